@@ -0,0 +1,197 @@
+"""
+the DependencyGraph class -- the resolved dependencies of a product
+"""
+import utils
+
+class DependencyGraph(object):
+    """
+    The dependencies of a product, resolved once (see Eups.getDependencyGraph()) and then queried
+    as often as needed.  The nodes are Products (i.e. (product, version, flavor)); each edge is
+    labelled with whether the dependency is optional.
+
+    There are two sets of edges:  the edges as resolved (which are used for closure queries), and
+    the edges used to order the products topologically.  These are the same unless the resolution
+    followed exact (as-built) versions, in which case the dependencies are usually flattened and the
+    order is taken from a resolution of the inexact dependencies of the same versions.
+    """
+
+    def __init__(self, topProduct, productDictionary=None):
+        """
+        @param topProduct        the Product whose dependencies are described
+        @param productDictionary the direct dependencies of each product, as filled in by
+                                   Table.dependencies(): a dictionary mapping a Product to a list of
+                                   (Product, optional?, recursionDepth)
+        """
+        self.topProduct = topProduct
+
+        # The products that topProduct depends on, as [Product, optional?, recursionDepth], in the
+        # order in which they were found
+        self.dependentProducts = []
+
+        self._edges = {}                # the resolved edges: Product -> [(Product, optional?), ...]
+        self._sortEdges = None          # the edges used for topological sorting; None means _edges
+        #
+        # The defaultProduct (see hooks.config.Eups.defaultProduct) is implicitly a dependency of
+        # every product, so it's treated specially when sorting
+        #
+        self.defaultProduct = None
+        self.defaultProductDeps = None  # the products that the defaultProduct depends on, if it has a table
+
+        if productDictionary:
+            self._edges = self._makeEdges(productDictionary)
+
+    def _makeEdges(self, productDictionary):
+        edges = {}
+        for product, deps in productDictionary.items():
+            if not edges.has_key(product):
+                edges[product] = []
+            for dep in deps:
+                edges[product].append((dep[0], dep[1]))
+                if not edges.has_key(dep[0]):
+                    edges[dep[0]] = []
+
+        return edges
+
+    def setSortEdges(self, productDictionary):
+        """Set the edges used for topological sorting from a dictionary like productDictionary in __init__"""
+        self._sortEdges = self._makeEdges(productDictionary)
+
+    def products(self):
+        """Return a list of all the products in the graph (including topProduct)"""
+        return self._edges.keys()
+
+    def getDependencies(self, product=None):
+        """Return the direct dependencies of product (default: topProduct) as a list of
+        (Product, optional?) tuples"""
+        if product is None:
+            product = self.topProduct
+
+        return list(self._edges.get(product, []))
+
+    def closure(self, product=None, includeOptional=True):
+        """
+        Return a set of all the products that product (default: topProduct) depends on, directly
+        or indirectly
+        @param includeOptional   follow optional dependencies too
+        """
+        if product is None:
+            product = self.topProduct
+
+        out = set()
+        todo = [product]
+        while todo:
+            for dep, optional in self._edges.get(todo.pop(), []):
+                if (includeOptional or not optional) and dep not in out:
+                    out.add(dep)
+                    todo.append(dep)
+
+        out.discard(product)
+        return out
+
+    def cycles(self):
+        """Return a list of the cycles in the graph, each a tuple of the Products involved"""
+        graph = {}
+        for product, deps in self._edges.items():
+            graph[product] = [dep for dep, optional in deps if dep != product]
+
+        return [c for c in utils.stronglyConnectedComponents(graph) if len(c) > 1]
+
+    def _sortGraph(self):
+        # Return a dictionary from the sort edges that can be used as input to utils.topologicalSort,
+        # handling the defaultProduct
+        edges = self._sortEdges
+        if edges is None:
+            edges = self._edges
+
+        pdir = {}
+        defaultProduct = self.defaultProduct
+        if defaultProduct:
+            if self.defaultProductDeps is not None:
+                pdir[defaultProduct] = set(self.defaultProductDeps)
+
+                if self.topProduct in self.defaultProductDeps:
+                    pdir[defaultProduct] = set()
+        else:
+            pdir[defaultProduct] = set()
+        #
+        # We have to a bit careful as we populate pdir.  There will be dependent cycles induced if
+        # there's an implicit dependency on a product that also appears in defaultProduct's dependencies
+        #
+        for k, values in edges.items():
+            if k == defaultProduct:   # don't modify pdir[defaultProduct]; especially don't add defaultProduct
+                continue
+            if not pdir.has_key(k):
+                pdir[k] = set()
+
+            for p, optional in values:
+                if p == defaultProduct and k in pdir[defaultProduct]:
+                    continue
+
+                pdir[k].add(p)
+
+        return pdir
+
+    def topologicalOrder(self, checkCycles=False, verbose=0):
+        """
+        Return a list of sets of Products, in the order that they should be setup (i.e. a set's
+        products only depend on products in earlier sets)
+        @param checkCycles   raise RuntimeError if a cycle is detected
+        """
+        return self._topologicalSort(checkCycles, verbose)
+
+    def _topologicalSort(self, checkCycles, verbose):
+        # the products sorted topologically, as returned by utils.topologicalSort (dependencies first)
+        return [t for t in utils.topologicalSort(self._sortGraph(), verbose=verbose, checkCycles=checkCycles)]
+
+    def getDependentProducts(self, topological=False, checkCycles=False, verbose=0):
+        """
+        Return the products that topProduct depends on as a list of [Product, optional?, recursionDepth]
+        as returned by Eups.getDependentProducts()
+        @param topological     Perform a topological sort before returning the product list; in this case the
+                               "recursionDepth" is the topological order
+        @param checkCycles     Raise RuntimeError if topological sort detects a cycle
+        """
+        dependentProducts = [list(p) for p in self.dependentProducts]
+
+        if not (topological or checkCycles):
+            return dependentProducts
+
+        sortedProducts = self._topologicalSort(checkCycles, verbose)
+        #
+        # Replace the recursion level by the topological depth
+        #
+        tsorted_depth = {}
+        nlevel = len(sortedProducts) + 1 # "+ 1" to allow for topProduct
+        for i, pp in enumerate(sortedProducts):
+            for p in pp:
+                if p:
+                    tsorted_depth[p.name] = nlevel - i - 1
+
+        if self.defaultProduct:
+            tsorted_depth[self.defaultProduct] = nlevel
+
+        for p in dependentProducts:
+            pname = p[0].name
+            if tsorted_depth.has_key(pname):
+                p[2] = tsorted_depth[pname]
+
+        dependentProducts.sort(lambda a, b: cmp((a[2], a[0].name),
+                                                (b[2], b[0].name))) # sort by topological depth
+        #
+        # Make dependentProducts unique, but be careful to mark a product that is sometimes required and
+        # sometimes optional as required
+        #
+        optional = {}
+        for p, opt, depth in dependentProducts:
+            optional[p] = opt and optional.get(p, True)
+
+        tmp = []
+        entries = {}
+        for p, opt, d in reversed(dependentProducts):
+            if entries.has_key(p):
+                continue
+            entries[p] = 1
+
+            tmp.append([p, optional[p], d])
+
+        return [v for v in reversed(tmp)]
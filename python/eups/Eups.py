@@ -9,12 +9,17 @@ import zlib
 
 import utils
 from stack      import ProductStack, CacheOutOfSync
-from db         import Database
+from db         import Database, TagIndex, UsesIndex
+from db.UsesIndex import usesIndexFile
+from TableCache import TableCache
+from TableRegistry import getTableRegistry
 from tags       import Tags, Tag, TagNotRecognized
 from exceptions import ProductNotFound, EupsException, TableError, TableFileNotFound
 from table      import Table, Action
 from Product    import Product
 from Uses       import Uses
+from DependencyGraph import DependencyGraph
+from VersionCompare import sortVersions, VersionExpr
 import hooks
 
 class Eups(object):
@@ -35,6 +40,10 @@ class Eups(object):
 
     debugFlag = False                   # set via --debug=debug
 
+    # If not None, a dictionary in which the ProductStacks read from the caches are kept so that later
+    # instances can reuse them while they remain current (used by a resident process; see eups.daemon)
+    residentStacks = None
+
     # static variable:  the name of the EUPS database directory inside a EUPS-
     #  managed software stack
     ups_db = "ups_db"
@@ -108,7 +117,7 @@ class Eups(object):
                  keep=False, max_depth=-1, preferredTags=None,
                  # above is the backward compatible signature
                  userDataDir=None, asAdmin=False, setupType=[], validSetupTypes=None, vro={},
-                 exact_version=None, cmdName=None
+                 exact_version=None, cmdName=None, validateCache=False
                  ):
         """
         @param path             the colon-delimited list of product stack 
@@ -137,6 +146,9 @@ class Eups(object):
         @param preferredTags      List of tags to process in order; None will be intepreted as the default
         @param exact_version      Where possible, use the exact versions that were previously declared
         @param cmdName            The command being run, if known (used for diagnostics)
+        @param validateCache      if True (and readCache is True), only use product caches that are
+                                  known to be up to date; stacks without one are read directly from
+                                  their databases, and no cache is rebuilt.
         """
 
         self.verbose = verbose
@@ -178,6 +190,7 @@ class Eups(object):
         hooks.loadCustomization(verbose, path=path)
 
         utils.Color.colorize(hooks.config.Eups.colorize)
+        TagIndex.persistent(hooks.config.Eups.persistTagIndex)
 
         self.oldEnviron = os.environ.copy() # the initial version of the environment
 
@@ -279,6 +292,17 @@ class Eups(object):
             self._vroDict[key] = v
 
         self._vro = None                # the actual VRO to use
+        #
+        # The results of searching the VRO, remembered so that each product is only found once however
+        # many products depend on it (see findProductFromVRO()), and how useful they've been
+        #
+        self._vroMemo = {}
+        self.vroMemoHits = 0
+        self.vroMemoMisses = 0
+        #
+        # Version expressions (e.g. ">= 3.2 && < 4"), compiled once (see _versionExpr())
+        #
+        self._versionExprs = {}
         # 
         # determine the user data directory.  This is a place to store 
         # user preferences and caches of product information.
@@ -303,29 +327,21 @@ class Eups(object):
         self.userDataDir = userDataDir
         self.asAdmin = asAdmin
 
+        if hooks.config.Eups.tableCache and self.userDataDir:
+            TableCache.directory(os.path.join(self.userDataDir, "_tables_"))
+        else:
+            TableCache.directory("")
+        getTableRegistry().resize(hooks.config.Eups.tableRegistrySize)
+
         #
-        # Get product information:  
-        #   * read the cached version of product info
+        # Product information is read from the product stacks (see ProductStack.fromCache) when it's
+        # first needed (see the versions property), as many commands never look at it
         #
-        self.versions = {}
-        neededFlavors = utils.Flavor().getFallbackFlavors(self.flavor, True)
-        if readCache:
-          for p in self.path:
-
-            # the product cache.  If cache is non-existent or out of date,
-            # the product info will be refreshed from the database
-            dbpath = self.getUpsDB(p)
-            cacheDir = dbpath
-            userCacheDir = self._makeUserCacheDir(p)
-            if not self.asAdmin or not utils.isDbWritable(p):
-                # use a user-writable alternate location for the cache
-                cacheDir = userCacheDir
-            self.versions[p] = ProductStack.fromCache(dbpath, neededFlavors, 
-                                                      persistDir=cacheDir, 
-                                                      userTagDir=userCacheDir,
-                                                      updateCache=True, 
-                                                      autosave=False,
-                                                      verbose=self.verbose)
+        self._readCache = readCache
+        self._validateCache = validateCache
+        self._stackPaths = self.path[:] # the stacks on EUPS_PATH (as opposed to user data directories)
+        self._versions = None           # the ProductStacks, once loaded
+        self._neededFlavors = utils.Flavor().getFallbackFlavors(self.flavor, True)
         #
         # 
         fallbackList = hooks.config.Eups.fallbackFlavors
@@ -343,7 +359,7 @@ class Eups(object):
            hooks.config.Eups.globalTags.count(user) == 0:
             hooks.config.Eups.userTags.append(user)
 
-        self.tags = Tags()
+        self._tags = Tags()
         self.commandLineTagNames = []   # names of tags specified on the command line; set in selectVRO
 
         for tags, group in [
@@ -357,31 +373,17 @@ class Eups(object):
                 tags = tags.split()
             for tag in tags:
                 try:
-                    self.tags.registerTag(tag, group)
+                    self._tags.registerTag(tag, group)
                 except RuntimeError, e:
                     raise RuntimeError("Unable to process tag %s: %s" % (tag, e))
 
-        self._loadServerTags()
-        self._loadUserTags()
         #
-        # Handle preferred tags; this is a list where None means hooks.config.Eups.preferredTags
+        # The tags found in the product stacks and the preferred tags are processed when the tags
+        # are first needed (see the tags property); preferredTags is a list where None means
+        # hooks.config.Eups.preferredTags
         #
-        if preferredTags is None:
-            preferredTags = [None]
-
-        pt, preferredTags = preferredTags, []
-        for tags in pt:
-            if not tags:
-                tags = hooks.config.Eups.preferredTags
-            if isinstance(tags, str):
-                tags = tags.split()
-
-            for t in tags:
-                preferredTags.append(t)
-                
-        q = utils.Quiet(self)
-        self._kindlySetPreferredTags(preferredTags)
-        del q
+        self._initialPreferredTags = preferredTags
+        self._tagsLoaded = False
         #
         # Find which tags are reserved to the installation
         #
@@ -403,37 +405,182 @@ class Eups(object):
         for k in ["commandLine", "keep", "type", "version", "version!", "versionExpr", "warn"]:
             self._internalTags.append(k)
         #
-        # Check that nobody's used an internal tag by mistake (setup -t keep would be bad...)
+        # Locally-setup products in the environment are found when first needed (see localVersions)
         #
-        for t in self.tags.getTags():
-            if (t.isUser() or t.isGlobal()) and self.isInternalTag(t, True):
-                pass
+        self._localVersions = None
         #
-        # Find locally-setup products in the environment
+        # Always search for products in user's datadir (it's where anonymous tags go); their
+        # stacks are read along with the others
         #
-        self.localVersions = {}
+        self.includeUserDataDirInPath()
+        for user in self._tags.owners.values():
+            self.includeUserDataDirInPath(utils.defaultUserDataDir(user))
 
+        self._defaultProductChecked = False
+
+    def _getVersions(self):
+        self._loadStacks()
+        if not self._tagsLoaded:
+            self.tags                   # the tags in the stacks must be processed before they're used
+        if not self._defaultProductChecked:
+            self._checkDefaultProduct()
+
+        return self._versions
+
+    def _setVersions(self, versions):
+        self._versions = versions
+
+    versions = property(_getVersions, _setVersions, doc=
+                        """the ProductStacks for each directory on the path, read when first needed""")
+
+    def _loadStacks(self):
+        """Read the product stacks for the directories on our path if we haven't already done so"""
+        if self._versions is not None:
+            return self._versions
+
+        self._versions = {}
+        neededFlavors = self._neededFlavors
+        for p in self.path:
+            if p not in self._stackPaths:
+                self._loadUserDataStack(p)
+                continue
+
+            if not self._readCache:
+                continue
+
+            # the product cache.  If cache is non-existent or out of date,
+            # the product info will be refreshed from the database
+            dbpath = self.getUpsDB(p)
+            cacheDir = dbpath
+            userCacheDir = self._makeUserCacheDir(p)
+            if not self.asAdmin or not utils.isDbWritable(p):
+                # use a user-writable alternate location for the cache
+                cacheDir = userCacheDir
+            if self._validateCache:
+                if Eups.residentStacks is not None:
+                    key = (dbpath, cacheDir, tuple(neededFlavors))
+                    stack = Eups.residentStacks.get(key)
+                    if stack and stack.isCurrent(neededFlavors, cacheDir):
+                        self._versions[p] = stack
+                        continue
+
+                stack = ProductStack.fromValidCache(dbpath, neededFlavors,
+                                                    persistDir=cacheDir,
+                                                    userTagDir=userCacheDir,
+                                                    verbose=self.verbose,
+                                                    indexBackend=hooks.config.Eups.cacheBackend)
+                if stack:
+                    self._versions[p] = stack
+                    if Eups.residentStacks is not None:
+                        Eups.residentStacks[key] = stack
+                continue
+
+            self._versions[p] = ProductStack.fromCache(dbpath, neededFlavors, 
+                                                       persistDir=cacheDir, 
+                                                       userTagDir=userCacheDir,
+                                                       updateCache=True, 
+                                                       autosave=False,
+                                                       verbose=self.verbose,
+                                                       indexBackend=hooks.config.Eups.cacheBackend,
+                                                       crawlThreads=hooks.config.Eups.crawlThreads)
+
+        return self._versions
+
+    def _loadUserDataStack(self, dataDir):
+        # read the stack in a user data directory (see includeUserDataDirInPath)
+        self._versions[dataDir] = ProductStack.fromCache(self.getUpsDB(dataDir), [self.flavor],
+                                                         updateCache=True, autosave=False,
+                                                         verbose=self.verbose,
+                                                         indexBackend=hooks.config.Eups.cacheBackend,
+                                                         crawlThreads=hooks.config.Eups.crawlThreads)
+
+    def _getTags(self):
+        if not self._tagsLoaded:
+            self._tagsLoaded = True     # set first, as loading the tags uses self.tags
+            self._loadTags()
+
+        return self._tags
+
+    def _setTags(self, tags):
+        self._tags = tags
+        self._tagsLoaded = True
+
+    tags = property(_getTags, _setTags, doc=
+                    """the recognized Tags, including those found in the product stacks""")
+
+    def _getPreferredTags(self):
+        if not self._tagsLoaded:
+            self.tags                   # sets the initial preferred tags
+        return self._preferredTags
+
+    def _setPreferredTags(self, tags):
+        self._preferredTags = tags
+
+    preferredTags = property(_getPreferredTags, _setPreferredTags, doc=
+                             """the tags to prefer when selecting products (see setPreferredTags)""")
+
+    def _loadTags(self):
+        """Process the tags found in the product stacks, and the preferred tags"""
+        self._loadServerTags()
+        self._loadUserTags()
+        #
+        # Handle preferred tags; this is a list where None means hooks.config.Eups.preferredTags
+        #
+        preferredTags = self._initialPreferredTags
+        if preferredTags is None:
+            preferredTags = [None]
+
+        pt, preferredTags = preferredTags, []
+        for tags in pt:
+            if not tags:
+                tags = hooks.config.Eups.preferredTags
+            if isinstance(tags, str):
+                tags = tags.split()
+
+            for t in tags:
+                preferredTags.append(t)
+                
         q = utils.Quiet(self)
-        for product in self.getSetupProducts():
-            try:
-                if product.version.startswith(Product.LocalVersionPrefix):
-                    try:
-                        pdir = os.environ[self._envarDirName(product.name)]
-                    except KeyError:    # they explicitly envUnset PRODUCT_DIR
-                        pdir = product.dir
-                    self.localVersions[product.name] = pdir
-            except TypeError:
-                pass
+        self._kindlySetPreferredTags(preferredTags)
+        del q
         #
-        # Always search for products in user's datadir (it's where anonymous tags go)
+        # Check that nobody's used an internal tag by mistake (setup -t keep would be bad...)
         #
-        self.includeUserDataDirInPath()
-        for user in self.tags.owners.values():
-            self.includeUserDataDirInPath(utils.defaultUserDataDir(user))
+        for t in self._tags.getTags():
+            if (t.isUser() or t.isGlobal()) and self.isInternalTag(t, True):
+                pass
+
+    def _getLocalVersions(self):
+        if self._localVersions is None:
+            self._localVersions = {}
+
+            q = utils.Quiet(self)
+            for product in self.getSetupProducts():
+                try:
+                    if product.version.startswith(Product.LocalVersionPrefix):
+                        try:
+                            pdir = os.environ[self._envarDirName(product.name)]
+                        except KeyError:    # they explicitly envUnset PRODUCT_DIR
+                            pdir = product.dir
+                        self._localVersions[product.name] = pdir
+                except TypeError:
+                    pass
+
+        return self._localVersions
+
+    def _setLocalVersions(self, localVersions):
+        self._localVersions = localVersions
+
+    localVersions = property(_getLocalVersions, _setLocalVersions, doc=
+                             """the locally-setup products in the environment, found when first needed""")
+
+    def _checkDefaultProduct(self):
         #
         # We just changed the default defaultProduct from "toolchain" to "implicitProducts";
         # include a back-door for toolchain.  This hack should be deleted at some point.
         #
+        self._defaultProductChecked = True
+
         defaultProduct = hooks.config.Eups.defaultProduct["name"]
         if not self.findProduct(defaultProduct, hooks.config.Eups.defaultProduct["version"]):
             if defaultProduct == "implicitProducts" and self.findProduct("toolchain"):
@@ -539,8 +686,9 @@ The what argument tells us what sort of state is expected (allowed values are de
         return cachedir
 
     def _loadServerTags(self):
+        versions = self._loadStacks()
         tags = {}
-        for path in self.path:
+        for path in self._stackPaths:
             tags[path] = Tags()
 
             # start by looking for a cached list
@@ -554,8 +702,8 @@ The what argument tells us what sort of state is expected (allowed values are de
             tagNames = set()
             tagUsedInProducts = None    # used for better diagnostics
 
-            if self.versions.has_key(path):
-                for t in self.versions[path].getTags():
+            if versions.has_key(path):
+                for t in versions[path].getTags():
                     tagNames.add(t)
 
             for t in tagNames:
@@ -598,7 +746,8 @@ The what argument tells us what sort of state is expected (allowed values are de
         return tags
 
     def _loadUserTags(self):
-        for path in self.path:
+        versions = self._loadStacks()
+        for path in self._stackPaths:
             # start by looking for a cached list
             dirName = self._userStackCache(path)
             if not dirName or not os.path.isdir(dirName) or self.tags.loadUserTags(dirName):
@@ -606,8 +755,8 @@ The what argument tells us what sort of state is expected (allowed values are de
 
             # if no list cached, try asking the cached product stack
             tags = Tags()
-            if self.versions.has_key(path):
-                for t in self.versions[path].getTags():
+            if versions.has_key(path):
+                for t in versions[path].getTags():
                     t = Tag.parse(t)
                     if t.isUser() and not self.tags.isRecognized(t.name):
                         tags.registerUserTag(t.name)
@@ -634,13 +783,13 @@ The what argument tells us what sort of state is expected (allowed values are de
         db = Database(self.getUpsDB(path))
 
         for tag, owner in self.tags.owners.items():
-            for p in self.path:
+            for p in self._stackPaths:
                 userCacheDir = utils.userStackCacheFor(p, userDataDir=utils.defaultUserDataDir(owner))
                 extraDb = Database(self.getUpsDB(p), userCacheDir, owner=owner)
 
                 db.addUserTagDb(userCacheDir, p, userId=owner)
 
-                if not self.versions.has_key(p):
+                if not versions.has_key(p):
                     continue
 
                 for productName in extraDb.findProductNames():
@@ -649,7 +798,7 @@ The what argument tells us what sort of state is expected (allowed values are de
                             continue
 
                         try:
-                            self.versions[p].lookup[flavor][productName].tags[etag] = versionName
+                            versions[p].lookup[flavor][productName].tags[etag] = versionName
                         except KeyError:
                             continue
                 
@@ -835,10 +984,80 @@ The what argument tells us what sort of state is expected (allowed values are de
         if isinstance(eupsPathDirs, str):
             eupsPathDirs = [eupsPathDirs]
 
-        product, vroReason = None, None
-
         if not vro:
             vro = self.getPreferredTags()
+        #
+        # Look for an answer from an earlier call (see _vroMemoKey)
+        #
+        key = self._vroMemoKey(name, version, versionExpr, eupsPathDirs, flavor, noCache, recursionDepth,
+                               vro, optional)
+        if key is not None and self._vroMemo.has_key(key):
+            self.vroMemoHits += 1
+            product, vroReason, vroTag0, vroTag, warnings = self._vroMemo[key]
+            if product:
+                product = product.clone()
+            if vroReason:
+                vroReason = vroReason[:]
+            for strm, msg in warnings:  # as the search would have printed them
+                self._printVroWarning(strm, msg)
+        else:
+            self.vroMemoMisses += 1
+            warnings = []
+            product, vroReason, vroTag0, vroTag = \
+                self._searchVRO(name, version, versionExpr, eupsPathDirs, flavor, noCache, recursionDepth,
+                                vro, optional, warnings)
+            if key is not None:
+                memoReason = vroReason
+                if memoReason:
+                    memoReason = memoReason[:]
+                self._vroMemo[key] = (product, memoReason, vroTag0, vroTag, warnings)
+
+        if product:
+            if self.alreadySetupProducts.has_key(name): # name is already setup
+                oproduct, ovroReason = self.alreadySetupProducts[name]
+                if ovroReason:              # we setup this product
+                    ovroTag = ovroReason[0] # tag used to select the product last time we saw it
+
+                    try:
+                        if vro.count(ovroTag) and \
+                               vro.index(vroTag0) > vro.index(ovroTag): # old vro tag takes priority
+                            if self.verbose > 1:
+                                print >> utils.stdinfo, "%s%s has higher priority than %s in your VRO; keeping %s %s" % \
+                                      (13*" ", ovroTag, vroTag0, oproduct.name, oproduct.version)
+                                
+                            product, vroReason, vroTag = oproduct, ovroReason, ovroTag
+                    except Exception, e:
+                        utils.debug("RHL", name, vroTag, vro, vroReason, e)
+                        pass
+                else:                   # setup by previous setup command
+                    if oproduct.version != product.version:
+                        if self.verbose > 1:
+                            print >> sys.stderr, "%s%s %s replaces previously setup %s %s" % (13*" ",
+                                                                             product.name, product.version,
+                                                                             oproduct.name, oproduct.version)
+
+            if self.verbose > 3 or (self.cmdName in ("setup", "uses") and self.verbose > 2):
+                print >> sys.stderr, ("VRO used %-20s " % (vroTag)),
+                if self.cmdName != "setup":
+                    print >> sys.stderr, "%-15s %s" % (product.name, product.version)
+
+        return [product, vroReason]
+
+    def _searchVRO(self, name, version, versionExpr, eupsPathDirs, flavor, noCache, recursionDepth,
+                   vro, optional, warnings=None):
+        """
+        Search the VRO for a product for findProductFromVRO(); return (product, vroReason, vroTag0, vroTag)
+        where vroTag0 is the VRO entry that matched and vroTag the name it matched as.  The warnings
+        that are printed are also appended to warnings (if not None) as (stream name, message) pairs
+        (see _printVroWarning())
+        """
+        def warn(strm, msg):
+            self._printVroWarning(strm, msg)
+            if warnings is not None:
+                warnings.append((strm, msg))
+
+        product, vroReason = None, None
+        vroTag0, vroTag = None, None
 
         for i, vroTag in enumerate(vro):
             vroTag0 = vroTag            # we may modify vroTag
@@ -873,16 +1092,16 @@ The what argument tells us what sort of state is expected (allowed values are de
                         if "versionExpr" in postVro:
                             continue
                         else:
-                            print >> utils.stdwarn, "Failed to find %s %s for flavor %s" % \
-                                  (name, version, flavor)
+                            warn("warn", "Failed to find %s %s for flavor %s" % \
+                                 (name, version, flavor))
                             break
                     
                     versionExpr = version
                     
                 if vroTag == "versionExpr" and versionExpr:
                     if self.isLegalRelativeVersion(versionExpr):  # raises exception if bad syntax used
-                        products = self._findProductsByExpr(name, versionExpr, eupsPathDirs, flavor, noCache)
-                        product = self._selectPreferredProduct(products, ["latest"])
+                        product = self._findLatestProductByExpr(name, versionExpr, eupsPathDirs, flavor,
+                                                                noCache)
 
                         if product:
                             vroReason = [vroTag, versionExpr]
@@ -933,8 +1152,8 @@ The what argument tells us what sort of state is expected (allowed values are de
                 else:
                     if not ("version" in postVro or "version!" in postVro or "versionExpr" in postVro):
                         if self.verbose > self.quiet:
-                            print >> utils.stdwarn, "Failed to find %s %s for flavor %s" % \
-                                  (name, version, flavor)
+                            warn("warn", "Failed to find %s %s for flavor %s" % \
+                                 (name, version, flavor))
                         break
 
             elif re.search(r"^warn(:\d+)?$", vroTag):
@@ -965,7 +1184,7 @@ The what argument tells us what sort of state is expected (allowed values are de
                     if flavor:
                         msg += " (Flavor: %s)" % flavor
 
-                    print >> sys.stderr, msg
+                    warn("stderr", msg)
 
             elif self.tags.isRecognized(vroTag) or os.path.isfile(vroTag):
                 # search for a tagged version
@@ -989,7 +1208,7 @@ The what argument tells us what sort of state is expected (allowed values are de
                     self.makeVroExact()
 
             else:
-                print >> utils.stderr, "Impossible entry on the VRO %s (%s)" % (vroTag, vro)
+                warn("error", "Impossible entry on the VRO %s (%s)" % (vroTag, vro))
                 if False:
                     product = self.findProduct(name, version=Tag(vroTag), eupsPathDirs=eupsPathDirs,
                                                flavor=flavor, noCache=noCache)
@@ -997,36 +1216,47 @@ The what argument tells us what sort of state is expected (allowed values are de
             if product:
                 break
 
-        if product:
-            if self.alreadySetupProducts.has_key(name): # name is already setup
-                oproduct, ovroReason = self.alreadySetupProducts[name]
-                if ovroReason:              # we setup this product
-                    ovroTag = ovroReason[0] # tag used to select the product last time we saw it
+        return product, vroReason, vroTag0, vroTag
 
-                    try:
-                        if vro.count(ovroTag) and \
-                               vro.index(vroTag0) > vro.index(ovroTag): # old vro tag takes priority
-                            if self.verbose > 1:
-                                print >> utils.stdinfo, "%s%s has higher priority than %s in your VRO; keeping %s %s" % \
-                                      (13*" ", ovroTag, vroTag0, oproduct.name, oproduct.version)
-                                
-                            product, vroReason, vroTag = oproduct, ovroReason, ovroTag
-                    except Exception, e:
-                        utils.debug("RHL", name, vroTag, vro, vroReason, e)
-                        pass
-                else:                   # setup by previous setup command
-                    if oproduct.version != product.version:
-                        if self.verbose > 1:
-                            print >> sys.stderr, "%s%s %s replaces previously setup %s %s" % (13*" ",
-                                                                             product.name, product.version,
-                                                                             oproduct.name, oproduct.version)
+    def _printVroWarning(self, strm, msg):
+        """
+        Print a warning from _searchVRO() to the stream named strm ("warn", "error", or "stderr");
+        the stream is looked up each time so that a remembered warning goes where a new one would
+        """
+        print >> {"warn" : utils.stdwarn, "error" : utils.stderr, "stderr" : sys.stderr}[strm], msg
 
-            if self.verbose > 3 or (self.cmdName in ("setup", "uses") and self.verbose > 2):
-                print >> sys.stderr, ("VRO used %-20s " % (vroTag)),
-                if self.cmdName != "setup":
-                    print >> sys.stderr, "%-15s %s" % (product.name, product.version)
+    def _vroMemoKey(self, name, version, versionExpr, eupsPathDirs, flavor, noCache, recursionDepth,
+                    vro, optional):
+        """
+        Return the key to use to remember the result of a search of the VRO, or None if the
+        result mustn't be remembered.
 
-        return [product, vroReason]
+        The key includes the VRO itself, so changing it (e.g. with pushStack("vro")/popStack("vro"))
+        selects a different set of remembered results.  Results that depend on the products that have
+        already been setup (via the "keep" and "commandLine" VRO entries) or that have side effects
+        (the "type:" entries) aren't remembered
+        """
+        if self.alreadySetupProducts.has_key(name) and \
+               ("commandLine" in vro or (recursionDepth > 0 and "keep" in vro)):
+            return None
+
+        for v in vro:
+            if v.startswith("type:"):
+                return None
+
+        if isinstance(version, Tag):
+            version = ("tag", str(version))
+
+        return (name, version, versionExpr, tuple(eupsPathDirs), flavor, tuple(vro),
+                self.exact_version, self.ignore_versions, tuple(self.setupType),
+                bool(noCache), recursionDepth > 0, bool(optional), self.verbose, self.quiet)
+
+    def clearVroMemo(self):
+        """
+        Forget the results of earlier searches of the VRO made by findProductFromVRO().  This
+        is called whenever we change the products that are declared or their tags
+        """
+        self._vroMemo = {}
 
     def findProduct(self, name, version=None, eupsPathDirs=None, flavor=None,
                     noCache=False):
@@ -1321,8 +1551,7 @@ The what argument tells us what sort of state is expected (allowed values are de
             else:
                 # consult the cache
                 try: 
-                    vers = self.versions[root].getVersions(name, flavor)
-                    vers.sort(self.version_cmp)
+                    vers = self.versions[root].getSortedVersions(name, flavor, self.version_cmp)
                     if len(vers) == 0:
                         continue
 
@@ -1361,7 +1590,8 @@ The what argument tells us what sort of state is expected (allowed values are de
                 if len(products) == 0: 
                     continue
 
-                products = filter(lambda z: self.version_match(z.version, expr), products)
+                sortVersions(products, self.version_cmp, key=lambda p: p.version)
+                products = self._versionExpr(expr).select(products, key=lambda p: p.version)
                 for prod in products:
                     if prod.version not in outver:
                         out.append(prod)
@@ -1370,8 +1600,8 @@ The what argument tells us what sort of state is expected (allowed values are de
             else:
                 # consult the cache
                 try: 
-                    vers = self.versions[root].getVersions(name, flavor)
-                    vers = filter(lambda z: self.version_match(z, expr), vers)
+                    vers = self.versions[root].getSortedVersions(name, flavor, self.version_cmp)
+                    vers = self._versionExpr(expr).select(vers)
                     if len(vers) == 0:
                         continue
                     for ver in vers:
@@ -1385,6 +1615,39 @@ The what argument tells us what sort of state is expected (allowed values are de
 
         return out
 
+    def _findLatestProductByExpr(self, name, expr, eupsPathDirs, flavor, noCache):
+        # find the product with the latest version that satisfies the given expression, as
+        # _selectPreferredProduct(_findProductsByExpr(...), ["latest"]) would, but only looking
+        # for the latest match in each stack
+        versionExpr = self._versionExpr(expr)
+        latest = []
+        for root in eupsPathDirs:
+            if noCache or not self.versions.has_key(root) or not self.versions[root]:
+                # go directly to the EUPS database
+                if not os.path.exists(self.getUpsDB(root)):
+                    if self.verbose:
+                        print >> utils.stdwarn, "Skipping missing EUPS stack:", self.getUpsDB(root)
+                    continue
+
+                products = self._databaseFor(root).findProducts(name, flavors=flavor)
+                sortVersions(products, self.version_cmp, key=lambda p: p.version)
+                prod = versionExpr.best(products, key=lambda p: p.version)
+            else:
+                # consult the cache
+                try: 
+                    vers = self.versions[root].getSortedVersions(name, flavor, self.version_cmp)
+                    ver = versionExpr.best(vers)
+                    if ver is None:
+                        continue
+                    prod = self.versions[root].getProduct(name, ver, flavor)
+                except ProductNotFound:
+                    continue
+
+            if prod:
+                latest.append(prod)
+
+        return self._selectPreferredProduct(latest, ["latest"])
+
     def _selectPreferredProduct(self, products, preferredTags=None):
         # return the product in a list that is most preferred.
         # None is returned if no products are so tagged.
@@ -1400,7 +1663,7 @@ The what argument tells us what sort of state is expected (allowed values are de
             if tag.name == "latest":
                 # find the latest version; first order the versions
                 vers = map(lambda p: p.version, products)
-                vers.sort(self.version_cmp)
+                sortVersions(vers, self.version_cmp)
 
                 # select the product with the latest version
                 if len(vers) > 0:
@@ -1487,9 +1750,8 @@ The what argument tells us what sort of state is expected (allowed values are de
             if self.path.count(dataDir) == 0:
                 self.path.append(dataDir)
                 
-                self.versions[dataDir] = ProductStack.fromCache(self.getUpsDB(dataDir), [self.flavor],
-                                                                updateCache=True, autosave=False,
-                                                                verbose=self.verbose)
+                if self._versions is not None: # we've already read the other stacks
+                    self._loadUserDataStack(dataDir)
 
     def getSetupProducts(self, requestedProductName=None):
         """Return a list of all Products that are currently setup (or just the specified product)"""
@@ -1657,7 +1919,7 @@ The what argument tells us what sort of state is expected (allowed values are de
                     "Unable to unsetup %s %s: %s" % (prod.name, prod.version, e)
 
     # Permitted relational operators
-    _relop_re = re.compile(r"<=?|>=?|==")
+    _relop_re = VersionExpr.relop_re
     _bad_relop_re = re.compile(r"^\s*=\s+\S+")
 
     def isLegalRelativeVersion(self, versionName):
@@ -1673,58 +1935,23 @@ The what argument tells us what sort of state is expected (allowed values are de
     def version_match(self, vname, expr):
         """Return vname if it matches the logical expression expr"""
 
-        expr0 = expr
-        expr = filter(lambda x: not re.search(r"^\s*$", x), re.split(r"\s*(%s|\|\||\s)\s*" % self._relop_re.pattern, expr0))
-
-        logop = None                    # the next logical operation to process
-        value = None                    # the value of the current term (e.g. ">= 2.0.0")
-        i = -1
-        while i < len(expr) - 1:
-            i += 1
-
-            if self._relop_re.search(expr[i]):
-                relop = expr[i]; i += 1
-                v = expr[i]
-            elif re.search(r"^[-+.:/\w]+$", expr[i]) and expr[i] not in ("and", "or"):
-                relop = "=="
-                v = expr[i]
-            elif expr[i] == "||" or expr[i] == "or":
-                logop = "or"
-                continue
-            elif expr[i] == "&&" or expr[i] == "and":
-                if not value:
-                    return False        # short circuit
-                
-                logop = "and"
-                continue
-            else:
-                print >> utils.stdwarn, "Unexpected operator %s in \"%s\"" % (expr[i], expr0)
-                break
+        try:
+            if self._versionExpr(expr).match(vname):
+                return vname
+        except ValueError, e:           # no sort order is defined
+            if self.verbose > 2:
+                print >> utils.stdwarn, e
 
-            if not logop and value is not None:
-                print >> utils.stdwarn, "Expected logical operator || or && in \"%s\" at %s" % (expr0, v)
-            else:
-                try:
-                    rhs = self.version_match_prim(relop, vname, v)
-                    if not logop:
-                        value = rhs
-                    elif logop == "and":
-                        if value and rhs:
-                            value = True
-                        else:
-                            value = False
-                    elif logop == "or":
-                        if value or rhs:
-                            return vname
+        return None
 
-                        value = False
-                except ValueError, e:           # no sort order is defined
-                    return None
+    def _versionExpr(self, expr):
+        """Return the VersionExpr for the logical expression expr, compiling it if it's new"""
 
-        if value:
-            return vname
-        else:
-            return None
+        try:
+            return self._versionExprs[expr]
+        except KeyError:
+            versionExpr = self._versionExprs[expr] = VersionExpr(expr, self.version_cmp)
+            return versionExpr
 
     def version_match_prim(self, op, v1, v2):
         """
@@ -2119,6 +2346,7 @@ The what argument tells us what sort of state is expected (allowed values are de
         @param productName   the name of the product to tag
         @param versionName   the version of the product
         """
+        self.clearVroMemo()
         # convert tag name to a Tag instance; may raise TagNotRecognized
         tag = self.tags.getTag(tag)
 
@@ -2159,6 +2387,7 @@ The what argument tells us what sort of state is expected (allowed values are de
                                  the first product in the stack with that tag
                                  will be chosen.
         """
+        self.clearVroMemo()
         # convert tag name to a Tag instance; may raise TagNotRecognized
         tag = self.tags.getTag(tag)
 
@@ -2298,6 +2527,8 @@ The what argument tells us what sort of state is expected (allowed values are de
         @param declareCurrent  DEPRECATED, if True and tag=None, it is 
                                equivalent to tag="current".  
         """
+        self.clearVroMemo()
+        getTableRegistry().invalidate(productName)
         if re.search(r"[^a-zA-Z_0-9]", productName):
             raise EupsException("Product names may only include the characters [a-zA-Z_0-9]: saw %s" % productName)
 
@@ -2698,6 +2929,8 @@ The what argument tells us what sort of state is expected (allowed values are de
         @param undeclareCurrent  DEPRECATED; if True, and tag is None, this
                                 is equivalent to tag="current".  
         """
+        self.clearVroMemo()
+        getTableRegistry().invalidate(productName)
         # this is for backward compatibility
         if isinstance(tag, bool) or (tag is None and undeclareCurrent):
             tag = "current"
@@ -2894,13 +3127,12 @@ The what argument tells us what sort of state is expected (allowed values are de
                                     out.append(prod)
 
                     # select out matched versions
-                    vers = stack.getVersions(pname, flavor)
+                    vers = stack.getSortedVersions(pname, flavor, self.version_cmp)
                     if version:
                         if self.isLegalRelativeVersion(version): # version is actually an expression
-                            vers = [v for v in vers if self.version_match(v, version)]
+                            vers = self._versionExpr(version).select(vers)
                         else:
                             vers = fnmatch.filter(vers, version)
-                    vers.sort(self.version_cmp)
 
                     # only include latest if it passes the version constraint
                     if latest is not None and latest.version not in vers:
@@ -3007,10 +3239,35 @@ The what argument tells us what sort of state is expected (allowed values are de
         @param checkCycles     Raise RuntimeError if topological sort detects a cycle
         @param requiredVersions Require using these particular versions; to support topological sort
 
-        See also getDependencies()
+        See also getDependencies() and getDependencyGraph()
         """
+        graph = self.getDependencyGraph(topProduct, setup, shouldRaise, followExact, productDictionary,
+                                        topological=(topological or checkCycles),
+                                        requiredVersions=requiredVersions)
 
-        dependentProducts = []
+        return graph.getDependentProducts(topological, checkCycles, verbose=self.verbose)
+
+    def getDependencyGraph(self, topProduct, setup=False, shouldRaise=False,
+                           followExact=None, productDictionary=None, topological=False,
+                           requiredVersions={}):
+        """
+        Resolve Product topProduct's dependencies, returning them as a DependencyGraph
+        @param topProduct      Desired Product
+        @param setup           Use the versions of dependent products that are actually setup
+        @param shouldRaise     Raise an exception if setup is True and a required product isn't setup
+        @param followExact     If None use the exact/inexact status in eupsenv; if non-None set desired exactness
+        @param productDictionary add each product as a member of this dictionary (if non-NULL) and with the
+                               value being that product's dependencies.
+        @param topological     Also find what's needed to sort the graph topologically
+        @param requiredVersions Require using these particular versions
+
+        See also getDependentProducts()
+        """
+
+        if productDictionary is None:
+            productDictionary = {}
+
+        graph = DependencyGraph(topProduct)
 
         try:
             prodtbl = topProduct.getTable()
@@ -3019,8 +3276,9 @@ The what argument tells us what sort of state is expected (allowed values are de
             prodtbl = None
 
         if not prodtbl:
-            return dependentProducts
+            return graph
 
+        dependentProducts = []
         for product, optional, recursionDepth in prodtbl.dependencies(self, recursive=True, recursionDepth=1,
                                                                       followExact=followExact,
                                                                       productDictionary=productDictionary,
@@ -3046,112 +3304,53 @@ The what argument tells us what sort of state is expected (allowed values are de
                 product = setupProduct
 
             dependentProducts.append([product, optional, recursionDepth])
+
+        graph = DependencyGraph(topProduct, productDictionary)
+        graph.dependentProducts = dependentProducts
+
+        if not topological:
+            return graph
         #
         # If we're getting exact versions they'll all be at the same recursion depth which gives us
         # no clue about the order they need to be setup in.  Get the depth information from a
-        # topological sort of the inexact setup
+        # topological sort of the inexact setup.  If we already have the inexact setup (and each product
+        # only appears with one version) there's no need to resolve it again
         #
-        if topological or checkCycles:
-            productDictionary = {}          # look up the dependency tree assuming NON-exact (as exact
-                                            # dependencies are usually flattened)
+        if followExact is None:
+            exact = self.exact_version
+        else:
+            exact = followExact
+
+        names = [prod[0].name for prod in dependentProducts]
+        if not exact and not setup and len(set(names)) == len(names):
+            sortDictionary = productDictionary
+        else:
+            sortDictionary = {}         # look up the dependency tree assuming NON-exact (as exact
+                                        # dependencies are usually flattened)
 
             q = utils.Quiet(self)
             reqVersions = requiredVersions.copy()
             reqVersions.update(dict([(prod[0].name,prod[0].version) for prod in dependentProducts]))
-            self.getDependentProducts(topProduct, setup, shouldRaise,
-                                      followExact=False, productDictionary=productDictionary,
-                                      requiredVersions=reqVersions)
+            self.getDependencyGraph(topProduct, setup, shouldRaise,
+                                    followExact=False, productDictionary=sortDictionary,
+                                    requiredVersions=reqVersions)
             del q
-            # Create a dictionary from productDictionary that can be used as input to utils.topologicalSort
-            pdir = {}
-            #
-            # Remove the defaultProduct from productDictionary
-            #
-            defaultProduct = hooks.config.Eups.defaultProduct["name"]
-            if defaultProduct:
-                prods = [k for k in productDictionary.keys() if k.name == defaultProduct]
-                if prods:
-                    defaultProduct = prods[0]
-
-                    if defaultProduct:
-                        ptable = defaultProduct.getTable()
-                        if ptable:
-                            pdir[defaultProduct] = \
-                                                 set([p[0] for p in ptable.dependencies(self, recursive=True)])
-
-                    if topProduct in \
-                           [e[0] for e in defaultProduct.getTable().dependencies(self, recursive=True)]:
-                        del productDictionary[defaultProduct]
-                        pdir[defaultProduct] = set()
-                else:
-                    defaultProduct = None
-
-            if not defaultProduct:
-                pdir[defaultProduct] = set()
-            #
-            # We have to a bit careful as we populate pdir.  There will be dependent cycles induced if
-            # there's an implicit dependency on a product that also appears in defaultProduct's dependencies
-            #
-            for k, values in productDictionary.items():
-                if k == defaultProduct:   # don't modify pdir[defaultProduct]; especially don't add defaultProduct
-                    continue
 
-                if not pdir.has_key(k):
-                    pdir[k] = set()
-
-                for v in values:
-                    p = v[0]             # the dependent product
-
-                    if p == defaultProduct and k in pdir[defaultProduct]:
-                        continue
-
-                    pdir[k].add(p)
-            #
-            # Actually do the topological sort
-            #
-            sortedProducts = [t for t in
-                              utils.topologicalSort(pdir,verbose=self.verbose,
-                                                    checkCycles=checkCycles)] # products sorted topologically
-            #
-            # Replace the recursion level by the topological depth
-            #
-            tsorted_depth = {}
-            nlevel = len(sortedProducts) + 1 # "+ 1" to allow for topProduct
-            for i, pp in enumerate(sortedProducts):
-                for p in pp:
-                    if p:
-                        tsorted_depth[p.name] = nlevel - i - 1
-
-            if defaultProduct:
-                tsorted_depth[defaultProduct] = nlevel
-
-            for p in dependentProducts:
-                pname = p[0].name
-                if tsorted_depth.has_key(pname):
-                    p[2] = tsorted_depth[pname]
-
-            dependentProducts.sort(lambda a, b: cmp((a[2], a[0].name),
-                                                    (b[2], b[0].name))) # sort by topological depth
-            #
-            # Make dependentProducts unique, but be careful to mark a product that is sometimes required and
-            # sometimes optional as required
-            #
-            optional = {}
-            for p, opt, depth in dependentProducts:
-                optional[p] = opt and optional.get(p, True)
-
-            tmp = []
-            entries = {}
-            for p, opt, d in reversed(dependentProducts):
-                if entries.has_key(p):
-                    continue
-                entries[p] = 1
-                
-                tmp.append([p, optional[p], d])
+            graph.setSortEdges(sortDictionary)
+        #
+        # The defaultProduct is treated specially when sorting
+        #
+        defaultProduct = hooks.config.Eups.defaultProduct["name"]
+        if defaultProduct:
+            prods = [k for k in sortDictionary.keys() if k.name == defaultProduct]
+            if prods:
+                graph.defaultProduct = prods[0]
 
-            dependentProducts = [v for v in reversed(tmp)]
+                ptable = graph.defaultProduct.getTable()
+                if ptable:
+                    graph.defaultProductDeps = [p[0] for p in ptable.dependencies(self, recursive=True)]
 
-        return dependentProducts
+        return graph
 
     def remove(self, productName, versionName, recursive=False, checkRecursive=False, interactive=False, userInfo=None):
         """Undeclare and remove a product.  If recursive is true also remove everything that
@@ -3310,47 +3509,165 @@ The what argument tells us what sort of state is expected (allowed values are de
         if not usesInfo:
             usesInfo = Uses()
 
-            for pi in productList:          # for every known product
-                if False:
-                    try:
-                        q = utils.Quiet(self)
-                        tbl = pi.getTable()
+            usesIndex = self._updateUsesIndex(productList)
+            for (name, version, flavor), deps in usesIndex.depends.items():
+                for dep in deps:
+                    usesInfo.remember(name, version, dep)
 
-                        if not tbl:
-                            del q
-                            continue
+            usesInfo.invert(depth)
 
-                        depsO = tbl.dependencies(self, followExact=True) # lookup top-level dependencies
+        self.exact_version = old_exact_version
+        #
+        # OK, we have the information stored away
+        #
+        if not productName:
+            return usesInfo
 
-                        del q
-                    except Exception, e:
-                        if not self.quiet:
-                            print >> utils.stdwarn, ("Warning: %s" % (e))
-                        continue
+        return usesInfo.users(productName, versionName)
 
-                try:
-                    deps = self.getDependentProducts(pi, shouldRaise=False, followExact=None, topological=True)
-                except TableError, e:
-                    if not self.quiet:
-                        print >> utils.stdwarn, ("Warning: %s" % (e))
+    def _productUses(self, product):
+        # Return the dependencies of a product, in the form needed by Uses.remember(), and the names of
+        # all the products that its table (and those of its dependencies) asked for, found or not
+        productDictionary = {}
+        try:
+            graph = self.getDependencyGraph(product, shouldRaise=False, followExact=None, topological=True,
+                                            productDictionary=productDictionary)
+            deps = graph.getDependentProducts(topological=True, verbose=self.verbose)
+        except TableError, e:
+            if not self.quiet:
+                print >> utils.stdwarn, ("Warning: %s" % (e))
+            deps = []
+
+        out = []
+        for dep_product, dep_optional, dep_depth in deps:
+            assert not (product.name == dep_product.name and product.version == dep_product.version)
+
+            out.append((dep_product.name, dep_product.version, dep_optional, dep_depth))
+
+        requests = set([dep[0] for dep in out])
+        for vals in productDictionary.values():
+            requests.update([val[0].name for val in vals])
+        requests.discard(product.name)
+
+        return out, sorted(requests)
+
+    def _usesIndexStacks(self):
+        # Return a list of (database, database roots, index file) for each product stack; the
+        # roots are the directories that record changes to the database (including its user tags)
+        stacks = []
+        for p in self.path:
+            dbpath = self.getUpsDB(p)
+            persistDir = dbpath
+            if not self.asAdmin or not utils.isDbWritable(p):
+                persistDir = self._makeUserCacheDir(p)
+
+            dbroots = [dbpath]
+            userCacheDir = self._userStackCache(p)
+            if userCacheDir and os.path.isdir(userCacheDir):
+                dbroots.append(userCacheDir)
+
+            file = None
+            if persistDir:
+                file = os.path.join(persistDir, usesIndexFile)
+            stacks.append((dbpath, dbroots, file))
+
+        return stacks
+
+    def _updateUsesIndex(self, productList):
+        """Return a UsesIndex giving the dependencies of all the products in productList
+
+        The index saved by the last call (in each product stack, or in the user's caches for the stacks) is
+        loaded, and only the entries that could have been affected by changes to the databases and table
+        files since then are recomputed; e.g. declaring a version of a product recomputes that version's
+        dependencies and those of every product that depends on any version of it, or that asked for it
+        without finding a suitable version (e.g. as an optional dependency).  Databases that don't
+        record their generation are checked using modification times, and a change to one of them means
+        that the whole index is recomputed.
+        """
+        now = time.time()
+        context = (tuple(self.path), self.flavor, self._vro and [str(v) for v in self._vro],
+                   [str(t) for t in self.preferredTags], self.setupType, self.exact_version,
+                   hooks.config.Eups.defaultProduct["name"])
+        index = UsesIndex(context)
+
+        stacks = self._usesIndexStacks()
+        if hooks.config.Eups.usesIndex:
+            for dbpath, dbroots, file in stacks:
+                if file:
+                    index.load(file)
+        #
+        # Find the products that might have changed since the index was brought up to date
+        #
+        changed = set()                 # the names of the products
+        rebuild = index.updated is None
+        generations = {}
+        for dbpath, dbroots, file in stacks:
+            for dbroot in dbroots:
+                generations[dbroot] = Database(dbroot).getGeneration()
+                if rebuild:
                     continue
 
-                for dep_product, dep_optional, dep_depth in deps:
-                    assert not (pi.name == dep_product.name and pi.version == dep_product.version)
+                if not index.generations.has_key(dbroot):
+                    rebuild = True
+                elif index.generations[dbroot] is None:
+                    if Database(dbroot).isNewerThan(index.updated - utils.mtimeResolution):
+                        rebuild = True
+                else:
+                    changes = Database(dbroot).getChanges(index.generations[dbroot])
+                    if changes is None:
+                        rebuild = True
+                    else:
+                        changed.update([c[2] for c in changes])
 
-                    usesInfo.remember(pi.name, pi.version, (dep_product.name, dep_product.version,
-                                                            dep_optional, dep_depth))
+        if rebuild:
+            index = UsesIndex(context)
 
-            usesInfo.invert(depth)
+        current = {}
+        for product in productList:
+            current[(product.name, product.version, product.flavor)] = product
 
-        self.exact_version = old_exact_version
+        for key in index.keys():
+            if not current.has_key(key):
+                index.remove(key)
+                changed.add(key[0])
+
+        tableMtimes = {}
+        for key, product in current.items():
+            try:
+                tableMtimes[key] = os.stat(product.tableFileName()).st_mtime
+            except (OSError, TypeError):
+                tableMtimes[key] = None
+
+            if not index.has_key(key) or index.tableMtimes[key] != tableMtimes[key]:
+                changed.add(key[0])
         #
-        # OK, we have the information stored away
+        # Recompute the entries for the changed products, and for all the products that depend on them
         #
-        if not productName:
-            return usesInfo
+        recompute = set([key for key in current.keys() if key[0] in changed])
+        recompute.update(index.findUsers(changed))
+        recompute = sorted(recompute)
 
-        return usesInfo.users(productName, versionName)
+        results = utils.forkMap(lambda key: self._productUses(current[key]), recompute,
+                                hooks.config.Eups.usesIndexJobs)
+        for key, (deps, requests) in zip(recompute, results):
+            index.set(key, deps, tableMtimes[key], current[key].db, requests)
+
+        modified = rebuild or recompute or changed or generations != index.generations
+        index.generations = generations
+        index.updated = now
+
+        if self.verbose > 1:
+            print >> utils.stdinfo, "Uses index: %d products, %d recomputed" % (len(index), len(recompute))
+
+        if hooks.config.Eups.usesIndex and modified:
+            for dbpath, dbroots, file in stacks:
+                if file:
+                    try:
+                        index.save(file, dbpath)
+                    except (IOError, OSError):
+                        pass            # e.g. the database isn't writable
+
+        return index
 
     def supportServerTags(self, tags, eupsPathDir=None):
         """
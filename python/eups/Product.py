@@ -5,6 +5,7 @@ import ConfigParser
 import table as mod_table
 import utils
 from exceptions import ProductNotFound, TableFileNotFound
+from TableRegistry import getTableRegistry
 
 macrore = { "PROD_ROOT": re.compile(r"^\$PROD_ROOT\b"),
             "PROD_DIR":  re.compile(r"^\$PROD_DIR\b"),
@@ -374,9 +375,14 @@ class Product(object):
             if not os.path.exists(tablepath):
                 raise TableFileNotFound(tablepath, self.name, self.version,
                                         self.flavor)
-            self._table = mod_table.Table(tablepath, self,
-                                          addDefaultProduct=addDefaultProduct, verbose=verbose,
-                                          ).expandEupsVariables(self, quiet)
+            # Another Product may already have read this table (see TableRegistry)
+            tableRegistry = getTableRegistry()
+            self._table = tableRegistry.lookup(self, tablepath, addDefaultProduct)
+            if not self._table:
+                self._table = mod_table.Table(tablepath, self,
+                                              addDefaultProduct=addDefaultProduct, verbose=verbose,
+                                              ).expandEupsVariables(self, quiet)
+                tableRegistry.register(self, tablepath, self._table, addDefaultProduct)
 
             if self._prodStack and self.name and self.version and self.flavor:
                 # pass the loaded table back to the cache
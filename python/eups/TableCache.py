@@ -0,0 +1,173 @@
+"""
+A persistent store of parsed table files
+"""
+import os, time, cPickle
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+from utils import mtimeResolution
+
+class TableCache(object):
+    """
+    A store of parsed table files, kept in a directory (typically under the
+    user data directory) so that table files need only be parsed again when
+    they change.  An entry is keyed on the table file's path, a "variant"
+    (anything else that the parsed form depends on, e.g. the name of the
+    product that owns the table) and the file's size and modification time.
+
+    The store doesn't know what a parsed table looks like; it simply saves
+    and returns the data that Table gives it.  The hits and misses of this
+    process are counted, and reported by stats().
+    """
+
+    # Bump this whenever the form of the data stored changes, i.e. whenever
+    # the table file parser (Table._read) changes what it produces
+    parserVersion = 1
+
+    _directory = None
+
+    def __init__(self, dir):
+        """
+        @param dir   the directory in which to keep the parsed tables
+        """
+        self.dir = dir
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    def _fileFor(self, tableFile, variant):
+        # the file holding the parsed form of a table file
+        name = md5("%s\0%s" % (tableFile, variant)).hexdigest()
+        return os.path.join(self.dir, name[0:2], name)
+
+    def lookup(self, tableFile, variant=None):
+        """
+        return the data stored for a table file, or None if there's none or
+        the file has changed since it was stored
+        @param tableFile   the table file
+        @param variant     the variant of the parsed form
+        """
+        tableFile = os.path.abspath(tableFile)
+        try:
+            st = os.stat(tableFile)
+            fd = open(self._fileFor(tableFile, variant))
+            try:
+                entry = cPickle.load(fd)
+            finally:
+                fd.close()
+        except (IOError, OSError, EOFError, ValueError, TypeError, AttributeError, ImportError,
+                cPickle.UnpicklingError):
+            self.misses += 1
+            return None
+
+        try:
+            version, path, var, size, mtime, parsed, data = entry
+        except (TypeError, ValueError):
+            version = None
+
+        if version != TableCache.parserVersion or path != tableFile or var != variant or \
+               size != st.st_size or mtime != st.st_mtime or mtime > parsed - mtimeResolution:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return data
+
+    def store(self, tableFile, data, variant=None, parsed=None):
+        """
+        save the parsed form of a table file.  Failures (e.g. if the store
+        isn't writable) are silently ignored.
+        @param tableFile   the table file
+        @param data        the parsed form, as returned by lookup()
+        @param variant     the variant of the parsed form
+        @param parsed      the time that the table file was parsed (default: now)
+        """
+        tableFile = os.path.abspath(tableFile)
+        if parsed is None:
+            parsed = time.time()
+
+        try:
+            st = os.stat(tableFile)
+            if st.st_mtime > parsed - mtimeResolution: # too recent to trust
+                return
+
+            file = self._fileFor(tableFile, variant)
+            if not os.path.isdir(os.path.dirname(file)):
+                os.makedirs(os.path.dirname(file))
+
+            tmpfile = "%s.%d" % (file, os.getpid())
+            fd = open(tmpfile, "w")
+            try:
+                cPickle.dump((TableCache.parserVersion, tableFile, variant,
+                              st.st_size, st.st_mtime, parsed, data), fd, protocol=2)
+            finally:
+                fd.close()
+            os.rename(tmpfile, file)
+        except (IOError, OSError, cPickle.PicklingError):
+            return
+
+        self.stores += 1
+
+    def clear(self):
+        """
+        remove all the parsed tables from the store
+        """
+        if not os.path.isdir(self.dir):
+            return
+
+        for dir, subdirs, files in os.walk(self.dir, False):
+            for f in files:
+                os.remove(os.path.join(dir, f))
+            for d in subdirs:
+                os.rmdir(os.path.join(dir, d))
+
+    def entries(self):
+        """
+        return the number of parsed tables in the store
+        """
+        n = 0
+        for dir, subdirs, files in os.walk(self.dir):
+            n += len(files)
+        return n
+
+    def stats(self):
+        """
+        return a dictionary describing how useful the store has been to this process
+        """
+        lookups = self.hits + self.misses
+        if lookups:
+            hitRate = float(self.hits)/lookups
+        else:
+            hitRate = 0.0
+        return {"hits" : self.hits, "misses" : self.misses, "stores" : self.stores, "hitRate" : hitRate}
+
+    def directory(dir=None):
+        """
+        Return the directory used to store parsed tables (None if they aren't
+        being stored).  With an argument, set the directory; "" disables the store
+        """
+        if dir is not None:
+            TableCache._directory = dir or None
+
+        return TableCache._directory
+
+    directory = staticmethod(directory)
+
+try:
+    _tableCaches
+except NameError:
+    _tableCaches = {}                   # the TableCaches in use, keyed by directory
+
+def getTableCache():
+    """
+    return the TableCache for the directory set with TableCache.directory(),
+    or None if parsed tables aren't being stored
+    """
+    dir = TableCache.directory()
+    if not dir:
+        return None
+
+    if not _tableCaches.has_key(dir):
+        _tableCaches[dir] = TableCache(dir)
+    return _tableCaches[dir]
@@ -0,0 +1,135 @@
+"""
+A process-wide registry of the tables read by Products
+"""
+import os
+import time
+import utils
+from utils import mtimeResolution
+
+class TableRegistry(object):
+    """
+    A bounded store of the Tables read (and expanded) by Product.getTable(),
+    shared by all the Products in a process; Products describing the same
+    version of a product are created over and over again (e.g. by
+    ProductFamily.getProduct() and Database.findProduct()), and without the
+    registry each would read its table file again.
+
+    A Table is keyed on the resolved path to its table file and on the
+    properties of the Product used to expand its eups variables (directory,
+    flavor, name, version and database).  A Table is only returned while
+    its table file's size and modification time are unchanged; the least
+    recently used Table is discarded when the registry is full.
+    """
+
+    def __init__(self, maxsize=500):
+        """
+        @param maxsize   the maximum number of Tables to keep; 0 disables the registry
+        """
+        self._tables = utils.LRUCache(maxsize)
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _key(self, product, tableFile, addDefaultProduct):
+        return (os.path.realpath(tableFile), product.dir, product.flavor,
+                product.name, product.version, product.db, addDefaultProduct)
+
+    def lookup(self, product, tableFile, addDefaultProduct=None):
+        """
+        return the Table registered for a product's table file, or None
+        @param product            the Product that owns the table
+        @param tableFile          the path to the table file
+        @param addDefaultProduct  as passed to Table()
+        """
+        if not self._tables.maxsize:
+            return None
+
+        key = self._key(product, tableFile, addDefaultProduct)
+        entry = self._tables.get(key)
+        if entry is None:
+            return None
+
+        table, size, mtime = entry
+        try:
+            st = os.stat(tableFile)
+        except OSError:
+            st = None
+        if st is None or st.st_size != size or st.st_mtime != mtime:
+            self._tables.remove(key)
+            self._tables.hits -= 1      # the look-up failed after all
+            self._tables.misses += 1
+            return None
+
+        return table
+
+    def register(self, product, tableFile, table, addDefaultProduct=None):
+        """
+        remember the Table read from a product's table file
+        @param product            the Product that owns the table
+        @param tableFile          the path to the table file
+        @param table              the Table, with its eups variables expanded for product
+        @param addDefaultProduct  as passed to Table()
+        """
+        if not self._tables.maxsize:
+            return
+
+        try:
+            st = os.stat(tableFile)
+        except OSError:
+            return
+        if st.st_mtime > time.time() - mtimeResolution: # too recent to trust
+            return
+
+        key = self._key(product, tableFile, addDefaultProduct)
+        if key not in self._tables and len(self._tables) >= self._tables.maxsize:
+            self.evictions += 1
+        self._tables.put(key, (table, st.st_size, st.st_mtime))
+
+    def invalidate(self, productName=None, tableFile=None):
+        """
+        forget the registered Tables for a product and/or table file (or all
+        of them, if neither is specified)
+        @param productName   the name of the product
+        @param tableFile     the path to a table file
+        """
+        if tableFile:
+            tableFile = os.path.realpath(tableFile)
+
+        for key in self._tables.keys():
+            if (productName is None or key[3] == productName) and \
+                   (tableFile is None or key[0] == tableFile):
+                self._tables.remove(key)
+                self.invalidations += 1
+
+    def resize(self, maxsize):
+        """
+        set the maximum number of Tables to keep, discarding the least
+        recently used if there are too many; 0 disables the registry
+        """
+        self._tables.maxsize = maxsize
+        keys = self._tables.keys()
+        for key in keys[0:max(len(keys) - maxsize, 0)]:
+            self._tables.remove(key)
+            self.evictions += 1
+
+    def __len__(self):
+        return len(self._tables)
+
+    def stats(self):
+        """
+        return a dictionary describing how useful the registry has been to this process
+        """
+        stats = self._tables.stats()
+        stats["evictions"] = self.evictions
+        stats["invalidations"] = self.invalidations
+        return stats
+
+try:
+    _tableRegistry
+except NameError:
+    _tableRegistry = TableRegistry()
+
+def getTableRegistry():
+    """
+    return the process-wide TableRegistry
+    """
+    return _tableRegistry
@@ -2,7 +2,6 @@
 the Uses class -- a class for tracking product dependencies (used by the remove() 
 function).  
 """
-import re
 
 #
 # Cache for the Uses tree
@@ -23,6 +22,7 @@ class Uses(object):
     def __init__(self):
         self._depends_on = {}           # info about products that depend on key
         self._setup_by = {}             # info about products that setup key, directly or indirectly
+        self._setup_keys = {}           # the keys of _setup_by for each product name
 
     def _getKey(self, p, v):
         return "%s:%s" % (p, v)
@@ -42,12 +42,14 @@ class Uses(object):
         """ Invert the dependencies to tell us who uses what, not who depends on what"""
 
         self._setup_by = {}
+        self._setup_keys = {}
         for k in self._depends_on.keys():
             productName, versionName = self._splitKey(k)
             for dname, dver, doptional, ddepth in self._depends_on[k]:
                 key = self._getKey(dname, dver)
                 if not self._setup_by.has_key(key):
                     self._setup_by[key] = []
+                    self._setup_keys.setdefault(dname, []).append(key)
 
                 self._setup_by[key].append((productName, versionName, Props(dver, doptional, ddepth)))
 
@@ -77,18 +79,13 @@ class Uses(object):
         """Return a list of the users of productName/productVersion; each element of the list is:
         (user, userVersion, (productVersion, optional)"""
         if versionName:
-            versionName = re.escape(versionName)
+            keys = [self._getKey(productName, versionName)]
         else:
-            versionName = r"[\w.+\-]+"
-            
-        versionName = r"(?P<version>%s)" % versionName
+            keys = self._setup_keys.get(productName, [])
 
-        pattern = re.compile(r"^%s$" % self._getKey(productName, versionName))
         consumerList = []
-        for k in self._setup_by.keys():
-            mat = pattern.match(k)
-            if mat:
-                consumerList += (self._setup_by[k])
+        for k in keys:
+            consumerList += self._setup_by.get(k, [])
         #
         # Be nice; sort list
         #
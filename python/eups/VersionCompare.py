@@ -1,9 +1,17 @@
 import re
+import utils
 
 class VersionCompare(object):
     """
     A comparison function class that compares two product versions.
+
+    Lists of versions should be sorted with sort() (or sortVersions()) rather
+    than by passing an instance to list.sort(); the versions are then each
+    parsed once (see sortKey()) rather than on every comparison.
     """
+
+    # the maximum number of parsed versions to remember (see sortKey())
+    keyCacheSize = 10000
     def compare(self, v1, v2, mustReturnInt=True):
         """Compare two versions.
 
@@ -137,9 +145,472 @@ If mustReturnInt is False and you don't want to allow the versions to be sorted,
 
         return vvv, eee, fff
 
+    def sortKey(self, version):
+        """
+        Return a key for version, such that sorting a list of versions using
+        these keys gives the same order as sorting using compare().  The keys
+        of the keyCacheSize most recently used versions are remembered.
+        """
+        if not self._usesStdCompare():
+            return CmpKey(self, version)
+
+        try:
+            keys = self._keys
+        except AttributeError:
+            keys = self._keys = utils.LRUCache(self.keyCacheSize)
+
+        key = keys.get(version)
+        if key is None:
+            key = VersionKey(version, self._splitVersion)
+            keys.put(version, key)
+
+        return key
+
+    def sort(self, versions, key=None):
+        """
+        Sort a list of versions in place, earliest first.
+        @param versions   the list to sort
+        @param key        if not None, a function that returns the version
+                            given an element of the list
+        """
+        if key:
+            versions.sort(key=lambda el: self.sortKey(key(el)))
+        else:
+            versions.sort(key=self.sortKey)
+
+    def _usesStdCompare(self):
+        # is this instance's ordering that of stdCompare() (so that we can use VersionKeys)?
+        cls = self.__class__
+        for name in ("compare", "stdCompare", "_splitVersion"):
+            if getattr(cls, name).im_func is not getattr(VersionCompare, name).im_func:
+                return False
+        return True
+
     def __call__(self, v1, v2, mustReturnInt=True):
         """
         make an instance behave like a callable function
         """
         return self.compare(v1, v2, mustReturnInt)
 
+
+class VersionKey(object):
+    """
+    A version, parsed once so that it can be compared with other versions
+    (as VersionCompare.stdCompare() would compare them) without re-parsing it.
+    """
+
+    def __init__(self, version, splitVersion):
+        """
+        @param version       the version
+        @param splitVersion  the function to use to split the version into its
+                               base release name and annotations (see
+                               VersionCompare._splitVersion())
+        """
+        self.version = version
+        self._splitVersion = splitVersion
+
+        self.prim, self.sec, self.ter = splitVersion(version)
+        self.components = [_Component(c) for c in re.split(r"[._]", self.prim)]
+
+        self._secKey = None             # the keys for sec and ter, created when needed
+        self._terKey = None
+
+    def secKey(self):
+        if self._secKey is None:
+            self._secKey = VersionKey(self.sec, self._splitVersion)
+        return self._secKey
+
+    def terKey(self):
+        if self._terKey is None:
+            self._terKey = VersionKey(self.ter, self._splitVersion)
+        return self._terKey
+
+    def compare(self, other, mustReturnInt=True):
+        """
+        Return the value that VersionCompare.stdCompare(self.version, other.version, mustReturnInt=mustReturnInt)
+        would (including raising ValueError if mustReturnInt is False and the versions cannot be sorted)
+        """
+        if self.prim == other.prim:
+            # the same primary release component 
+            if self.sec or other.sec or self.ter or other.ter:
+                if self.sec or other.sec:
+                    if self.sec and other.sec:
+                        ret = self.secKey().compare(other.secKey())
+                    else:
+                        if self.sec:
+                            return -1
+                        else:
+                            return 1
+
+                    if ret == 0:
+                        return self.terKey().compare(other.terKey())
+                    else:
+                        return ret
+
+                return self.terKey().compare(other.terKey())
+            else:
+                return 0
+
+        c1 = self.components; c2 = other.components
+        n1 = len(c1); n2 = len(c2)
+
+        n = min(n1, n2)
+        for i in range(n):
+            different = c1[i].compare(c2[i])
+            if different:
+                if mustReturnInt or c1[i].isNumeric(c2[i]):
+                    return different
+                else:
+                    if i == n - 1:
+                        if c2[i].value.startswith(c1[i].value):
+                            return -1
+                        elif c1[i].value.startswith(c2[i].value):
+                            return 1
+
+                    raise ValueError("Versions %s and %s cannot be sorted" % (self.version, other.version))
+
+        # So far, the two versions are identical.  The longer version should sort later
+        return cmp(n1, n2)
+
+    def __cmp__(self, other):
+        return self.compare(other)
+
+    def __lt__(self, other):
+        return self.compare(other) < 0
+
+    def __repr__(self):
+        return "VersionKey(%r)" % (self.version,)
+
+class _Component(object):
+    # one of the "."/"_" separated components of a version's base release name
+
+    def __init__(self, value):
+        self.value = value
+
+        try:
+            self.integer = int(value)
+        except ValueError:
+            self.integer = None
+
+        self.prefix = None              # a non-numeric prefix to a number, e.g. "rc" in "rc2"
+        mat = re.search(r"^([^\d]+)\d+$", value)
+        if mat:
+            self.prefix = mat.group(1)
+            self.number = int(value[len(self.prefix):])
+        self._prefixPattern = None
+
+    def compare(self, other):
+        # compare as integers, having stripped a common prefix, if possible; otherwise as strings
+        integers = self._integers(other)
+        if integers is not None:
+            return cmp(*integers)
+
+        return cmp(self.value, other.value)
+
+    def isNumeric(self, other):
+        # are self and other compared as integers?
+        return self._integers(other) is not None
+
+    def _integers(self, other):
+        # the integers that self and other are compared as, or None if they're compared as strings
+        if self.prefix is not None and self.prefixPattern().search(other.value):
+            try:
+                return self.number, int(other.value[len(self.prefix):])
+            except ValueError:
+                return None
+
+        if self.integer is not None and other.integer is not None:
+            return self.integer, other.integer
+
+        return None
+
+    def prefixPattern(self):
+        # (as in stdCompare, the prefix is used as a regular expression)
+        if self._prefixPattern is None:
+            self._prefixPattern = re.compile(r"^%s\d+$" % self.prefix)
+        return self._prefixPattern
+
+class CmpKey(object):
+    """
+    A key for sorting versions with an arbitrary comparison function
+    """
+
+    def __init__(self, versionCmp, version):
+        self.versionCmp = versionCmp
+        self.version = version
+
+    def __cmp__(self, other):
+        return self.versionCmp(self.version, other.version)
+
+    def __lt__(self, other):
+        return self.versionCmp(self.version, other.version) < 0
+
+def sortVersions(versions, versionCmp, key=None):
+    """
+    Sort a list of versions in place, earliest first, in the order defined
+    by versionCmp; this is VersionCompare.sort() if versionCmp is a
+    VersionCompare, but versionCmp may be any comparison function.
+    @param versions    the list to sort
+    @param versionCmp  the function used to compare two versions
+                         (e.g. hooks.version_cmp)
+    @param key         if not None, a function that returns the version
+                         given an element of the list
+    """
+    if isinstance(versionCmp, VersionCompare):
+        versionCmp.sort(versions, key)
+    elif key:
+        versions.sort(key=lambda el: CmpKey(versionCmp, key(el)))
+    else:
+        versions.sort(key=lambda v: CmpKey(versionCmp, v))
+
+class VersionExpr(object):
+    """
+    A logical expression of versions such as ">= 3.2 && < 4", parsed once so
+    that it can be matched against many versions.
+
+    Each relational term of the expression selects an interval of versions in
+    sort order, so the versions in a sorted list that satisfy the expression
+    can be found by bisecting the list (see select() and best()) rather than
+    by matching each version in turn.
+    """
+
+    # Permitted relational operators
+    relop_re = re.compile(r"<=?|>=?|==")
+
+    _relops = {
+        "<"  : lambda c: c <  0,
+        "<=" : lambda c: c <= 0,
+        "==" : lambda c: c == 0,
+        ">"  : lambda c: c >  0,
+        ">=" : lambda c: c >= 0,
+        }
+
+    def __init__(self, expr, versionCmp):
+        """
+        @param expr        the expression, e.g. ">= 3.2 && < 4"
+        @param versionCmp  the function used to compare two versions
+                             (e.g. hooks.version_cmp)
+        """
+        self.expr = expr
+        self.versionCmp = versionCmp
+        self._keyed = isinstance(versionCmp, VersionCompare) and versionCmp._usesStdCompare()
+        #
+        # The expression as a list of steps, each either (logop, relop, version) for a term that's
+        # combined with the value so far using logop ("and", "or" or None), or (None, None, None) for
+        # an "&&" that fails if the value so far is false
+        #
+        self._steps = []
+
+        tokens = filter(lambda x: not re.search(r"^\s*$", x),
+                        re.split(r"\s*(%s|\|\||\s)\s*" % self.relop_re.pattern, expr))
+        logop = None                    # the next logical operation to process
+        haveValue = False               # have we seen a term?
+        i = -1
+        while i < len(tokens) - 1:
+            i += 1
+
+            if self.relop_re.search(tokens[i]):
+                relop = tokens[i]; i += 1
+                if i == len(tokens):
+                    print >> utils.stdwarn, "Missing version after %s in \"%s\"" % (relop, expr)
+                    break
+                v = tokens[i]
+            elif re.search(r"^[-+.:/\w]+$", tokens[i]) and tokens[i] not in ("and", "or"):
+                relop = "=="
+                v = tokens[i]
+            elif tokens[i] == "||" or tokens[i] == "or":
+                logop = "or"
+                continue
+            elif tokens[i] == "&&" or tokens[i] == "and":
+                self._steps.append((None, None, None))
+                logop = "and"
+                continue
+            else:
+                print >> utils.stdwarn, "Unexpected operator %s in \"%s\"" % (tokens[i], expr)
+                break
+
+            if not logop and haveValue:
+                print >> utils.stdwarn, "Expected logical operator || or && in \"%s\" at %s" % (expr, v)
+            else:
+                self._steps.append((logop, relop, v))
+                haveValue = True
+
+    def match(self, version):
+        """
+        Return True if version satisfies the expression.  Raise ValueError if
+        version can't be compared with a version in the expression.
+        """
+        value = None
+        for logop, relop, v in self._steps:
+            if relop is None:
+                if not value:
+                    return False        # short circuit
+                continue
+
+            rhs = self._relops[relop](self._compare(version, v))
+            if not logop:
+                value = rhs
+            elif logop == "and":
+                value = value and rhs
+            else:
+                if value or rhs:
+                    return True
+                value = False
+
+        return bool(value)
+
+    def select(self, versions, key=None):
+        """
+        Return the elements of a list of versions, sorted earliest first (see
+        sortVersions()), that satisfy the expression, in the same order
+        @param versions   the sorted list
+        @param key        if not None, a function that returns the version
+                            given an element of the list
+        """
+        return [versions[i] for i in self._candidates(versions, key) if self._matches(versions[i], key)]
+
+    def best(self, versions, key=None):
+        """
+        Return the latest element of a list of versions, sorted earliest first
+        (see sortVersions()), that satisfies the expression, or None
+        @param versions   the sorted list
+        @param key        if not None, a function that returns the version
+                            given an element of the list
+        """
+        for start, stop in reversed(self._ranges(versions, key)):
+            for i in xrange(stop - 1, start - 1, -1):
+                if self._matches(versions[i], key):
+                    return versions[i]
+
+        return None
+
+    def _compare(self, v1, v2):
+        # compare two versions as versionCmp(v1, v2, mustReturnInt=False) would
+        if self._keyed:
+            return self.versionCmp.sortKey(v1).compare(self.versionCmp.sortKey(v2), mustReturnInt=False)
+        return self.versionCmp(v1, v2, mustReturnInt=False)
+
+    def _matches(self, el, key):
+        # does element el of a list of versions satisfy the expression?
+        if key:
+            el = key(el)
+        try:
+            return self.match(el)
+        except ValueError:              # no sort order is defined
+            return False
+
+    def _candidates(self, versions, key):
+        # the indices of the elements of a sorted list of versions that may satisfy the expression
+        for start, stop in self._ranges(versions, key):
+            for i in xrange(start, stop):
+                yield i
+
+    def _ranges(self, versions, key):
+        #
+        # Return the intervals (start, stop) of indices into a sorted list of versions that may satisfy
+        # the expression.  Versions that can't be compared with those in the expression fail to match
+        # in match(), but otherwise are ordered as they're sorted, so they're included to be checked
+        #
+        if not self._keyed:             # we can't assume that versionCmp orders versions consistently
+            return [(0, len(versions))]
+
+        n = len(versions)
+        undecided = [(0, n)]            # the versions whose match isn't yet known
+        value = []                      # the versions for which the expression's true so far
+        accepted = []                   # the versions known to match
+        for logop, relop, v in self._steps:
+            if relop is None:
+                undecided = value
+                continue
+
+            term = self._termRange(versions, key, relop, v)
+            if not logop:
+                value = _intersectRanges(term, undecided)
+            elif logop == "and":
+                value = _intersectRanges(value, term)
+            else:
+                decided = _intersectRanges(_unionRanges(value, term), undecided)
+                accepted = _unionRanges(accepted, decided)
+                undecided = _intersectRanges(undecided, _complementRanges(decided, n))
+                value = []
+
+        return _unionRanges(accepted, _intersectRanges(value, undecided))
+
+    def _termRange(self, versions, key, relop, v):
+        # the indices of the elements of a sorted list of versions that satisfy "relop v"
+        n = len(versions)
+        if relop in ("<", "==", ">="):
+            lo = self._bisect(versions, key, v, False)
+        if relop in ("<=", "==", ">"):
+            hi = self._bisect(versions, key, v, True)
+
+        if relop == "<":
+            ranges = [(0, lo)]
+        elif relop == "<=":
+            ranges = [(0, hi)]
+        elif relop == "==":
+            ranges = [(lo, hi)]
+        elif relop == ">":
+            ranges = [(hi, n)]
+        else:
+            ranges = [(lo, n)]
+
+        return [r for r in ranges if r[0] < r[1]]
+
+    def _bisect(self, versions, key, v, right):
+        # the index at which to insert v into a sorted list of versions, after any equal versions if right
+        target = self.versionCmp.sortKey(v)
+        lo, hi = 0, len(versions)
+        while lo < hi:
+            mid = (lo + hi)//2
+            el = versions[mid]
+            if key:
+                el = key(el)
+            c = self.versionCmp.sortKey(el).compare(target)
+            if c < 0 or (right and c == 0):
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return lo
+
+def _intersectRanges(a, b):
+    # the intersection of two sorted lists of disjoint intervals (start, stop)
+    out = []
+    i = j = 0
+    while i < len(a) and j < len(b):
+        start = max(a[i][0], b[j][0])
+        stop = min(a[i][1], b[j][1])
+        if start < stop:
+            out.append((start, stop))
+        if a[i][1] < b[j][1]:
+            i += 1
+        else:
+            j += 1
+
+    return out
+
+def _unionRanges(a, b):
+    # the union of two sorted lists of disjoint intervals (start, stop)
+    out = []
+    for start, stop in sorted(a + b):
+        if out and start <= out[-1][1]:
+            if stop > out[-1][1]:
+                out[-1] = (out[-1][0], stop)
+        else:
+            out.append((start, stop))
+
+    return out
+
+def _complementRanges(a, n):
+    # the intervals of [0, n) that aren't in a sorted list of disjoint intervals (start, stop)
+    out = []
+    prev = 0
+    for start, stop in a:
+        if prev < start:
+            out.append((prev, start))
+        prev = stop
+    if prev < n:
+        out.append((prev, n))
+
+    return out
@@ -1,6 +1,58 @@
 """A simple recursive descent parser for logical expressions"""
 
 import os, re
+import utils
+
+_envVarRe = re.compile(r"^\${([^:}]*)(:-([^\}*]*))?}")
+
+class CompiledExpression(object):
+    """A logical expression, tokenized once so that it can be evaluated many times
+    (with different symbol definitions) by VersionParser.  Use compileExpression() to create one"""
+
+    def __init__(self, exprStr):
+        self.exprStr = exprStr
+
+        exprStr = re.sub(r"['\"]([^'\"]+)['\"]", r"\1", exprStr)
+        tokens = re.split(r"(\$\??{[^}]+}|[\w.+]+|\s+|==|!=|<=|>=|[()<>])", exprStr)
+        self.tokens = tuple(filter(lambda p: p and not re.search(r"^\s*$", p), tokens))
+        #
+        # The environment variables that the expression refers to; its value may change if they do
+        #
+        self.envVars = []
+        for tok in self.tokens:
+            mat = _envVarRe.search(tok)
+            if mat and mat.group(1) not in self.envVars:
+                self.envVars.append(mat.group(1))
+
+    def eval(self, symbols={}):
+        """Evaluate the expression, returning a Bool
+        @param symbols   a dictionary of the names to define (see VersionParser.define())"""
+        parser = VersionParser(self)
+        for key, value in symbols.items():
+            parser.define(key, value)
+
+        return parser.eval()
+
+    def __str__(self):
+        return self.exprStr
+
+try:
+    _compiled
+except NameError:
+    _compiled = utils.LRUCache(1000)    # the CompiledExpressions created by compileExpression()
+
+def compileExpression(exprStr):
+    """Return a CompiledExpression for a logical expression (which may already be one),
+    reusing an earlier compilation of the same expression if possible"""
+    if isinstance(exprStr, CompiledExpression):
+        return exprStr
+
+    expr = _compiled.get(exprStr)
+    if expr is None:
+        expr = CompiledExpression(exprStr)
+        _compiled.put(exprStr, expr)
+
+    return expr
 
 class VersionParser(object):
     """Evaluate a logical expression, returning a Bool.  The grammar is:
@@ -26,9 +78,10 @@ class VersionParser(object):
 names are declared using VersionParser.define()
         """
     def __init__(self, exprStr):
-        exprStr = re.sub(r"['\"]([^'\"]+)['\"]", r"\1", exprStr)
-        self._tokens = re.split(r"(\$\??{[^}]+}|[\w.+]+|\s+|==|!=|<=|>=|[()<>])", exprStr)
-        self._tokens = filter(lambda p: p and not re.search(r"^\s*$", p), self._tokens)
+        """
+        @param exprStr   the expression, as a string or a CompiledExpression
+        """
+        self._tokens = list(compileExpression(exprStr).tokens)
         
         self._symbols = {}
         self._caseSensitive = False
@@ -43,7 +96,7 @@ names are declared using VersionParser.define()
         key0 = key
         
         try:
-            envVar, modifier, value = re.search(r"^\${([^:}]*)(:-([^\}*]*))?}", key).groups()
+            envVar, modifier, value = _envVarRe.search(key).groups()
 
             if not value or value == "false":
                 value = False
@@ -9,6 +9,7 @@ from exceptions     import ProductNotFound
 from tags           import Tags, Tag, TagNotRecognized, checkTagsList
 import Product
 from VersionParser  import VersionParser
+from VersionCompare import sortVersions
 from stack          import ProductStack, persistVersionName as cacheVersion
 from distrib.server import ServerConf
 import utils, table, distrib.builder, hooks
@@ -146,9 +147,9 @@ def printProducts(ostrm, productName=None, versionName=None, eupsenv=None,
                 fmt = "%-40s %s"
             print fmt % (product.name, product.version)
 
-        for product, optional, recursionDepth in eupsenv.getDependentProducts(product, setup,
-                                                                              topological=topological,
-                                                                              checkCycles=checkCycles):
+        graph = eupsenv.getDependencyGraph(product, setup, topological=(topological or checkCycles))
+        for product, optional, recursionDepth in graph.getDependentProducts(topological, checkCycles,
+                                                                            verbose=eupsenv.verbose):
             if not includeProduct(recursionDepth) or (checkCycles and not topological):
                 continue
 
@@ -572,8 +573,8 @@ def clearCache(path=None, flavors=None, inUserDir=False, verbose=0):
         if not flavs:
             continue
 
-        ProductStack.fromCache(dbpath, flavs, persistDir=persistDir,
-                               autosave=False).clearCache(verbose=verbose)
+        ProductStack.fromCache(dbpath, flavs, persistDir=persistDir, autosave=False,
+                               indexBackend=hooks.config.Eups.cacheBackend).clearCache(verbose=verbose)
 
 def listCache(path=None, verbose=0, flavor=None):
     if path is None:
@@ -591,7 +592,7 @@ def listCache(path=None, verbose=0, flavor=None):
     for p in path:
         dbpath = os.path.join(p, Eups.ups_db)
         cache = ProductStack.fromCache(dbpath, flavor, updateCache=False, 
-                                       autosave=False)
+                                       autosave=False, indexBackend=hooks.config.Eups.cacheBackend)
 
         productNames = cache.getProductNames()
         productNames.sort()
@@ -608,10 +609,66 @@ def listCache(path=None, verbose=0, flavor=None):
 
         for productName in productNames:
             versionNames = cache.getVersions(productName)
-            versionNames.sort(hooks.version_cmp)
+            sortVersions(versionNames, hooks.version_cmp)
 
             print "  %-20s %s" % (productName, " ".join(versionNames))
 
+def checkCache(path=None, flavors=None, verbose=0):
+    """
+    check that the product caches are up to date by comparing them with the 
+    modification time of every file in their databases.  This is the 
+    thorough check that is normally avoided by comparing the generation 
+    count of the database recorded in the cache with its current value;
+    it catches databases that were modified without updating their 
+    generation count (e.g. by an older version of EUPS).  Returned is the 
+    number of out-of-date caches.
+
+    @param path     the stacks to check caches for.  This can be given either
+                        as a python list or a colon-delimited string.  If 
+                        None (default), EUPS_PATH will be used.
+    @param flavors  the flavors to check.  This can either be a python list 
+                        or space-delimited string.  If None, check caches for
+                        all flavors.
+    @params verbose   chattiness
+    """
+    if path is None:
+        path = os.environ["EUPS_PATH"]
+    if isinstance(path, str):
+        path = path.split(":")
+
+    if isinstance(flavors, str):
+        flavors = flavors.split()
+
+    nstale = 0
+    for p in path:
+        dbpath = os.path.join(p, Eups.ups_db)
+        if not os.path.isdir(dbpath):
+            continue
+        stack = ProductStack(dbpath, autosave=False, indexBackend=hooks.config.Eups.cacheBackend)
+
+        for cacheDir in [dbpath, utils.userStackCacheFor(p)]:
+            if not cacheDir or not os.path.isdir(cacheDir):
+                continue
+
+            flavs = flavors
+            if flavs is None:
+                flavs = ProductStack.findCachedFlavors(cacheDir)
+
+            for flavor in flavs:
+                if stack.cacheIsUpToDate(flavor, cacheDir, fullCheck=True):
+                    state = "ok"
+                else:
+                    nstale += 1
+                    if stack.cacheIsUpToDate(flavor, cacheDir):
+                        state = "out of date (not detected by generation count)"
+                    else:
+                        state = "out of date"
+
+                if verbose or state != "ok":
+                    print "%-40s %-10s %s" % (cacheDir, flavor, state)
+
+    return nstale
+
 def Current():
     """
     a deprecated means of specifying a preferred tag.  This will return
@@ -666,6 +723,63 @@ def setup(productName, version=None, prefTags=None, productRoot=None,
         if version:
             eupsenv.selectVRO(versionName=version)
 
+    prefTags, postTags = _checkSetupTags(eupsenv, prefTags, postTags)
+
+    if _setupProduct(eupsenv, productName, version, prefTags, postTags, productRoot, fwd, tablefile):
+        return _setupCommands(eupsenv, [productName], fwd)
+    else:
+        return ["false"]                # as in /bin/false
+
+def setupProducts(products, prefTags=None, eupsenv=None, fwd=True, exact_version=False, postTags=[]):
+    """
+    Return a set of shell commands which, when sourced, will setup several
+    products in turn.  (If fwd is false, unset them up.)  All the products
+    are set up by the same Eups instance, so dependencies that they share
+    are only looked up once, and the commands describe the combined change
+    to the environment.  If a product can't be setup, the ones after it are
+    skipped and the commands end with "false" (as if "setup A && setup B"
+    had failed while setting up B).
+
+    @param products        a list of (productName, version) pairs, where
+                             version may be None (see setup())
+    @param prefTags        the list of requested tags (n.b. the VRO already knows about them)
+    @param eupsenv         the Eups instance to use to do the setup.  If 
+                             None, one will be created for it.
+    @param fwd             If False, actually do an unsetup.
+    @param postTags        the list of requested post-tags (n.b. the VRO already knows about them)
+    """
+    if not eupsenv:
+        eupsenv = Eups(readCache=False, exact_version=exact_version)
+        for productName, version in products:
+            if version:
+                eupsenv.selectVRO(versionName=version)
+                break
+
+    prefTags, postTags = _checkSetupTags(eupsenv, prefTags, postTags)
+
+    productNames = []                   # the products that we've setup
+    ok = True
+    for productName, version in products:
+        environ = os.environ.copy()     # so that we can forget a partial setup
+        aliases, oldAliases = eupsenv.aliases.copy(), eupsenv.oldAliases.copy()
+
+        ok = _setupProduct(eupsenv, productName, version, prefTags, postTags, None, fwd, None)
+        if not ok:
+            os.environ.clear()
+            os.environ.update(environ)
+            eupsenv.aliases, eupsenv.oldAliases = aliases, oldAliases
+            break
+
+        productNames.append(productName)
+
+    cmds = _setupCommands(eupsenv, productNames, fwd)
+    if not ok:
+        cmds += ["false"]               # as in /bin/false
+
+    return cmds
+
+def _checkSetupTags(eupsenv, prefTags, postTags):
+    # return prefTags and postTags as lists, having checked that the tags are valid
     if isinstance(prefTags, str):
         prefTags = prefTags.split()
     elif isinstance(prefTags, Tag):
@@ -681,11 +795,14 @@ def setup(productName, version=None, prefTags=None, productRoot=None,
     if postTags:
         checkTagsList(eupsenv, postTags)
 
+    return prefTags, postTags
+
+def _setupProduct(eupsenv, productName, version, prefTags, postTags, productRoot, fwd, tablefile):
+    # (un)setup a product, updating os.environ and eupsenv.aliases, and return True if it succeeded
     versionRequested = version
     ok, version, reason = eupsenv.setup(productName, version, fwd,
                                         productRoot=productRoot, tablefile=tablefile)
         
-    cmds = []
     if ok:
         #
         # Check that we got the desired tag
@@ -719,109 +836,11 @@ def setup(productName, version=None, prefTags=None, productRoot=None,
 
                         print >> utils.stdwarn, "No versions of %s are tagged%s %s; setup version is %s" % \
                               (productName, extra, ",".join(prefTags + postTags), version)
-
-        #
-        # Set new variables
-        #
-        for key, val in os.environ.items():
-            try:
-                if val == eupsenv.oldEnviron[key]:
-                    continue
-            except KeyError:
-                pass
-
-            if val and not re.search(r"^['\"].*['\"]$", val) and \
-                   re.search(r"[\s<>|&;()]", val):   # quote characters that the shell cares about
-                val = "'%s'" % val
-
-            if eupsenv.shell in ("sh", "zsh",):
-                cmd = "export %s=%s" % (key, val)
-            elif eupsenv.shell in ("csh",):
-                cmd = "setenv %s %s" % (key, val)
-
-            if eupsenv.noaction:
-                if eupsenv.verbose < 2 and re.search(utils.setupEnvPrefix(), key):
-                    continue            # these variables are an implementation detail
-
-                cmd = "echo \"%s\"" % cmd
-
-            cmds += [cmd]
-        #
-        # Extra environment variables that EUPS uses
-        #
-        if not fwd and productName == "eups":
-            for k in ("EUPS_PATH", "EUPS_PKGROOT", "EUPS_SHELL",):
-                if k in os.environ:
-                    del os.environ[k]
-        #
-        # unset ones that have disappeared
-        #
-        for key in eupsenv.oldEnviron.keys():
-            if productName != "eups":   # the world will break if we delete these
-                if re.search(r"^EUPS_(DIR|PATH|PKGROOT|SHELL)$", key):
-                    continue
-
-            if os.environ.has_key(key):
-                continue
-
-            if eupsenv.shell == "sh" or eupsenv.shell == "zsh":
-                cmd = "unset %s" % (key)
-            elif eupsenv.shell == "csh":
-                cmd = "unsetenv %s" % (key)
-
-            if eupsenv.noaction:
-                if eupsenv.verbose < 2 and re.search(utils.setupEnvPrefix(), key):
-                    continue            # an implementation detail
-
-                cmd = "echo \"%s\"" % cmd
-
-            cmds += [cmd]
-        #
-        # Now handle aliases
-        #
-        for key in eupsenv.aliases.keys():
-            value = eupsenv.aliases[key]
-
-            try:
-                if value == eupsenv.oldAliases[key]:
-                    continue
-            except KeyError:
-                pass
-
-            if eupsenv.shell == "sh":
-                cmd = "function %s { %s ; }; export -f %s" % (key, value, key)
-            elif eupsenv.shell == "csh":
-                value = re.sub(r'"?\$@"?', r"\!*", value)
-                cmd = "alias %s \'%s\'" % (key, value)
-            elif eupsenv.shell == "zsh":
-                cmd = "%s() { %s ; }" % (key, value, key)
-
-            if eupsenv.noaction:
-                cmd = "echo \"%s\"" % re.sub(r"`", r"\`", cmd)
-
-            cmds += [cmd]
-        #
-        # and unset ones that used to be present, but are now gone
-        #
-        for key in eupsenv.oldAliases.keys():
-            if eupsenv.aliases.has_key(key):
-                continue
-
-            if eupsenv.shell == "sh" or eupsenv.shell == "zsh":
-                cmd = "unset %s" % (key)
-            elif eupsenv.shell == "csh":
-                cmd = "unalias %s" (key)
-
-            if eupsenv.noaction:
-                cmd = "echo \"%s\"" % cmd
-
-            cmds += [cmd]
     elif fwd and version is None:
         print >> utils.stderr, \
             "Unable to find an acceptable version of", productName
         if eupsenv.verbose and os.path.exists(productName):
             print >> utils.stderr, "(Did you mean setup -r %s?)" % productName
-        cmds += ["false"]               # as in /bin/false
     else:
         if fwd:
             versionName = version
@@ -836,7 +855,108 @@ def setup(productName, version=None, prefTags=None, productRoot=None,
         else:
             print >> utils.stderr, "Failed to unsetup %s: %s" % (productName, reason)
 
-        cmds += ["false"]               # as in /bin/false
+    return ok
+
+def _setupCommands(eupsenv, productNames, fwd):
+    # return the shell commands that change the environment we started with (eupsenv.oldEnviron and
+    # eupsenv.oldAliases) to the current one, given the names of the products that were (un)setup
+    cmds = []
+    #
+    # Set new variables
+    #
+    for key, val in os.environ.items():
+        try:
+            if val == eupsenv.oldEnviron[key]:
+                continue
+        except KeyError:
+            pass
+
+        if val and not re.search(r"^['\"].*['\"]$", val) and \
+               re.search(r"[\s<>|&;()]", val):   # quote characters that the shell cares about
+            val = "'%s'" % val
+
+        if eupsenv.shell in ("sh", "zsh",):
+            cmd = "export %s=%s" % (key, val)
+        elif eupsenv.shell in ("csh",):
+            cmd = "setenv %s %s" % (key, val)
+
+        if eupsenv.noaction:
+            if eupsenv.verbose < 2 and re.search(utils.setupEnvPrefix(), key):
+                continue            # these variables are an implementation detail
+
+            cmd = "echo \"%s\"" % cmd
+
+        cmds += [cmd]
+    #
+    # Extra environment variables that EUPS uses
+    #
+    if not fwd and "eups" in productNames:
+        for k in ("EUPS_PATH", "EUPS_PKGROOT", "EUPS_SHELL",):
+            if k in os.environ:
+                del os.environ[k]
+    #
+    # unset ones that have disappeared
+    #
+    for key in eupsenv.oldEnviron.keys():
+        if "eups" not in productNames: # the world will break if we delete these
+            if re.search(r"^EUPS_(DIR|PATH|PKGROOT|SHELL)$", key):
+                continue
+
+        if os.environ.has_key(key):
+            continue
+
+        if eupsenv.shell == "sh" or eupsenv.shell == "zsh":
+            cmd = "unset %s" % (key)
+        elif eupsenv.shell == "csh":
+            cmd = "unsetenv %s" % (key)
+
+        if eupsenv.noaction:
+            if eupsenv.verbose < 2 and re.search(utils.setupEnvPrefix(), key):
+                continue            # an implementation detail
+
+            cmd = "echo \"%s\"" % cmd
+
+        cmds += [cmd]
+    #
+    # Now handle aliases
+    #
+    for key in eupsenv.aliases.keys():
+        value = eupsenv.aliases[key]
+
+        try:
+            if value == eupsenv.oldAliases[key]:
+                continue
+        except KeyError:
+            pass
+
+        if eupsenv.shell == "sh":
+            cmd = "function %s { %s ; }; export -f %s" % (key, value, key)
+        elif eupsenv.shell == "csh":
+            value = re.sub(r'"?\$@"?', r"\!*", value)
+            cmd = "alias %s \'%s\'" % (key, value)
+        elif eupsenv.shell == "zsh":
+            cmd = "%s() { %s ; }" % (key, value, key)
+
+        if eupsenv.noaction:
+            cmd = "echo \"%s\"" % re.sub(r"`", r"\`", cmd)
+
+        cmds += [cmd]
+    #
+    # and unset ones that used to be present, but are now gone
+    #
+    for key in eupsenv.oldAliases.keys():
+        if eupsenv.aliases.has_key(key):
+            continue
+
+        if eupsenv.shell == "sh" or eupsenv.shell == "zsh":
+            cmd = "unset %s" % (key)
+        elif eupsenv.shell == "csh":
+            cmd = "unalias %s" (key)
+
+        if eupsenv.noaction:
+            cmd = "echo \"%s\"" % cmd
+
+        cmds += [cmd]
 
     return cmds
 
@@ -31,7 +31,7 @@ The output of run() is a status code appropriate for passing to sys.exit().
 #
 ########################################################################
 
-import glob, re, os, shutil, sys, time, copy
+import glob, re, os, shutil, sys, time, copy, errno
 import optparse
 import eups, lock
 import tags
@@ -39,6 +39,8 @@ import utils
 import distrib
 import hooks
 from distrib.server import ServerConf, Mapping, importClass
+from db import Database
+from TableCache import getTableCache
 
 _errstrm = utils.stderr
 
@@ -66,6 +68,7 @@ class EupsCmd(object):
 
 Supported commands are:
 	admin		Administer the eups system
+	daemon		Start or stop the resident setup process, eupsd
 	declare		Declare a product
 	distrib		Install a product from a remote distribution,
 			or create such a distribution 
@@ -79,6 +82,7 @@ Supported commands are:
         pkgroot [n]     Print the current eups pkgroot, or an element thereof
 	pkg-config	Return the options associated with product
 	remove          Remove an eups product from the system
+	run		Run a command with products setup
         startup         List files used (or potentially used) to configure eups
         tags            List information about supported and known tags
 	undeclare	Undeclare a product
@@ -161,7 +165,7 @@ Common"""
 
         locks = lock.takeLocks(ecmd.cmd, eups.Eups.setEupsPath(ecmd.opts.path, ecmd.opts.dbz),
                                ecmd.lockType, nolocks=ecmd.opts.nolocks,
-                               verbose=ecmd.opts.verbose - ecmd.opts.quiet)
+                               verbose=ecmd.opts.verbose - ecmd.opts.quiet, products=ecmd.lockedProducts())
 
         try:
             return ecmd.run()
@@ -246,6 +250,14 @@ Common"""
     def _issubclass(self):
         return isinstance(self, EupsCmd) and type(self) != EupsCmd
 
+    def lockedProducts(self):
+        """
+        return the names of the products that this command modifies if it
+        modifies no others (so that only they need be locked exclusively; 
+        see lock.takeLocks()), otherwise None
+        """
+        return None
+
     def err(self, msg, volume=0):
         """
         print an error message to standard error.  The message will only 
@@ -1158,6 +1170,10 @@ only wish to assign a tag, you should use the -t option but not include
 -r.  
 """
 
+    def lockedProducts(self):
+        # if no product is named, it's guessed from the product's directory after the locks are taken
+        return self.args[:1] or None
+
     def addOptions(self):
         # these are specific to this command
         self.clo.add_option("-r", "--root", dest="productDir", action="store", 
@@ -1347,6 +1363,9 @@ undeclaring a product, a version must be specified unless there is only one
 version currently declared.  
 """
 
+    def lockedProducts(self):
+        return self.args[:1] or None
+
     def addOptions(self):
         # these are specific to this command
         self.clo.add_option("-t", "--tag", dest="tag", action="store", 
@@ -1499,7 +1518,7 @@ where it is installed.
 
 class AdminCmd(EupsCmd):
 
-    usage = "%prog admin [buildCache|clearCache|listCache|clearLocks|listLocks|clearServerCache|info|show] [-h|--help] [-r root]"
+    usage = "%prog admin [buildCache|checkCache|clearCache|listCache|tableCache|clearLocks|listLocks|lockstats|clearServerCache|info|show] [-h|--help] [-r root]"
 
     # set this to True if the description is preformatted.  If false, it 
     # will be automatically reformatted to fit the screen
@@ -1537,10 +1556,14 @@ that are writable by the user.
             self.err("Unrecognized admin subcommand: %s" % subcmd)
             return 10
 
-        lock.takeLocks(ecmd.cmd, eups.Eups.setEupsPath(ecmd.opts.path, ecmd.opts.dbz),
-                       ecmd.lockType, nolocks=ecmd.opts.nolocks, verbose=ecmd.opts.verbose - ecmd.opts.quiet)
+        locks = lock.takeLocks(ecmd.cmd, eups.Eups.setEupsPath(ecmd.opts.path, ecmd.opts.dbz),
+                               ecmd.lockType, nolocks=ecmd.opts.nolocks,
+                               verbose=ecmd.opts.verbose - ecmd.opts.quiet)
 
-        return ecmd.run()
+        try:
+            return ecmd.run()
+        finally:
+            lock.giveLocks(locks, ecmd.opts.verbose)
 
         return 0
 
@@ -1561,6 +1584,8 @@ class AdminBuildCacheCmd(EupsCmd):
 
         self.clo.add_option("-A", "--admin-mode", dest="asAdmin", action="store_true", default=False, 
                             help="apply cache operations to caches under EUPS_PATH")
+        self.clo.add_option("--threads", dest="threads", action="store", type="int", default=None,
+                            help="the number of threads to read the databases with (default: hooks.config.Eups.crawlThreads)")
 
     def execute(self):
         self.args.pop(0)                # remove the "admin"
@@ -1569,8 +1594,48 @@ class AdminBuildCacheCmd(EupsCmd):
             self.err("Unexpected arguments: %s" % " ".join(self.args))
             return 1
 
+        if self.opts.threads is not None:
+            if self.opts.threads < 1:
+                self.err("--threads must be at least 1: %d" % self.opts.threads)
+                return 2
+            hooks.config.Eups.crawlThreads = self.opts.threads
+
         eups.clearCache(inUserDir=not self.opts.asAdmin, verbose=self.opts.verbose)
-        eups.Eups(readCache=True, asAdmin=self.opts.asAdmin)
+        myeups = eups.Eups(readCache=True, asAdmin=self.opts.asAdmin)
+
+        if self.opts.asAdmin:
+            # start recording the generation count of the databases so that the caches can be cheaply checked
+            for path in myeups.path:
+                if utils.isDbWritable(path):
+                    Database(myeups.getUpsDB(path)).initGeneration()
+
+        return 0
+
+class AdminCheckCacheCmd(EupsCmd):
+
+    usage = "%prog admin checkCache [-h|--help] [options]"
+
+    # set this to True if the description is preformatted.  If false, it 
+    # will be automatically reformatted to fit the screen
+    noDescriptionFormatting = False
+
+    description = \
+"""Check that all cache files are up to date by examining every file in the databases (rather than 
+trusting the databases' generation counts).  Out-of-date caches are listed (all caches with -v)"""
+
+    def addOptions(self):
+        # always call the super-version so that the core options are set
+        EupsCmd.addOptions(self)
+
+    def execute(self):
+        self.args.pop(0)                # remove the "admin"
+
+        if len(self.args) > 0:
+            self.err("Unexpected arguments: %s" % " ".join(self.args))
+            return 1
+
+        if eups.checkCache(verbose=self.opts.verbose):
+            return 1
 
         return 0
 
@@ -1658,6 +1723,39 @@ class AdminListLocksCmd(EupsCmd):
 
         return 0
 
+class AdminLockStatsCmd(EupsCmd):
+
+    usage = "%prog admin lockstats [-h|--help] [options]"
+
+    # set this to True if the description is preformatted.  If false, it 
+    # will be automatically reformatted to fit the screen
+    noDescriptionFormatting = False
+
+    description = \
+"""Summarize how long eups commands have waited for, and held, locks: the percentiles of the wait
+and hold times of shared and exclusive locks, and the commands that held locks for longest.  The
+number of uses of each lock that is remembered is set by hooks.config.site.lockStatsSize (by default
+none are)
+"""
+    def addOptions(self):
+        # always call the super-version so that the core options are set
+        EupsCmd.addOptions(self)
+
+        self.clo.add_option("--top", dest="top", action="store", type="int", default=10,
+                            help="List this many of the commands that held locks for longest")
+
+    def execute(self):
+        self.args.pop(0)                # remove the "admin"
+
+        if len(self.args) > 0:
+            self.err("Unexpected arguments: %s" % " ".join(self.args))
+            return 2
+
+        lock.listLockStats(self.createEups(self.opts, readCache=False).path,
+                           self.opts.top, self.opts.verbose)
+
+        return 0
+
 class AdminClearServerCacheCmd(EupsCmd):
 
     usage = "%prog admin clearServerCache [-h|--help] [options]"
@@ -1857,6 +1955,66 @@ class AdminListCacheCmd(EupsCmd):
 
         return 0
 
+class AdminTableCacheCmd(EupsCmd):
+
+    usage = "%prog admin tableCache [-h|--help] [options] [product ...]"
+
+    # set this to True if the description is preformatted.  If false, it 
+    # will be automatically reformatted to fit the screen
+    noDescriptionFormatting = False
+
+    description = \
+"""Report on the saved parsed table files (see hooks.config.Eups.tableCache).  If products are specified,
+read the table files of all their declared versions and report how many were found already parsed.
+"""
+
+    def addOptions(self):
+        # always call the super-version so that the core options are set
+        EupsCmd.addOptions(self)
+
+        # these options are used to configure the Eups instance
+        self.addEupsOptions()
+
+        self.clo.add_option("--clear", dest="clear", action="store_true", default=False,
+                            help="Remove all the saved parsed table files")
+
+    def execute(self):
+        self.args.pop(0)                # remove the "admin"
+
+        myeups = self.createEups(self.opts)
+
+        tableCache = getTableCache()
+        if not tableCache:
+            self.err("Parsed table files are not being saved")
+            return 1
+
+        if self.opts.clear:
+            tableCache.clear()
+            return 0
+
+        for productName in self.args:
+            products = myeups.findProducts(productName)
+            if not products:
+                self.err("Unable to find product %s" % productName)
+                continue
+
+            for product in products:
+                tablefile = product.tableFileName()
+                if not tablefile or not os.path.exists(tablefile):
+                    continue
+                try:
+                    eups.table.Table(tablefile, product)
+                except eups.TableError, e:
+                    self.err(e)
+
+        print "%s: %d parsed table files" % (tableCache.dir, tableCache.entries())
+        if self.args:
+            stats = tableCache.stats()
+            print "found %d, parsed %d (%.0f%% found), saved %d" % \
+                (stats["hits"], stats["misses"], 100*stats["hitRate"], stats["stores"])
+
+        return 0
+
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 
 class DistribCmd(EupsCmd):
@@ -1915,10 +2073,14 @@ Common """
             self.err("Unrecognized distrib subcommand: %s" % subcmd)
             return 10
 
-        lock.takeLocks(ecmd.cmd, eups.Eups.setEupsPath(ecmd.opts.path, ecmd.opts.dbz),
-                       ecmd.lockType, nolocks=ecmd.opts.nolocks, verbose=ecmd.opts.verbose - ecmd.opts.quiet)
+        locks = lock.takeLocks(ecmd.cmd, eups.Eups.setEupsPath(ecmd.opts.path, ecmd.opts.dbz),
+                               ecmd.lockType, nolocks=ecmd.opts.nolocks,
+                               verbose=ecmd.opts.verbose - ecmd.opts.quiet)
 
-        return ecmd.run()
+        try:
+            return ecmd.run()
+        finally:
+            lock.giveLocks(locks, ecmd.opts.verbose)
 
 class DistribDeclareCmd(EupsCmd):
 
@@ -2588,9 +2750,10 @@ class DistribCreateCmd(EupsCmd):
             return 4
 
 
-        def isDependent(product, searchList):
-            """Return whether a product is dependent upon one of the packages named in the searchList"""
-            dependencies = [q[0].name for q in myeups.getDependentProducts(product)]
+        def isDependent(product, searchList, graph):
+            """Return whether a product is dependent upon one of the packages named in the searchList,
+            according to a DependencyGraph that includes product"""
+            dependencies = [q.name for q in graph.closure(product)]
             for name in searchList:
                 if name in dependencies:
                     return True
@@ -2644,13 +2807,15 @@ class DistribCreateCmd(EupsCmd):
                         outVersion=self.incrBuildVersion(myeups, productName, version))
             
             foundRebuilds = set()
-            for p, optional, recursionDepth in myeups.getDependentProducts(topProduct, topological=True):
+            graph = myeups.getDependencyGraph(topProduct, topological=True)
+            for p, optional, recursionDepth in graph.getDependentProducts(topological=True,
+                                                                          verbose=myeups.verbose):
                 if p.name in rebuildProducts:
                     mapping.add(inProduct=p.name, inVersion=p.version, outVersion=rebuildProducts[p.name])
                     foundRebuilds.add(p.name)
                     continue
 
-                if not isDependent(p, rebuildProducts.keys()):
+                if not isDependent(p, rebuildProducts.keys(), graph):
                     continue
 
                 # If the product has a config file that claims that it has no binary components (and thus
@@ -2801,6 +2966,200 @@ class TagsCmd(EupsCmd):
 
         return 0
 
+class DaemonCmd(EupsCmd):
+
+    usage = "%prog daemon [-h|--help] [options] [start|stop|status]"
+
+    # set this to True if the description is preformatted.  If false, it 
+    # will be automatically reformatted to fit the screen
+    noDescriptionFormatting = False
+
+    description = \
+"""Start, stop, or report on the resident EUPS process (eupsd) that speeds up setup.  While it's running,
+setup commands are sent to it over a socket private to you, rather than each starting EUPS afresh; if
+it isn't running (or can't serve a request) setup does the work itself.  Restart it after changing your
+EUPS_PATH.  Set $EUPS_NODAEMON to stop setup from using it, or $EUPSD_TIMEOUT to change how many
+seconds setup waits for its reply (default 10) before doing the work itself.
+"""
+
+    def addOptions(self):
+        # always call the super-version so that the core options are set
+        EupsCmd.addOptions(self)
+
+        self.clo.add_option("--foreground", dest="foreground", action="store_true", default=False,
+                            help="Don't detach the daemon from the terminal")
+        self.clo.add_option("--idle-timeout", dest="idleTimeout", action="store", type="float", default=None,
+                            help="Exit after this many seconds without a request")
+        self.clo.add_option("--connection-timeout", dest="connectionTimeout", action="store", type="float",
+                            default=None,
+                            help="Give up on a client that hasn't sent its request after this many seconds")
+        self.clo.add_option("--socket", dest="socket", action="store", default=None,
+                            help="The socket to use (default: $EUPSD_SOCKET or a file under $TMPDIR)")
+
+    def execute(self):
+        import daemon
+
+        if len(self.args) > 1:
+            self.err("Unexpected arguments: %s" % " ".join(self.args[1:]))
+            return 2
+        if self.args:
+            action = self.args[0]
+        else:
+            action = "status"
+
+        if action == "start":
+            try:
+                daemon.start(self.opts.socket, idleTimeout=self.opts.idleTimeout,
+                             foreground=self.opts.foreground, verbose=self.opts.verbose,
+                             connectionTimeout=self.opts.connectionTimeout)
+            except RuntimeError, e:
+                self.err(e)
+                return 1
+        elif action == "stop":
+            if not daemon.stop(self.opts.socket):
+                self.err("No EUPS daemon is running")
+                return 1
+        elif action == "status":
+            reply = daemon.request({"command" : "ping"}, self.opts.socket, timeout=5)
+            if reply is None:
+                if not self.opts.quiet:
+                    print "No EUPS daemon is running"
+                return 1
+            if not self.opts.quiet:
+                print "EUPS daemon (pid %d) has served %d requests" % (reply["pid"], reply["requests"] - 1)
+        else:
+            self.err("Unknown daemon action: %s" % action)
+            return 2
+
+        return 0
+
+class RunCmd(EupsCmd):
+
+    usage = "%prog run [-h|--help] [options] product[:version] ... -- command [args]"
+
+    # set this to True if the description is preformatted.  If false, it 
+    # will be automatically reformatted to fit the screen
+    noDescriptionFormatting = False
+
+    description = \
+"""Setup the specified products and run a command in the resulting environment.  This is equivalent
+to setting up each product in turn and then running the command, but all the products are looked up in
+one EUPS process and the command is run directly, so the environment isn't passed through your shell.
+Aliases defined by the products' table files are not available to the command.
+"""
+
+    def __init__(self, args=None, toolname=None, cmd=None, lockType=None):
+        #
+        # Everything after "--" is the command to run, which mustn't be parsed for options
+        #
+        if args is None:
+            args = sys.argv[1:]
+        if "--" in args:
+            i = args.index("--")
+            args, self.command = args[:i], args[i + 1:]
+        else:
+            self.command = []
+
+        EupsCmd.__init__(self, args, toolname, cmd, lockType)
+
+    def addOptions(self):
+        self.clo.add_option("-e", "--exact", dest="exact_version", action="store_true", default=False,
+                            help="Use the as-installed versions of dependencies, not those in the table files")
+        self.clo.add_option("-i", "--ignore-versions", dest="ignorever", action="store_true", default=False,
+                            help="Ignore any explicit versions in table files")
+        self.clo.add_option("-k", "--keep", dest="keep", action="store_true", default=False,
+                            help="Keep any products already setup (regardless of their versions)")
+        self.clo.add_option("-t", "--tag", dest="tag", action="append",
+                            help="Put TAG near the start of the VRO (may be repeated; precedence is left-to-right)")
+
+        # always call the super-version so that the core options are set
+        EupsCmd.addOptions(self)
+
+        # these options are used to configure the Eups instance
+        self.addEupsOptions()
+
+    def execute(self):
+        if not self.args:
+            self.err("Please specify at least one product")
+            return 3
+        if not self.command:
+            self.err("Please specify a command to run after --")
+            return 3
+
+        products = []
+        for spec in self.args:
+            if ":" in spec:
+                productName, versionName = spec.split(":", 1)
+            else:
+                productName, versionName = spec, None
+            products.append((productName, versionName))
+        #
+        # Setup the products (which updates os.environ), holding the locks only while we read the database
+        #
+        snapshotReads = hooks.config.site.snapshotReads # read the product caches without taking locks
+
+        path = eups.Eups.setEupsPath(self.opts.path, self.opts.dbz)
+        locks = lock.takeLocks("run", path, lock.LOCK_SH, nolocks=self.opts.nolocks or snapshotReads,
+                               verbose=self.opts.verbose - self.opts.quiet)
+        try:
+            try:
+                readCache = hooks.config.Eups.setupUsesCache or snapshotReads
+                validateCache = readCache and not snapshotReads
+                Eups = eups.Eups(flavor=self.opts.flavor, path=self.opts.path, dbz=self.opts.dbz,
+                                 readCache=readCache, validateCache=validateCache, force=self.opts.force,
+                                 ignore_versions=self.opts.ignorever, setupType=self.opts.setupType.split(),
+                                 keep=self.opts.keep, verbose=self.opts.verbose, quiet=self.opts.quiet,
+                                 vro=self.opts.vro, noaction=self.opts.noaction,
+                                 exact_version=self.opts.exact_version, cmdName="setup")
+
+                Eups._processDefaultTags(self.opts)
+
+                try:
+                    eups.commandCallbacks.apply(Eups, self.cmd, self.opts, self.args)
+                except eups.OperationForbidden, e:
+                    e.status = 255
+                    raise
+                except Exception, e:
+                    e.status = 9
+                    raise
+
+                versionNames = [v for p, v in products if v]
+                if versionNames:
+                    versionName = versionNames[0]
+                else:
+                    versionName = None
+                Eups.selectVRO(self.opts.tag, None, versionName, self.opts.dbz, postTag=self.opts.postTag)
+                Eups.includeUserDataDirInPath()
+
+                for productName, versionName in products:
+                    ok, version, reason = Eups.setup(productName, versionName)
+                    if not ok:
+                        if versionName:
+                            productName += " " + versionName
+                        self.err("Failed to setup %s: %s" % (productName, reason))
+                        return 1
+            except eups.EupsException, e:
+                if not hasattr(e, "status"):
+                    e.status = 1
+                raise
+        finally:
+            lock.giveLocks(locks, self.opts.verbose)
+
+        if Eups.aliases:
+            self.err("Ignoring aliases: %s" % " ".join(sorted(Eups.aliases.keys())), volume=1)
+
+        if self.opts.noaction:
+            print " ".join(self.command)
+            return 0
+
+        try:
+            os.execvpe(self.command[0], self.command, os.environ)
+        except OSError, e:
+            self.err("Unable to run %s: %s" % (self.command[0], e.strerror))
+            if e.errno == errno.ENOENT:
+                return 127
+            return 126
+
 class VroCmd(EupsCmd):
 
     usage = "%prog vro [-h|--help] [options] product [version]"
@@ -3000,11 +3359,14 @@ register("undeclare",    UndeclareCmd)
 register("remove",       RemoveCmd)
 register("admin",                  AdminCmd, lockType=None) # must be None, as subcommands take locks
 register("admin buildCache",       AdminBuildCacheCmd)
+register("admin checkCache",       AdminCheckCacheCmd, lockType=lock.LOCK_SH)
 register("admin clearCache",       AdminClearCacheCmd)
 register("admin clearServerCache", AdminClearServerCacheCmd)
 register("admin clearLocks",       AdminClearLocksCmd, lockType=None)
 register("admin listLocks",        AdminListLocksCmd, lockType=None)
+register("admin lockstats",        AdminLockStatsCmd, lockType=None)
 register("admin listCache",        AdminListCacheCmd, lockType=lock.LOCK_SH)
+register("admin tableCache",       AdminTableCacheCmd, lockType=lock.LOCK_SH)
 register("admin info",             AdminInfoCmd, lockType=lock.LOCK_SH)
 register("admin show",             AdminShowCmd, lockType=None)
 register("distrib",         DistribCmd, lockType=None) # must be None, as subcommands take locks
@@ -3016,5 +3378,7 @@ register("distrib list",    DistribListCmd, lockType=lock.LOCK_SH)
 register("distrib path",   DistribPathCmd)
 register("tags",         TagsCmd, lockType=lock.LOCK_SH)
 register("vro",          VroCmd, lockType=None)
+register("daemon",       DaemonCmd, lockType=None)
+register("run",          RunCmd, lockType=None) # must be None, as the locks are released before the command runs
 register("help",         HelpCmd, lockType=None)
     
@@ -0,0 +1,393 @@
+"""
+an optional resident process ("eupsd") that executes setup requests on
+behalf of the setup command.
+
+Each invocation of setup normally pays for starting python, importing
+eups, loading the user's customizations and reading the product caches.
+The daemon does this once and then serves requests sent over a Unix
+socket that is private to the user (see socketPath()).  The product
+stacks it reads are kept in memory (see Eups.residentStacks) and reused
+for as long as the databases' generation counts show that they are
+current; the chain file indexes (see eups.db.TagIndex) and parsed tables
+are kept warm in the same way.
+
+A request carries the client's command line arguments, environment and
+working directory; the reply carries what setup would have written to
+standard output and error and its exit status.  The daemon declines
+(replying with a "fallback" reason) any request that it cannot answer
+exactly as an in-process setup would, e.g. one that uses a different
+EUPS_PATH or startup files than the daemon was started with; the
+client is then expected to run setup itself.  Both sides of the
+protocol are simple enough that the client (bin/eups_setup_impl.py)
+doesn't need to import eups at all.
+
+To run it:
+    eups daemon start       # or "eupsd"
+    eups daemon status
+    eups daemon stop
+"""
+import os, select, socket, sys, tempfile
+try:
+    import json
+except ImportError:
+    json = None
+
+import hooks
+import utils
+
+# incremented whenever the format of requests or replies changes
+protocolVersion = 1
+
+# environment variables that determine how eups is configured; a request
+# is only served if these match the daemon's
+contextVariables = ["EUPS_DIR", "EUPS_PATH", "EUPS_SITEDATA", "EUPS_USERDATA",
+                    "EUPS_STARTUP", "HOME",]
+
+# how long (in seconds) the daemon waits for a client to send its request or
+# accept its reply before giving up on it, so that a client that stalls can't
+# keep the daemon from serving others
+defaultConnectionTimeout = 10
+
+def socketPath():
+    """
+    return the path to the current user's daemon socket.  This is
+    $EUPSD_SOCKET if set, otherwise a file in a directory under $TMPDIR
+    (or /tmp) that only the user can access.
+    """
+    if os.environ.get("EUPSD_SOCKET"):
+        return os.environ["EUPSD_SOCKET"]
+    return os.path.join(os.environ.get("TMPDIR", "/tmp"), "eupsd-%d" % os.getuid(), "socket")
+
+def sendMessage(sock, message):
+    """send a message (a dictionary) and signal that there's no more to come"""
+    sock.sendall(json.dumps(message))
+    sock.shutdown(socket.SHUT_WR)
+
+def receiveMessage(sock):
+    """receive a message sent by sendMessage()"""
+    data = []
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        data.append(chunk)
+    return _strings(json.loads("".join(data)))
+
+def request(message, path=None, timeout=None):
+    """
+    send a message to the daemon and return its reply, or None if the
+    daemon isn't running
+    @param message   the request, as a dictionary
+    @param path      the socket to connect to (default: socketPath())
+    @param timeout   how long to wait for the reply, in seconds
+    """
+    if json is None:
+        return None
+    if not path:
+        path = socketPath()
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.settimeout(timeout)
+            sock.connect(path)
+            message = message.copy()
+            message["protocol"] = protocolVersion
+            sendMessage(sock, message)
+            return receiveMessage(sock)
+        except (socket.error, ValueError):
+            return None
+    finally:
+        sock.close()
+
+def isRunning(path=None):
+    """return True if a daemon is answering on the socket"""
+    reply = request({"command" : "ping"}, path, timeout=5)
+    return reply is not None and reply.get("status") == 0
+
+class EupsDaemon(object):
+    """
+    a server that runs setup requests received on a Unix socket
+    """
+
+    def __init__(self, path=None, idleTimeout=None, verbose=0, log=sys.stderr,
+                 connectionTimeout=None):
+        """
+        @param path         the socket to listen on (default: socketPath())
+        @param idleTimeout  exit after this many seconds without a request;
+                              if None, run until asked to stop
+        @param connectionTimeout  give up on a client that doesn't send its request
+                              (or read the reply) within this many seconds
+                              (default: defaultConnectionTimeout)
+        @param verbose      the verbosity level for the daemon's log
+        @param log          where to log messages to
+        """
+        if not path:
+            path = socketPath()
+        self.path = path
+        self.idleTimeout = idleTimeout
+        if connectionTimeout is None:
+            connectionTimeout = defaultConnectionTimeout
+        self.connectionTimeout = connectionTimeout
+        self.verbose = verbose
+        self.log = log
+
+        self.sock = None
+        self.running = False
+        self.nrequest = 0
+
+        # the configuration that requests must share with the daemon
+        self.context = {}
+        self.customizations = {}        # startup files and their modification times
+
+    def start(self):
+        """
+        load the configuration and start listening on the socket
+        """
+        if json is None:
+            raise RuntimeError("The json module is needed to run the EUPS daemon")
+        import eups
+
+        dir = os.path.dirname(self.path)
+        if not os.path.isdir(dir):
+            os.makedirs(dir, 0700)
+        st = os.stat(dir)
+        if st.st_uid != os.getuid() or st.st_mode & 0077:
+            raise RuntimeError("%s must be a directory only accessible by you" % dir)
+
+        if isRunning(self.path):
+            raise RuntimeError("An EUPS daemon is already listening on %s" % self.path)
+        if os.path.exists(self.path):
+            os.remove(self.path)        # left over from a daemon that died
+
+        for k in contextVariables:
+            self.context[k] = os.environ.get(k)
+
+        path = eups.Eups.setEupsPath()
+        for f in hooks.loadCustomization(path=path):
+            self.customizations[f] = _mtime(f)
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        self.sock.listen(5)
+        self.running = True
+
+        if self.verbose:
+            print >> self.log, "eupsd: listening on %s" % self.path
+
+    def serve(self):
+        """
+        serve requests until asked to stop (or until idle for too long)
+        """
+        import eups
+
+        if not self.running:
+            self.start()
+
+        # keep the product stacks that we read so that later requests can reuse them
+        eups.Eups.residentStacks = {}
+
+        try:
+            while self.running:
+                ready = select.select([self.sock], [], [], self.idleTimeout)[0]
+                if not ready:
+                    if self.verbose:
+                        print >> self.log, "eupsd: exiting after %s seconds of inactivity" % self.idleTimeout
+                    break
+
+                conn = self.sock.accept()[0]
+                conn.settimeout(self.connectionTimeout)
+                try:
+                    try:
+                        self.handle(conn)
+                    except (socket.error, ValueError), e:
+                        print >> self.log, "eupsd: failed to process a request: %s" % e
+                finally:
+                    conn.close()
+        finally:
+            self.stop()
+
+    def stop(self):
+        self.running = False
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def handle(self, conn):
+        """
+        process a single request from a connection
+        """
+        message = receiveMessage(conn)
+        self.nrequest += 1
+
+        if message.get("protocol") != protocolVersion:
+            reply = {"fallback" : "protocol version mismatch"}
+        elif message.get("command") == "ping":
+            reply = {"status" : 0, "pid" : os.getpid(), "requests" : self.nrequest}
+        elif message.get("command") == "stop":
+            reply = {"status" : 0}
+            self.running = False
+        elif message.get("command") == "setup":
+            reply = self.setup(message.get("argv", []), message.get("environ", {}),
+                               message.get("cwd", "/"))
+        else:
+            reply = {"status" : 9, "stdout" : "false\n",
+                     "stderr" : "eupsd: unknown request: %s\n" % message.get("command")}
+
+        if self.verbose > 1:
+            print >> self.log, "eupsd: %s %s -> %s" % (message.get("command"),
+                                                      " ".join(message.get("argv", [])),
+                                                      reply.get("fallback", reply.get("status")))
+        sendMessage(conn, reply)
+
+    def _checkContext(self, environ):
+        # return the reason that a request can't be served, or None
+        for k in contextVariables:
+            if environ.get(k) != self.context[k]:
+                return "$%s differs from the daemon's" % k
+
+        for f, mtime in self.customizations.items():
+            if _mtime(f) != mtime:
+                # we can't unload the old customizations; let a new daemon load them
+                self.running = False
+                return "%s has changed" % f
+
+        return None
+
+    def setup(self, argv, environ, cwd):
+        """
+        run setup with the given arguments in the client's environment,
+        returning a reply holding its output and exit status
+        """
+        reason = self._checkContext(environ)
+        if reason:
+            return {"fallback" : reason}
+
+        oldEnviron = os.environ.copy()
+        oldCwd = os.getcwd()
+        oldArgv = sys.argv
+
+        out = tempfile.TemporaryFile()
+        err = tempfile.TemporaryFile()
+        sys.stdout.flush(); sys.stderr.flush()
+        savedFds = (os.dup(1), os.dup(2))
+        try:
+            os.environ.clear()
+            os.environ.update(environ)
+            os.chdir(cwd)
+            sys.argv = ["eups"] + argv
+
+            os.dup2(out.fileno(), 1)
+            os.dup2(err.fileno(), 2)
+            try:
+                status = self._runSetup(argv)
+            finally:
+                sys.stdout.flush(); sys.stderr.flush()
+                os.dup2(savedFds[0], 1)
+                os.dup2(savedFds[1], 2)
+        finally:
+            os.close(savedFds[0]); os.close(savedFds[1])
+            sys.argv = oldArgv
+            os.chdir(oldCwd)
+            os.environ.clear()
+            os.environ.update(oldEnviron)
+
+        if isinstance(status, str):
+            return {"fallback" : status}
+
+        out.seek(0); err.seek(0)
+        return {"status" : status, "stdout" : out.read(), "stderr" : err.read()}
+
+    def _runSetup(self, argv):
+        # run setup as bin/eups_setup_impl.py would.  A string is returned
+        # if the request should be run by the client instead.
+        import eups
+        import eups.setupcmd
+        Color = utils.Color
+
+        try:
+            setup = eups.setupcmd.EupsSetup(args=argv)
+        except SystemExit, e:           # e.g. a bad option
+            return _exitStatus(e)
+
+        if setup.opts.path or setup.opts.dbz:
+            return "the customizations depend on -Z/-z"
+        if setup.opts.debug:
+            return "--debug was requested"
+
+        try:
+            status = setup.run()
+        except SystemExit, e:
+            status = _exitStatus(e)
+        except Exception, e:
+            setup.err(Color(e, Color.classes["ERROR"]))
+            if hasattr(e, "status"):
+                status = e.status
+            else:
+                status = 9
+            print("false")
+
+        return status
+
+def start(path=None, idleTimeout=None, foreground=False, verbose=0, connectionTimeout=None):
+    """
+    start a daemon listening on path, detaching it from the terminal
+    unless foreground is True.  In the foreground, this returns when the
+    daemon exits.
+    """
+    daemon = EupsDaemon(path, idleTimeout, verbose, connectionTimeout=connectionTimeout)
+    daemon.start()
+
+    if not foreground:
+        if os.fork() > 0:
+            daemon.sock.close()
+            return daemon
+        os.setsid()
+        if os.fork() > 0:
+            os._exit(0)
+
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        os.close(devnull)
+        try:
+            daemon.serve()
+        finally:
+            os._exit(0)
+
+    daemon.serve()
+    return daemon
+
+def stop(path=None):
+    """
+    ask the daemon to exit; return False if it isn't running
+    """
+    return request({"command" : "stop"}, path, timeout=5) is not None
+
+def _exitStatus(e):
+    if e.code is None:
+        return 0
+    if isinstance(e.code, int):
+        return e.code
+    return 1
+
+def _mtime(file):
+    try:
+        return os.stat(file).st_mtime
+    except OSError:
+        return None
+
+def _strings(value):
+    # json returns unicode strings, but the rest of eups expects str
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    if isinstance(value, list):
+        return [_strings(v) for v in value]
+    if isinstance(value, dict):
+        out = {}
+        for k, v in value.items():
+            out[_strings(k)] = _strings(v)
+        return out
+    return value
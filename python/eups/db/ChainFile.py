@@ -1,5 +1,6 @@
 import os, re, sys, pwd
 from eups.utils import ctimeTZ, isRealFilename, stdwarn, stderr
+import eups.utils
 
 who = re.sub(r",.*", "", pwd.getpwuid(os.getuid())[4])
 
@@ -125,7 +126,8 @@ class ChainFile(object):
         """
         write the tag assingment data out to a file.  Note that if the tag
         is not currently assigned to any flavor, the file will be removed 
-        from disk.
+        from disk.  The file is replaced atomically, so readers never see
+        it half written.
 
         @param file : the file to write the data to.  If None, the 
                        configured file will be used.  
@@ -137,8 +139,16 @@ class ChainFile(object):
             if os.path.exists(file):  os.remove(file)
             return
 
-        fd = open(file, "w")
+        fd = eups.utils.AtomicFile(file)
+        try:
+            self._writeTo(fd)
+        except:
+            fd.abort()
+            raise
+        fd.close()
 
+    def _writeTo(self, fd):
+        # write the data to an open file (see write())
         # Should really be "FILE = chain", but eups checks for version.  I've changed it to allow 
  	# chain, but let's not break backward compatibility with old eups versions 
         print >> fd, """FILE = version
@@ -173,8 +183,6 @@ CHAIN = %s
 
             print >> fd, "#End:"
 
-        fd.close()
-
     def _read(self, file=None, verbosity=0):
         """
         read in data from a file, possibly overwring previously tagged products
@@ -1,12 +1,18 @@
-import os, sys, re
+import os, sys, re, errno
 from VersionFile import VersionFile
 from ChainFile import ChainFile
-from eups.utils import isRealFilename, isDbWritable
+from TagIndex import getTagIndex, touch as touchTagIndex
+from eups.utils import isRealFilename, isDbWritable, AtomicFile
 import eups.tags
 from eups.Product import Product
 from eups.exceptions import UnderSpecifiedProduct, ProductNotFound
 from eups.exceptions import TableError
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 versionFileExt = "version"
 versionFileTmpl = "%s." + versionFileExt
 versionFileRe = re.compile(r'^(\w.*)\.%s$' % versionFileExt)
@@ -14,6 +20,22 @@ tagFileExt = "chain"
 tagFileTmpl = "%s." + tagFileExt
 tagFileRe = re.compile(r'^(\w.*)\.%s$' % tagFileExt)
 
+# the file recording the generation count of a database; it is incremented
+# every time the database is modified
+generationFile = ".generation"
+
+# the append-only journal of changes to a database.  Each line records one
+# change, labelled by the generation count that it produced.
+journalFile = ".journal"
+
+# the journal is trimmed to this many entries when it grows to about twice the size
+maxJournalEntries = 1000
+
+# the file locked while the generation count and journal are updated, as
+# writers that only lock the products that they modify (see lock.takeLocks())
+# may update them at the same time
+generationLockFile = ".generationLock"
+
 try:
     _databases
 except NameError:
@@ -77,6 +99,13 @@ class _Database(object):
     may be assigned to one flavor of the version but not all.  The chain
     file, thus, indicates which flavors are assigned the tag.
 
+    Every modification (declare, undeclare, and tag assignments) increments
+    a generation count recorded in a file in the root directory, so that
+    caches of the database can be checked for staleness without scanning
+    every file (see getGeneration()).  The modification is also appended 
+    to a journal, so that a cache can be brought up to date by reloading 
+    only the products that have changed (see getChanges()).
+
     The Database class understands a notion of "user" tags defined from its
     perspective as tag assignments that are recorded under a separate 
     directory (provided by the constructor).  Methods that take a tag name as 
@@ -157,6 +186,165 @@ class _Database(object):
         """
         return eups.utils.isDbWritable(self.dbpath)
 
+    def getGeneration(self, dbrootdir=None):
+        """
+        return the generation count of the database: a number that is 
+        changed every time the database is modified.  None is returned if
+        the database has no record of its generation (e.g. it has only 
+        been modified by older versions of EUPS).
+        @param dbrootdir    the database root directory (e.g. a user tag 
+                              area).  If None, defaults to database root.
+        """
+        if not dbrootdir:
+            dbrootdir = self.dbpath
+
+        try:
+            fd = open(os.path.join(dbrootdir, generationFile))
+            try:
+                return int(fd.read().strip())
+            finally:
+                fd.close()
+        except (IOError, ValueError):
+            return None
+
+    def getChanges(self, since, dbrootdir=None):
+        """
+        return the changes made to the database after a given generation
+        as a list of tuples of the form (generation, operation, product, 
+        version, flavors, tag), where operation is one of "declare", 
+        "undeclare", "tag" or "untag", flavors is a list, and version and 
+        tag may be None.  None is returned if the journal cannot account for
+        every change since that generation (e.g. it has been trimmed, or 
+        the database was modified by an older version of EUPS).
+        @param since        the generation of interest
+        @param dbrootdir    the database root directory (e.g. a user tag 
+                              area).  If None, defaults to database root.
+        """
+        if not dbrootdir:
+            dbrootdir = self.dbpath
+
+        current = self.getGeneration(dbrootdir)
+        if current is None or since is None or since > current:
+            return None
+
+        out = []
+        first = last = None
+        try:
+            fd = open(os.path.join(dbrootdir, journalFile))
+            try:
+                for line in fd:
+                    change = _parseJournalEntry(line)
+                    if change is None:
+                        continue
+                    if first is None:
+                        first = change[0]
+                    last = change[0]
+                    if change[0] > since:
+                        out.append(change)
+            finally:
+                fd.close()
+        except IOError:
+            pass
+
+        if current == since:
+            return []
+        if first is None or first > since + 1 or last != current:
+            return None
+
+        return out
+
+    def initGeneration(self, dbrootdir=None):
+        """
+        start recording the generation count of the database, if it isn't
+        already
+        """
+        if self.getGeneration(dbrootdir) is None:
+            self._bumpGeneration(dbrootdir)
+
+    def _bumpGeneration(self, dbrootdir=None, change=None):
+        # record that the database has been modified.  The new count is 
+        # written atomically so that readers never see a partially written
+        # file.  If change is provided (as a tuple of (operation, product, 
+        # version, flavors, tag)), it is recorded in the journal first.
+        if not dbrootdir:
+            dbrootdir = self.dbpath
+
+        lockfd = self._lockGeneration(dbrootdir)
+        try:
+            generation = self.getGeneration(dbrootdir)
+            if generation is None:
+                generation = 0
+
+            if change:
+                self._appendToJournal(dbrootdir, (generation + 1,) + tuple(change))
+
+                # the product's chain files may have been rewritten in place,
+                # which doesn't update the directory's modification time
+                touchTagIndex(self._productDir(change[1], dbrootdir))
+
+            fd = AtomicFile(os.path.join(dbrootdir, generationFile))
+            try:
+                print >> fd, generation + 1
+            except:
+                fd.abort()
+                raise
+            fd.close()
+        finally:
+            if lockfd is not None:
+                os.close(lockfd)        # releases the lock
+
+    def _lockGeneration(self, dbrootdir):
+        # wait for an exclusive lock on the database's generation count,
+        # returning the file descriptor to close to release it (or None if
+        # locks aren't available)
+        if not fcntl:
+            return None
+
+        try:
+            fd = os.open(os.path.join(dbrootdir, generationLockFile), os.O_RDWR | os.O_CREAT, 0666)
+        except OSError:
+            return None
+
+        while True:
+            try:
+                fcntl.lockf(fd, fcntl.LOCK_EX)
+                return fd
+            except IOError, e:
+                if e.errno != errno.EINTR:
+                    os.close(fd)
+                    return None
+
+    def _appendToJournal(self, dbrootdir, change):
+        file = os.path.join(dbrootdir, journalFile)
+
+        fd = open(file, "a")
+        try:
+            print >> fd, _formatJournalEntry(change)
+            fd.flush()
+            nbyte = os.fstat(fd.fileno()).st_size
+        finally:
+            fd.close()
+
+        # keep the journal from growing without limit; entries are typically
+        # shorter than 80 bytes, so only read it when it may need trimming
+        if nbyte <= 2*80*maxJournalEntries:
+            return
+
+        fd = open(file)
+        try:
+            lines = fd.readlines()
+        finally:
+            fd.close()
+
+        if len(lines) > maxJournalEntries:
+            tmpfile = "%s.%d" % (file, os.getpid())
+            fd = open(tmpfile, "w")
+            try:
+                fd.writelines(lines[-maxJournalEntries:])
+            finally:
+                fd.close()
+            os.rename(tmpfile, file)
+
     def findProduct(self, name, version, flavor):
         """
         find the fully specified declared product given its name, version, 
@@ -206,22 +394,9 @@ class _Database(object):
         return tags
 
     def _findTagsInDir(self, dir, productName, version, flavor):
-        # look tag assignments via chain files in a given directory
-
-        tagFiles = filter(lambda x: not x.startswith('.'), os.listdir(dir))
-        
-        tags = []
-        for file in tagFiles:
-            mat = tagFileRe.match(file)
-            if not mat:
-                continue
-
-            tag = mat.group(1)
-            cf = ChainFile(os.path.join(dir,file), productName, tag)
-            if cf.getVersion(flavor) == version:
-                tags.append(tag)
-
-        return tags
+        # look up tag assignments via the index of the chain files in a 
+        # given directory
+        return getTagIndex(dir, productName).findTags(version, flavor)
 
     def findProductNames(self):
         """
@@ -371,14 +546,8 @@ class _Database(object):
                 if not os.path.exists(loc[i]):
                     continue
 
-            for file in os.listdir(loc[i]):
-                mat = tagFileRe.match(file)
-                if mat: 
-                    tag = mat.group(1)
-                    file = ChainFile(os.path.join(loc[i],file), productName,tag)
-                    for flavor in file.getFlavors():
-                        vers = file.getVersion(flavor)
-                        out.append( (tgroup+tag, vers, flavor) )
+            for tag, vers, flavor in getTagIndex(loc[i], productName).getAssignments():
+                out.append( (tgroup+tag, vers, flavor) )
 
         return out
 
@@ -466,6 +635,7 @@ class _Database(object):
                 trimDir = None
                 
         versionFile.write(trimDir)
+        self._bumpGeneration(change=("declare", prod.name, prod.version, [prod.flavor], None))
 
         # now assign any tags
         for tag in prod.tags:
@@ -505,7 +675,9 @@ class _Database(object):
                 self.unassignTag(tag, product.name, product.flavor)
 
         changed = versionFile.removeFlavor(product.flavor)
-        if changed:  versionFile.write()
+        if changed:
+            versionFile.write()
+            self._bumpGeneration(change=("undeclare", product.name, product.version, [product.flavor], None))
 
         # do a little clean up: if we got rid of the version file, try 
         # deleting the directory
@@ -609,10 +781,12 @@ class _Database(object):
             if not self._getUserTagDb():
                 raise RuntimeError("Unable to assign user tags (user db not available)")
 
-            pdir = self._productDir(productName, self._getUserTagDb())
+            dbroot = self._getUserTagDb()
+            pdir = self._productDir(productName, dbroot)
             if not os.path.exists(pdir):
                 os.makedirs(pdir)
         else:
+            dbroot = self.dbpath
             pdir = self._productDir(productName)
         
         tfile = self._tagFileInDir(pdir, tag.name)
@@ -620,6 +794,7 @@ class _Database(object):
 
         tagFile.setVersion(version, flavors)
         tagFile.write()
+        self._bumpGeneration(dbroot, ("tag", productName, version, flavors, tag.name))
             
 
     def unassignTag(self, tag, productNames, flavors=None):
@@ -651,7 +826,7 @@ class _Database(object):
         if flavors is not None and not isinstance(flavors, list):
             flavors = [flavors]
 
-        unassigned = False
+        unassigned = []
         for prod in productNames:
             tfile = self._tagFileInDir(self._productDir(prod,dbroot), tag)
             if not os.path.exists(tfile):
@@ -660,7 +835,7 @@ class _Database(object):
             if flavors is None:
                 # remove all flavors
                 os.remove(tfile)
-                unassigned = True
+                unassigned.append(prod)
                 continue
 
             tf = ChainFile(tfile)
@@ -671,9 +846,12 @@ class _Database(object):
 
             if changed:
                 tf.write()
-                unassigned = True
+                unassigned.append(prod)
 
-        return unassigned
+        for prod in unassigned:
+            self._bumpGeneration(dbroot, ("untag", prod, None, flavors, tag))
+
+        return len(unassigned) > 0
 
     def isNewerThan(self, timestamp, dbrootdir=None):
         """
@@ -704,6 +882,31 @@ class _Database(object):
 
         return False
         
+def _formatJournalEntry(change):
+    generation, op, productName, version, flavors, tag = change
+    if not flavors:
+        flavors = []
+    return "\t".join([str(generation), op, productName, version or "-", 
+                      ",".join(flavors) or "-", tag or "-"])
+
+def _parseJournalEntry(line):
+    fields = line.rstrip("\n").split("\t")
+    if len(fields) != 6:
+        return None
+
+    try:
+        generation = int(fields[0])
+    except ValueError:
+        return None
+    fields = map(lambda f: (f != "-" and f) or None, fields[1:])
+    op, productName, version, flavors, tag = fields
+    if flavors:
+        flavors = flavors.split(",")
+    else:
+        flavors = []
+
+    return (generation, op, productName, version, flavors, tag)
+
 def _cmp_by_verflav(a, b):
     c = _cmp_str(a.version,b.version)
     if c == 0:
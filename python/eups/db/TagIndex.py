@@ -0,0 +1,195 @@
+import os, re, time, cPickle
+from ChainFile import ChainFile
+from eups.utils import mtimeResolution
+
+tagFileRe = re.compile(r'^(\w.*)\.chain$')
+
+# the directory (under a database root directory) holding persisted indexes
+tagIndexDir = ".tagIndex"
+
+class TagIndex(object):
+    """
+    an index of the tags assigned to the versions of a product, built from
+    the chain files in a product's directory.  It maps a (version, flavor)
+    pair to the list of tags assigned to it so that the tags of a product
+    can be found without reading every chain file.
+
+    An index is only valid while the modification time of the product
+    directory is unchanged; Database updates this time whenever it writes
+    a chain file (creating or removing a file updates it anyway).  Indexes
+    are kept in memory, and optionally persisted under the database root
+    directory (see persistent()) so that they can be shared between
+    processes.
+    """
+
+    _persistent = False
+
+    def __init__(self, dir, productName):
+        """
+        create an index for the tags of the product whose chain files are
+        in dir.  The index is empty until build() or load() is called.
+        @param dir          the product directory containing chain files
+        @param productName  the name of the product
+        """
+        self.dir = dir
+        self.productName = productName
+
+        # the modification time of dir when the index was built
+        self.mtime = None
+
+        # the time when the index was built
+        self.built = None
+
+        # the tag assignments as a list of (tag, version, flavor) tuples
+        self.assignments = []
+
+        # the tags assigned to each (version, flavor)
+        self.byVersion = {}
+
+    def build(self):
+        """
+        (re)build the index by reading the chain files
+        """
+        self.built = time.time()
+        self.mtime = _mtime(self.dir)
+
+        self.assignments = []
+        self.byVersion = {}
+        for file in os.listdir(self.dir):
+            mat = tagFileRe.match(file)
+            if not mat:
+                continue
+
+            tag = mat.group(1)
+            cf = ChainFile(os.path.join(self.dir, file), self.productName, tag)
+            for flavor in cf.getFlavors():
+                version = cf.getVersion(flavor)
+                self.assignments.append((tag, version, flavor))
+                if not self.byVersion.has_key((version, flavor)):
+                    self.byVersion[(version, flavor)] = []
+                self.byVersion[(version, flavor)].append(tag)
+
+    def isCurrent(self):
+        """
+        return True if the product's chain files haven't changed since the
+        index was built
+        """
+        if self.mtime is None:
+            return False
+        if self.mtime > self.built - mtimeResolution:
+            return False
+        return _mtime(self.dir) == self.mtime
+
+    def findTags(self, version, flavor):
+        """
+        return a list of the tags assigned to a version of the product
+        """
+        return list(self.byVersion.get((version, flavor), []))
+
+    def getAssignments(self):
+        """
+        return a list of (tag, version, flavor) tuples giving all the tag
+        assignments of the product
+        """
+        return list(self.assignments)
+
+    def save(self, file):
+        """
+        persist the index to a file
+        """
+        tmpfile = "%s.%d" % (file, os.getpid())
+        fd = open(tmpfile, "w")
+        try:
+            cPickle.dump((self.mtime, self.built, self.assignments), fd, protocol=2)
+        finally:
+            fd.close()
+        os.rename(tmpfile, file)
+
+    def load(self, file):
+        """
+        restore the index from a file written by save().  False is returned
+        if the file could not be read.
+        """
+        try:
+            fd = open(file)
+            try:
+                self.mtime, self.built, assignments = cPickle.load(fd)
+            finally:
+                fd.close()
+        except (IOError, EOFError, ValueError, cPickle.UnpicklingError):
+            return False
+
+        self.assignments = []
+        self.byVersion = {}
+        for tag, version, flavor in assignments:
+            self.assignments.append((tag, version, flavor))
+            if not self.byVersion.has_key((version, flavor)):
+                self.byVersion[(version, flavor)] = []
+            self.byVersion[(version, flavor)].append(tag)
+
+        return True
+
+    def persistent(val=None):
+        """Should indexes be persisted to disk?  With an argument, set the value"""
+        if val is not None:
+            TagIndex._persistent = bool(val)
+
+        return TagIndex._persistent
+
+    persistent = staticmethod(persistent)
+
+try:
+    _tagIndexes
+except NameError:
+    _tagIndexes = {}                    # the in-memory indexes, keyed by product directory
+
+def getTagIndex(dir, productName):
+    """
+    return an up-to-date TagIndex for the product whose chain files are in
+    dir, reusing an index held in memory or persisted to disk if possible.
+    @param dir          the product directory containing chain files
+    @param productName  the name of the product
+    """
+    index = _tagIndexes.get(dir)
+    if index is not None and index.isCurrent():
+        return index
+
+    index = TagIndex(dir, productName)
+    file = None
+    if TagIndex.persistent():
+        file = os.path.join(os.path.dirname(dir), tagIndexDir, productName)
+        if index.load(file) and index.isCurrent():
+            _tagIndexes[dir] = index
+            return index
+
+    index.build()
+    _tagIndexes[dir] = index
+
+    if file and index.isCurrent():
+        try:
+            if not os.path.isdir(os.path.dirname(file)):
+                os.mkdir(os.path.dirname(file))
+            index.save(file)
+        except (IOError, OSError):
+            pass                        # e.g. the database isn't writable
+
+    return index
+
+def touch(dir):
+    """
+    mark the tag indexes of the product whose chain files are in dir as
+    out of date
+    """
+    if dir in _tagIndexes:
+        del _tagIndexes[dir]
+    if os.path.isdir(dir):
+        try:
+            os.utime(dir, None)
+        except OSError:
+            pass
+
+def _mtime(dir):
+    try:
+        return os.stat(dir).st_mtime
+    except OSError:
+        return None
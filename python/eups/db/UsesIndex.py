@@ -0,0 +1,180 @@
+import os, cPickle
+
+# the file (in a database, or in the user's cache for the database) holding a persisted index
+usesIndexFile = ".usesIndex"
+
+# Bump this whenever the contents of a persisted index change
+usesIndexVersion = 2
+
+class UsesIndex(object):
+    """
+    an index of the dependencies of declared products, used by Eups.uses()
+    (and so by "eups uses" and "eups remove --checkRecursive").
+
+    For each declared (product, version, flavor) the index holds the
+    forward edges: the (product, version, optional, depth) of every product
+    that it depends on, directly or indirectly, as computed by
+    Eups.getDependentProducts().  It also holds the names of all the
+    products that were asked for while resolving them, whether or not
+    a matching version was found, so that a product whose optional (or
+    unsatisfiable) dependency is later declared can be found (see
+    findUsers()).  The reverse edges are derived from these names when
+    they're needed.
+
+    The dependencies that are found depend on the context in which they
+    were resolved (the EUPS_PATH, flavor, VRO...), on the state of the
+    databases (what's declared and which tags are assigned) and on the table
+    files.  An index records the generation counts of the databases and
+    the modification time of each product's table file, so that it can be
+    brought up to date by recomputing only the entries that a change could
+    affect (see Eups.uses()).  An index is persisted as one
+    file per database, holding the entries for the products declared in it.
+    """
+
+    def __init__(self, context=None):
+        """
+        @param context   a description of the context that the dependencies are resolved in
+        """
+        self.context = context
+
+        # the generation counts of the databases when the index was last brought up to date
+        # (None for a database that doesn't record its generation), keyed by database directory
+        self.generations = {}
+
+        # the time when the index was last brought up to date
+        self.updated = None
+
+        # the dependencies of each (product, version, flavor)
+        self.depends = {}
+
+        # the names of the products asked for while finding each (product, version, flavor)'s dependencies
+        self.requests = {}
+
+        # the modification time of each (product, version, flavor)'s table file
+        self.tableMtimes = {}
+
+        # the database that each (product, version, flavor) is declared in
+        self.dbs = {}
+
+        self._usersByName = None        # the keys of the products that depend on each product name
+
+    def __len__(self):
+        return len(self.depends)
+
+    def keys(self):
+        return self.depends.keys()
+
+    def has_key(self, key):
+        return self.depends.has_key(key)
+
+    def set(self, key, deps, tableMtime=None, db=None, requests=None):
+        """
+        set the dependencies of a product
+        @param key         the (product, version, flavor) of the product
+        @param deps        a list of (product, version, optional, depth) for each dependency
+        @param tableMtime  the modification time of the product's table file
+        @param db          the database that the product is declared in
+        @param requests    the names of the products asked for while finding deps, including
+                             those that weren't found (default: the names in deps)
+        """
+        self.remove(key)
+
+        if requests is None:
+            requests = [dep[0] for dep in deps]
+
+        self.depends[key] = deps
+        self.requests[key] = sorted(set(requests))
+        self.tableMtimes[key] = tableMtime
+        self.dbs[key] = db
+        if self._usersByName is not None:
+            self._addUser(key)
+
+    def remove(self, key):
+        """
+        forget the dependencies of a product
+        @param key         the (product, version, flavor) of the product
+        """
+        if not self.depends.has_key(key):
+            return
+
+        if self._usersByName is not None:
+            for name in self.requests[key]:
+                users = self._usersByName.get(name)
+                if users and key in users:
+                    users.remove(key)
+
+        del self.depends[key]
+        del self.requests[key]
+        del self.tableMtimes[key]
+        del self.dbs[key]
+
+    def _addUser(self, key):
+        for name in self.requests[key]:
+            if not self._usersByName.has_key(name):
+                self._usersByName[name] = set()
+            self._usersByName[name].add(key)
+
+    def findUsers(self, productNames):
+        """
+        return a set of the (product, version, flavor)s that depend on any
+        version of the named products, or that asked for them (directly or
+        indirectly) but didn't find a suitable version
+        """
+        if self._usersByName is None:
+            self._usersByName = {}
+            for key in self.depends.keys():
+                self._addUser(key)
+
+        out = set()
+        for name in productNames:
+            out.update(self._usersByName.get(name, []))
+        return out
+
+    def save(self, file, db):
+        """
+        persist the entries for the products declared in a database to a file
+        @param file   the file to write
+        @param db     the database whose products should be saved
+        """
+        entries = {}
+        for key, deps in self.depends.items():
+            if self.dbs[key] == db:
+                entries[key] = (deps, self.tableMtimes[key], self.requests[key])
+
+        tmpfile = "%s.%d" % (file, os.getpid())
+        fd = open(tmpfile, "w")
+        try:
+            cPickle.dump((usesIndexVersion, self.context, self.generations, self.updated, db, entries), fd,
+                         protocol=2)
+        finally:
+            fd.close()
+        os.rename(tmpfile, file)
+
+    def load(self, file):
+        """
+        add the entries persisted to a file by save().  False is returned if
+        the file could not be read, or if it describes a different context or
+        database state from the entries already loaded.
+        """
+        try:
+            fd = open(file)
+            try:
+                version, context, generations, updated, db, entries = cPickle.load(fd)
+            finally:
+                fd.close()
+        except (IOError, EOFError, ValueError, TypeError, AttributeError, ImportError,
+                cPickle.UnpicklingError):
+            return False
+
+        if version != usesIndexVersion or context != self.context:
+            return False
+        if self.updated is None:
+            self.generations = generations
+            self.updated = updated
+        elif generations != self.generations or updated != self.updated:
+            return False
+
+        for key, (deps, tableMtime, requests) in entries.items():
+            self.set(key, deps, tableMtime, db, requests)
+
+        return True
@@ -441,6 +441,7 @@ class VersionFile(object):
         """
         write the data out to a file.  If this version file contains no
         declared flavors, this function will remove the file, if it exists.
+        The file is replaced atomically, so readers never see it half written.
 
         @param trimDir  strip off this leading directory name from all
                           paths written out.
@@ -453,8 +454,16 @@ class VersionFile(object):
             if os.path.exists(file):  os.remove(file)
             return
 
-        fd = open(file, "w")
+        fd = eups.utils.AtomicFile(file)
+        try:
+            self._writeTo(fd, trimDir)
+        except:
+            fd.abort()
+            raise
+        fd.close()
 
+    def _writeTo(self, fd, trimDir):
+        # write the data to an open file (see write())
         print >> fd, """FILE = version
 PRODUCT = %s
 VERSION = %s
@@ -529,7 +538,5 @@ Group:
 
         print >> fd, "End:"
 
-        fd.close()
-
 
 
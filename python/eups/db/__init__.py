@@ -12,8 +12,16 @@ The main classes in this module are:
    ChainFile    an interface into the data about the assignment of a 
                  specific tag to a product, which is stored in a single 
                  file in the database.
+   TagIndex     an index of the tags assigned to a product's versions, 
+                 built from its chain files and kept up to date using the 
+                 modification time of the product's directory.
+   UsesIndex    an index of the dependencies of the declared products, 
+                 saved in the database so that "eups uses" needn't 
+                 recompute them all.
 """
 from VersionFile import VersionFile 
 from ChainFile import ChainFile
+from TagIndex import TagIndex
+from UsesIndex import UsesIndex
 from Database import Database
 
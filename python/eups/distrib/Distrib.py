@@ -4,7 +4,7 @@
 # Export a product and its dependencies as a package, or install a
 # product from a package
 #
-import sys, os, re, atexit, shutil
+import sys, os, re, atexit, shutil, threading
 import eups
 import eups.hooks as hooks
 import eups.table
@@ -13,6 +13,12 @@ from server import RemoteFileNotFound, Manifest, TaggedProductList
 from eups.VersionParser import VersionParser
 from eups.exceptions import EupsException
 
+# the files that prefetchFile() has downloaded in this process; only these are
+# returned by takePrefetchedFile(), so a file left behind by an earlier,
+# interrupted install is never mistaken for the package being installed
+_prefetchedFiles = set()
+_prefetchedFilesLock = threading.Lock()
+
 class Distrib(object):
     """A class to encapsulate product distribution
 
@@ -238,6 +244,88 @@ class Distrib(object):
         """
         self.unimplemented("installPackage");
 
+    def prefetchPackage(self, location, product, version, buildDir):
+        """download the files that installPackage() will need into the
+        package's build directory ahead of time, so that the packages for
+        a whole manifest can be downloaded concurrently before any of them
+        is installed (see Repositories.install()).  installPackage() should
+        then use the prefetched files (see takePrefetchedFile()) rather than
+        download them again.  This may be called from a different thread
+        to the one that installs the package, while other packages are being
+        prefetched.
+
+        This implementation does nothing.  Subclasses that download their
+        packages from the server should override this method.
+
+        @param location     the location of the package on the server (see
+                               installPackage())
+        @param product      the name of the product installed by the package.
+        @param version      the name of the product version.
+        @param buildDir     the directory that the package will be built in
+        """
+        pass
+
+    def prefetchFile(self, path, product, version, ftype, buildDir):
+        """download a file associated with a product from the server into
+        buildDir, where takePrefetchedFile() will find it.  The file only
+        appears under the name that takePrefetchedFile() looks for once it
+        has been completely downloaded.
+        @param path        the path on the remote server to the desired file
+        @param product     the name of the product
+        @param version     the version of the product
+        @param ftype       the type of file (see DistribServer.getFileForProduct())
+        @param buildDir    the directory that the package will be built in
+        """
+        prefetched = self._prefetchedFilename(path, buildDir)
+        tmpfile = prefetched + ".tmp"
+
+        filename = self.distServer.getFileForProduct(path, product, version, self.Eups.flavor,
+                                                     ftype=ftype, filename=tmpfile)
+        if filename != tmpfile:
+            shutil.copyfile(filename, tmpfile)
+        os.rename(tmpfile, prefetched)
+
+        _prefetchedFilesLock.acquire()
+        try:
+            _prefetchedFiles.add(prefetched)
+        finally:
+            _prefetchedFilesLock.release()
+
+    def takePrefetchedFile(self, path, buildDir, filename=None):
+        """return the name of the copy of a file that was downloaded by
+        prefetchFile() in this process, or None if it hasn't been.  A file
+        can only be taken once.
+        @param path        the path on the remote server to the desired file
+        @param buildDir    the directory that the package will be built in
+        @param filename    if not None, move the file to this name before
+                             returning it
+        """
+        if not buildDir:
+            return None
+        prefetched = self._prefetchedFilename(path, buildDir)
+
+        _prefetchedFilesLock.acquire()
+        try:
+            fetched = prefetched in _prefetchedFiles
+            _prefetchedFiles.discard(prefetched)
+        finally:
+            _prefetchedFilesLock.release()
+
+        if not fetched:
+            if os.path.exists(prefetched): # left behind by an earlier install
+                os.remove(prefetched)
+            return None
+        if not os.path.exists(prefetched):
+            return None
+
+        if filename:
+            shutil.move(prefetched, filename)
+            return filename
+        return prefetched
+
+    def _prefetchedFilename(self, path, buildDir):
+        return os.path.join(buildDir, "%s.prefetched" % os.path.basename(path))
+
     def cleanPackage(self, product, version, productRoot, location):
         """remove any distribution-specific remnants of a package installation.
         Some distrib mechanisms (namely, Pacman) maintain some of their own 
@@ -412,8 +500,8 @@ class Distrib(object):
             def getDependencies(productName, version):
                 try:
                     product = self.Eups.getProduct(productName, version)
-                    dependencies = self.Eups.getDependentProducts(product, productDictionary={},
-                                                                  topological=True)
+                    graph = self.Eups.getDependencyGraph(product, topological=True)
+                    dependencies = graph.getDependentProducts(topological=True, verbose=self.Eups.verbose)
                 except:
                     return None
                 return dependencies
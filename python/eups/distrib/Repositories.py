@@ -342,9 +342,87 @@ class Repositories(object):
             raise EupsException("You asked to install %s %s but it is not in the manifest\nCheck manifest.remap (see \"eups startup\") and/or increase the verbosity" % (product, version))
 
         self._msgs = {}
+        self._prefetch(man, product, version, flavor, productRoot, options, nodepend, noeups)
         self._recursiveInstall(0, man, product, version, flavor, pkgroot, 
                                productRoot, updateTags, alsoTag, options, 
                                nodepend, noclean, noeups)
+
+    def _prefetch(self, manifest, product, version, flavor, productRoot, opts=None, 
+                  nodepend=False, noeups=False):
+        # Download the packages for the products in a manifest that need to be installed
+        # into their build directories, using hooks.config.Eups.downloadThreads threads, 
+        # so that _recursiveInstall doesn't wait for each download in turn.  A package
+        # that can't be prefetched is simply downloaded again when it's installed
+        nthreads = hooks.config.Eups.downloadThreads
+        if not nthreads or self.eups.noaction:
+            return
+
+        instflavor = flavor
+        if instflavor == "generic":
+            instflavor = self.eups.flavor
+
+        defaultProduct = hooks.config.Eups.defaultProduct["name"]
+
+        products = []
+        for prod in manifest.getProducts():
+            if nodepend and prod.product != product and prod.version != version:
+                continue
+            if prod.product == defaultProduct or prod.version == "dummy":
+                continue
+
+            if not noeups and self.eups.findProduct(prod.product, prod.version, flavor=instflavor):
+                if not self.eups.force or \
+                       (manifest.mapping and manifest.mapping.noReinstall(prod.product, prod.version, flavor)):
+                    continue            # it won't be reinstalled
+
+            products.append(prod)
+
+        if len(products) < 2:
+            return                      # nothing to be gained
+
+        if self.verbose > 0:
+            print >> self.log, "Downloading %d packages using %d threads" % (len(products), nthreads)
+
+        # create the build directories first, as they may share parents that
+        # makeBuildDirFor() can't safely create from several threads at once
+        builddirs = []
+        for prod in products:
+            try:
+                builddirs.append(self.makeBuildDirFor(productRoot, prod.product, prod.version, 
+                                                      opts, instflavor))
+            except OSError:
+                builddirs.append(None)
+
+        def prefetch(item):
+            prod, builddir = item
+            if builddir is None:
+                return
+            try:
+                self._prefetchPackage(prod, builddir, instflavor, opts)
+            except Exception, e:
+                return e
+
+        for prod, e in zip(products, utils.parallelMap(prefetch, zip(products, builddirs), nthreads)):
+            if e is not None and self.verbose > 1:
+                print >> self.log, "Unable to download %s %s ahead of installing it: %s" % \
+                      (prod.product, prod.version, e)
+
+    def _prefetchPackage(self, prod, builddir, instflavor, opts):
+        # Download the package for a product in a manifest (see _prefetch()) into builddir; 
+        # the package is looked up just as _recursiveInstall will when it installs it
+        pkg = self.findPackage(prod.product, prod.version, prod.flavor)
+        if not pkg:
+            return                      # _recursiveInstall will complain
+
+        pkgroot = pkg[3]
+        nprod = self.repos[pkgroot].getManifest(pkg[0], pkg[1], pkg[2]).getDependency(prod.product)
+        if nprod:
+            prod = nprod
+        if not prod.distId:
+            return
+
+        distrib = self.repos[pkgroot].getDistribFor(prod.distId, opts, instflavor)
+        distrib.prefetchPackage(distrib.parseDistID(prod.distId), prod.product, prod.version, builddir)
         
     def _recursiveInstall(self, recursionLevel, manifest, product, version, 
                           flavor, pkgroot, productRoot, updateTags=False, 
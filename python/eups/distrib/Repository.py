@@ -7,6 +7,7 @@ import eups
 import server 
 from eups.tags      import Tag, TagNotRecognized
 from eups.utils     import Flavor, Quiet, isDbWritable
+from eups.VersionCompare import sortVersions
 from server         import ServerConf, Manifest, Mapping, TaggedProductList
 from server         import RemoteFileNotFound, LocalTransporter
 from DistribFactory import DistribFactory
@@ -155,7 +156,7 @@ class Repository(object):
             lookup[prod]["_sortOrder"] = keys
 
             for flav in lookup[prod]["_sortOrder"]:
-                lookup[prod][flav].sort(self.eups.version_cmp)
+                sortVersions(lookup[prod][flav], self.eups.version_cmp)
 
         return lookup
 
@@ -346,7 +347,7 @@ class Repository(object):
         for name in names:
             for flav in flavors:
                 latest = filter(lambda p: p[0] == name and p[2] == flav, prods)
-                latest.sort(lambda a,b: self.eups.version_cmp(a[1],b[1]))
+                sortVersions(latest, self.eups.version_cmp, key=lambda p: p[1])
                 out.extend(latest)
 
         return out
@@ -293,6 +293,12 @@ DIST_URL = %%(base)s/builds/%%(path)s
                                                              flavor))
         return os.path.exists(os.path.join(serverDir, "builds", location))
 
+    def prefetchPackage(self, location, product, version, buildDir):
+        """download the build file into the build directory for installPackage()
+        (see Distrib.prefetchPackage())
+        """
+        self.prefetchFile(location, product, version, "build", buildDir)
+
     def installPackage(self, location, product, version, productRoot, 
                        installDir, setups=None, buildDir=None):
         """Install a package with a given server location into a given
@@ -312,10 +318,12 @@ DIST_URL = %%(base)s/builds/%%(path)s
         """
 
         builder = location
-        tfile = self.distServer.getFileForProduct(builder, product, version,
-                                                  self.Eups.flavor, 
-                                                  ftype="build", 
-                                                  noaction=self.Eups.noaction)
+        tfile = self.takePrefetchedFile(builder, buildDir)
+        if not tfile:
+            tfile = self.distServer.getFileForProduct(builder, product, version,
+                                                      self.Eups.flavor, 
+                                                      ftype="build", 
+                                                      noaction=self.Eups.noaction)
 
         if False:
             if not self.Eups.noaction and not os.access(tfile, os.R_OK):
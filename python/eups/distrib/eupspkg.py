@@ -883,6 +883,12 @@ TAGLIST_DIR = tags
         location = self.parseDistID(self.getDistIdForPackage(product, version, flavor))
         return os.path.exists(os.path.join(serverDir, "products", location))
 
+    def prefetchPackage(self, location, product, version, buildDir):
+        """download the package into the build directory for installPackage()
+        (see Distrib.prefetchPackage())
+        """
+        self.prefetchFile(location, product, version, "eupspkg", buildDir)
+
     def installPackage(self, location, product, version, productRoot, 
                        installDir, setups=None, buildDir=None):
         """Install a package with a given server location into a given
@@ -904,10 +910,17 @@ TAGLIST_DIR = tags
         pkg = location
         if self.Eups.verbose >= 1:
             print >> self.log, "[dl]",; self.log.flush()
-        tfname = self.distServer.getFileForProduct(pkg, product, version,
-                                                   self.Eups.flavor,
-                                                   ftype="eupspkg", 
-                                                   noaction=self.Eups.noaction)
+        tfname = self.takePrefetchedFile(pkg, buildDir)
+        if tfname:
+            # move it out of the way, as the build directory is emptied below
+            tmpfile = self.distServer.makeTempFile(product + "_")
+            shutil.move(tfname, tmpfile)
+            tfname = tmpfile
+        else:
+            tfname = self.distServer.getFileForProduct(pkg, product, version,
+                                                       self.Eups.flavor,
+                                                       ftype="eupspkg", 
+                                                       noaction=self.Eups.noaction)
 
         logfile = os.path.join(buildDir, "build.log") # we'll log the build to this file
         uimsgfile = os.path.join(buildDir, "build.msg") # messages to be shown on the console go to this file
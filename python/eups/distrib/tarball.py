@@ -165,6 +165,12 @@ DIST_URL = %(base)s/%(path)s
         location = self.parseDistID(self.getDistIdForPackage(product, version, flavor))
         return os.path.exists(os.path.join(serverDir, location))
 
+    def prefetchPackage(self, location, product, version, buildDir):
+        """download the tarball into the build directory for installPackage()
+        (see Distrib.prefetchPackage())
+        """
+        self.prefetchFile(location, product, version, "dist", buildDir)
+
     def installPackage(self, location, product, version, productRoot, 
                        installDir=None, setups=None, buildDir=None):
         """Install a package with a given server location into a given
@@ -197,10 +203,11 @@ DIST_URL = %(base)s/%(path)s
         tfile = "%s/%s" % (buildDir, tarball)
 
         if not self.Eups.noaction:
-            tfile = self.distServer.getFileForProduct(location, product, 
-                                                      version, self.Eups.flavor,
-                                                      ftype="dist",
-                                                      filename=tfile)
+            if not self.takePrefetchedFile(location, buildDir, tfile):
+                tfile = self.distServer.getFileForProduct(location, product, 
+                                                          version, self.Eups.flavor,
+                                                          ftype="dist",
+                                                          filename=tfile)
             if not os.access(tfile, os.R_OK):
                 raise RuntimeError, ("Unable to read %s" % (tfile))
 
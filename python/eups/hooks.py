@@ -32,8 +32,12 @@ def defineProperties(names, parentName=None):
 
 # various configuration properties settable by the user
 config = defineProperties("Eups distrib site user")
-config.Eups = defineProperties("userTags preferredTags globalTags reservedTags defaultTags verbose asAdmin setupTypes setupCmdName VRO fallbackFlavors defaultProduct startupFileName repoVersioner versionIncrementer colorize", "Eups")
+config.Eups = defineProperties("userTags preferredTags globalTags reservedTags defaultTags verbose asAdmin setupTypes setupCmdName VRO fallbackFlavors defaultProduct startupFileName repoVersioner versionIncrementer colorize cacheBackend setupUsesCache crawlThreads downloadThreads persistTagIndex tableCache tableRegistrySize usesIndex usesIndexJobs", "Eups")
 config.Eups.setType("verbose", int)
+config.Eups.setType("crawlThreads", int)
+config.Eups.setType("downloadThreads", int)
+config.Eups.setType("tableRegistrySize", int)
+config.Eups.setType("usesIndexJobs", int)
 
 config.Eups.userTags = []
 config.Eups.defaultTags = dict(pre=[], post=[])
@@ -69,12 +73,89 @@ config.Eups.defaultProduct = {"name" : "implicitProducts", "version" : None, "ta
 
 config.Eups.colorize = False
 #
+# The format used to persist the product caches: "sqlite" (an indexed database, allowing individual products
+# to be looked up without loading the entire stack) or "pickle".  If sqlite isn't available, pickle is used.
+#
+config.Eups.cacheBackend = "sqlite"
+#
+# Should setup use the product caches?  If True, a cache is only used when it's known to be up to date
+# with the database (it is never rebuilt by setup); if False, setup always reads the database files.
+#
+config.Eups.setupUsesCache = True
+#
+# The number of threads used to read the database files when a cache is rebuilt.  Reading a database is
+# dominated by the time taken to open many small files, so several threads help on network filesystems.
+#
+config.Eups.crawlThreads = 4
+#
+# The number of threads used by "eups distrib install" to download the packages in a manifest before
+# installing them (rather than downloading each in turn as it is installed); 0 means don't download them early
+#
+config.Eups.downloadThreads = 4
+#
+# Should the per-product indexes of tag assignments be saved in the databases (in ups_db/.tagIndex), so that
+# they can be shared between processes?  They are always kept in memory.
+#
+config.Eups.persistTagIndex = False
+#
+# Should parsed table files be saved (in the user data directory, in _tables_) so that a table file is only
+# parsed again when it changes?
+#
+config.Eups.tableCache = True
+#
+# The maximum number of tables (read from table files) that are kept in memory and shared by all the
+# products that use them; 0 means that each product reads its own table
+#
+config.Eups.tableRegistrySize = 500
+#
+# Should the index of which products depend on which (used by "eups uses" and "eups remove") be saved
+# in the databases (in ups_db/.usesIndex, or in the user's caches), and brought up to date as they change?
+#
+config.Eups.usesIndex = True
+#
+# The number of processes used to compute the entries of the uses index
+#
+config.Eups.usesIndexJobs = 1
+#
 # Configure things that apply to the entire site
 #
-config.site = defineProperties("lockDirectoryBase", "site")
+config.site = defineProperties("lockDirectoryBase lockMethod lockTimeout lockStatsSize lockGranularity "
+                               "snapshotReads", "site")
+config.site.setType("lockStatsSize", int)
 
 _defaultLockDirectoryBase = "__UPS_DB__";
 config.site.lockDirectoryBase = _defaultLockDirectoryBase
+#
+# How to take locks:  "fcntl" uses the kernel's advisory locks on a file (which are released
+# automatically if the process dies), "mkdir" uses lock directories.  Every eups at a site
+# must use the same method, as the two sorts of lock don't see each other; older versions of
+# eups only use "mkdir", so only choose "fcntl" once every eups using the site's stacks does too
+# (and the filesystem supports fcntl locks, as commands fail rather than use a different sort of lock)
+#
+config.site.lockMethod = "mkdir"
+#
+# The number of seconds to wait for an fcntl lock held by someone else; a negative number means wait forever
+#
+config.site.lockTimeout = 60
+#
+# The number of records of how long locks were waited for and held to keep (in .lockStats next to the
+# locks; see "eups admin lockstats"); 0 means don't keep any.  Recording them means writing to the stack
+# every time a lock is taken (including by every setup), so only turn this on while investigating contention
+#
+config.site.lockStatsSize = 0
+#
+# What commands that modify products (e.g. declare) lock:  "stack" means the entire stack, excluding
+# everyone else; "product" means just the products that they modify, so other commands (e.g. setup) can
+# still read the stack
+#
+config.site.lockGranularity = "stack"
+#
+# If true, setup and "eups run" don't take any locks, so they never wait for a command that's modifying
+# the stack.  They read a consistent snapshot of the stack from the product caches (which are stamped with
+# the database's generation count, and rebuilt if it's changed) instead of the database itself; this relies
+# on every eups at the site writing its files atomically
+#
+config.site.snapshotReads = False
 
 # it is expected that different Distrib classes will have different set-able
 # properties.  The key for looking up Distrib-specific data should be the Distrib
@@ -1,15 +1,36 @@
 import errno, glob, os, shutil, sys, time
 import re
+import signal
 import hooks
 import utils
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 #
 # Types of locks
 #
 LOCK_SH = 1                             # acquire a shared lock
 LOCK_EX = 2                             # acquire an exclusive lock
 
-_lockDir = ".lockDir"                   # name of lock directory
+_lockDir = ".lockDir"                   # name of lock directory (used by the "mkdir" lockMethod)
+_lockFile = ".lockFile"                 # name of lock file (used by the "fcntl" lockMethod)
+_lockStats = ".lockStats"               # name of the file recording the use of locks
+_productLocks = ".productLocks"         # directory holding the locks on individual products
+
+#
+# The fcntl locks that this process holds, indexed by (pid, name of the lock file).  POSIX
+# locks belong to the process, and closing any descriptor for the file drops them, so we
+# must only open each lock file once; the values are lists [fd, lockType, count].  The pid
+# is needed as children don't inherit our locks when we fork
+#
+_fcntlLocks = {}
+
+class _LockTimeout(Exception):
+    """The timeout for acquiring an fcntl lock expired"""
+    pass
 
 def getLockPath(dirName, create=False):
     """Get the directory path that should prefix the """
@@ -34,7 +55,30 @@ def getLockPath(dirName, create=False):
 
         return dirName
     
-def takeLocks(cmdName, path, lockType, nolocks=False, ntry=10, verbose=0):
+def takeLocks(cmdName, path, lockType, nolocks=False, ntry=10, verbose=0, timeout=None, products=None):
+    """
+    Take locks of type lockType (LOCK_SH or LOCK_EX) on each of the directories in path, returning
+    a list of the locks taken that should be passed to giveLocks()
+
+    If hooks.config.site.lockGranularity is "product" and a command that only modifies some products
+    lists them in products, an exclusive lock is only taken on each of those products;  the directories
+    are locked shared, so other products can be read and modified while the command runs.  Commands that
+    take exclusive locks on the directories (e.g. eups admin) still exclude everyone else.
+
+    Locks are taken using the method set by hooks.config.site.lockMethod:  "fcntl" uses the kernel's
+    advisory locks on a file in each directory (which are released when the process exits, however
+    it dies), and "mkdir" uses lock directories.  The two sorts of lock don't see each other, so if
+    fcntl locks aren't available (e.g. on some NFS mounts) RuntimeError is raised rather than falling
+    back to lock directories in just this process.
+    @param cmdName   the name of the command taking the locks
+    @param path      the directories to lock
+    @param lockType  the type of lock;  if None, no locks are taken
+    @param nolocks   if True, don't take any locks
+    @param ntry      the number of times to try to make a lock directory
+    @param timeout   the number of seconds to wait for an fcntl lock;  if None, use
+                        hooks.config.site.lockTimeout.  A negative value means wait forever
+    @param products  the names of the only products that an exclusive lock is needed on (or None)
+    """
     locks = []
 
     if hooks.config.site.lockDirectoryBase is None:
@@ -51,105 +95,61 @@ def takeLocks(cmdName, path, lockType, nolocks=False, ntry=10, verbose=0):
         if verbose > 1:
             print >> utils.stdinfo, "Acquiring %s locks for command \"%s\"" % (lockTypeName, cmdName)
 
-        dt = 1.0                        # number of seconds to wait
-        for d in path:
-            makeLock = True             # we can make the lock
-            for i in range(1, ntry + 1):
-                try:
-                    lockDir = os.path.join(getLockPath(d), _lockDir)
-                    getLockPath(d, create=True)
-
-                    os.mkdir(lockDir)
-                except OSError, e:
-                    if lockType == LOCK_EX:
-                        lockPids = listLockers(lockDir, getPids=True)
-                        if len(lockPids) == 1 and lockPids[0] == os.environ.get("EUPS_LOCK_PID", "-1"):
-                            pass        # OK, there's a lock but we know about it
-                            if verbose:
-                                print >> utils.stdinfo, "Lock is held by a parent, PID %d" % lockPids[0]
-                        else:
-                            if e.errno == errno.EEXIST:
-                                reason = "locks are held by %s" % " ".join(listLockers(lockDir))
-                            else:
-                                reason = str(e)
-
-                            msg = "Unable to take exclusive lock on %s" % (d)
-                            if e.errno == errno.EACCES:
-                                if verbose >= 0:
-                                    print >> utils.stdinfo, "%s; your command may fail" % (msg)
-                                    utils.stdinfo.flush()
-                                makeLock = False
-                                break
-                                
-                            msg += ": %s" % (reason)
-                            if i == ntry:
-                                raise RuntimeError(msg)
-                            else:
-                                print >> utils.stdinfo, "%s; retrying" % msg
-                                utils.stdinfo.flush()
-
-                                time.sleep(dt)
-                                continue
-                    else:
-                        if not os.path.exists(lockDir):
-                            if verbose:
-                                print >> utils.stdwarn, "Unable to lock %s; proceeding with trepidation" % d
-                            return []
-
-                if not makeLock:
-                    continue
-
-                if verbose > 2:
-                    print >> utils.stdinfo, "Creating lock directory %s" % (lockDir)
-                #
-                # OK, the lock directory exists.
-                #
-                # If we're a shared lock, we need to check that no-one holds an exclusive lock (or, if someone
-                # does hold the lock, that we're the holder's child)
-                #
-                # N.b. the check isn't atomic, but that's conservative (we don't care if the exclusive lock's
-                # dropped while we're pondering its existence)
-                #
-                lockers = listLockers(lockDir, "exclusive*")
-                if len(lockers) > 0:
-                    if len(lockers) == 1 and \
-                       os.environ.get("EUPS_LOCK_PID", "-1") == \
-                       listLockers(lockDir, "exclusive*", getPids=True)[0]:
-                        pass
-                    else:
-                        raise RuntimeError(("Unable to take shared lock on %s: " +
-                                            "an exclusive lock is held by %s") % (d, " ".join(lockers)))
+        lockMethod = hooks.config.site.lockMethod
+        if lockMethod not in ("fcntl", "mkdir"):
+            raise RuntimeError("hooks.config.site.lockMethod must be \"fcntl\" or \"mkdir\", not \"%s\"" %
+                               lockMethod)
+        if lockMethod == "fcntl" and fcntl is None:
+            raise RuntimeError("hooks.config.site.lockMethod is \"fcntl\", but fcntl locks are not available")
+
+        if timeout is None:
+            timeout = hooks.config.site.lockTimeout
+
+        granularity = hooks.config.site.lockGranularity
+        if granularity not in ("stack", "product"):
+            raise RuntimeError("hooks.config.site.lockGranularity must be \"stack\" or \"product\", not \"%s\"" %
+                               granularity)
+
+        targets = [(d, lockType) for d in path]
+        if products and lockType == LOCK_EX and granularity == "product":
+            targets = [(d, LOCK_SH) for d in path]
+            for d in path:
+                for p in products:
+                    productLockDir = os.path.join(d, _productLocks, p)
+                    try:
+                        os.makedirs(getLockPath(productLockDir))
+                    except OSError:
+                        pass            # it already exists, or we'll fail to lock it
+
+                    targets.append((productLockDir, LOCK_EX))
+
+        for d, lockType in targets:
+            stats = dict(dir=d, cmd=cmdName, type=lockType, retries=0)
+            t0 = time.time()
+
+            lock = None
+            try:
+                if lockMethod == "fcntl":
+                    lock = _takeFcntlLock(cmdName, d, lockType, timeout, verbose, stats)
+                else:
+                    lock = _takeMkdirLock(d, lockType, ntry, verbose, stats)
+            except RuntimeError:
+                stats["wait"] = time.time() - t0
+                _recordStats(stats, None)
+                raise
+
+            if lock is None:
+                continue
 
-                break                   # got the lock
+            stats["acquired"] = time.time()
+            stats["wait"] = stats["acquired"] - t0
+            lock += (stats,)
 
-            if not makeLock:
-                continue
-            
             if not os.environ.has_key("EUPS_LOCK_PID"): # remember the PID of the process taking the lock
                 os.environ["EUPS_LOCK_PID"] = "%d" % os.getpid()
                 os.putenv("EUPS_LOCK_PID", os.environ["EUPS_LOCK_PID"])
-            #
-            #
-            # Create a file in it
-            #
-            import pwd
-            who = pwd.getpwuid(os.geteuid())[0]
-            pid = os.getpid()
-
-            lockFile = "%s-%s.%d" % (lockTypeName, who, pid)
-
-            try:
-                fd = os.open(os.path.join(lockDir, lockFile), os.O_EXCL | os.O_RDWR | os.O_CREAT)
-                os.close(fd)
-            except OSError, e:
-                if e.errno != errno.EEXIST:
-                    # should not occur
-                    raise
 
-            locks.append((lockDir, lockFile))
-
-            if verbose > 3:
-                print >> utils.stdinfo, "Creating lockfile %s" % (os.path.join(lockDir, lockFile))
+            locks.append(lock)
     #
     # Cleanup, even in the event of the user being rude enough to use kill
     #
@@ -159,18 +159,347 @@ def takeLocks(cmdName, path, lockType, nolocks=False, ntry=10, verbose=0):
     import atexit
     atexit.register(cleanup)            # regular exit
 
-    import signal
     signal.signal(signal.SIGINT, cleanup) # user killed us
     signal.signal(signal.SIGTERM, cleanup)
 
     return locks
 
+def _takeMkdirLock(d, lockType, ntry, verbose, stats):
+    """
+    Take a lock on directory d by making a lock directory, and a file in it describing the lock,
+    returning the (directory, file) or None if no lock was taken.  The number of retries is
+    counted in stats["retries"]
+    """
+    if lockType == LOCK_EX:
+        lockTypeName = "exclusive"
+    else:
+        lockTypeName = "shared"
+
+    dt = 1.0                        # number of seconds to wait
+    for i in range(1, ntry + 1):
+        try:
+            lockDir = os.path.join(getLockPath(d), _lockDir)
+            getLockPath(d, create=True)
+
+            os.mkdir(lockDir)
+        except OSError, e:
+            if lockType == LOCK_EX:
+                lockPids = listLockers(lockDir, getPids=True)
+                if len(lockPids) == 1 and lockPids[0] == os.environ.get("EUPS_LOCK_PID", "-1"):
+                    pass        # OK, there's a lock but we know about it
+                    if verbose:
+                        print >> utils.stdinfo, "Lock is held by a parent, PID %s" % lockPids[0]
+                else:
+                    if e.errno == errno.EEXIST:
+                        reason = "locks are held by %s" % " ".join(listLockers(lockDir))
+                    else:
+                        reason = str(e)
+
+                    msg = "Unable to take exclusive lock on %s" % (d)
+                    if e.errno == errno.EACCES:
+                        if verbose >= 0:
+                            print >> utils.stdinfo, "%s; your command may fail" % (msg)
+                            utils.stdinfo.flush()
+                        return None
+
+                    msg += ": %s" % (reason)
+                    if i == ntry:
+                        raise RuntimeError(msg)
+                    else:
+                        print >> utils.stdinfo, "%s; retrying" % msg
+                        utils.stdinfo.flush()
+
+                        stats["retries"] += 1
+                        time.sleep(dt)
+                        continue
+            else:
+                if not os.path.exists(lockDir):
+                    if verbose:
+                        print >> utils.stdwarn, "Unable to lock %s; proceeding with trepidation" % d
+                    return None
+
+        if verbose > 2:
+            print >> utils.stdinfo, "Creating lock directory %s" % (lockDir)
+        #
+        # OK, the lock directory exists.
+        #
+        # If we're a shared lock, we need to check that no-one holds an exclusive lock (or, if someone
+        # does hold the lock, that we're the holder's child)
+        #
+        # N.b. the check isn't atomic, but that's conservative (we don't care if the exclusive lock's
+        # dropped while we're pondering its existence)
+        #
+        lockers = listLockers(lockDir, "exclusive*")
+        if len(lockers) > 0:
+            if len(lockers) == 1 and \
+               os.environ.get("EUPS_LOCK_PID", "-1") == \
+               listLockers(lockDir, "exclusive*", getPids=True)[0]:
+                pass
+            else:
+                raise RuntimeError(("Unable to take shared lock on %s: " +
+                                    "an exclusive lock is held by %s") % (d, " ".join(lockers)))
+
+        break                   # got the lock
+    #
+    # Create a file in it
+    #
+    import pwd
+    who = pwd.getpwuid(os.geteuid())[0]
+    pid = os.getpid()
+
+    lockFile = "%s-%s.%d" % (lockTypeName, who, pid)
+
+    try:
+        fd = os.open(os.path.join(lockDir, lockFile), os.O_EXCL | os.O_RDWR | os.O_CREAT)
+        os.close(fd)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            # should not occur
+            raise
+
+    if verbose > 3:
+        print >> utils.stdinfo, "Creating lockfile %s" % (os.path.join(lockDir, lockFile))
+
+    return (lockDir, lockFile)
+
+def _takeFcntlLock(cmdName, d, lockType, timeout, verbose, stats):
+    """
+    Take an fcntl lock on directory d, waiting up to timeout seconds for other processes to release
+    it, returning (lockFile, None), or None if no lock was taken.  Raise RuntimeError if the lock
+    can't be taken (including if the filesystem doesn't support fcntl locks, or the lock server
+    is overloaded).  If we had to wait, stats["retries"] is incremented
+    """
+    if lockType == LOCK_EX:
+        lockTypeName, op = "exclusive", fcntl.LOCK_EX
+    else:
+        lockTypeName, op = "shared", fcntl.LOCK_SH
+
+    lockFile = os.path.join(getLockPath(d), _lockFile)
+    #
+    # Do we already hold this lock?  If so we mustn't open the file again
+    #
+    held = _fcntlLocks.get((os.getpid(), lockFile))
+    if held:
+        if lockType == LOCK_EX and held[1] != LOCK_EX:
+            try:
+                upgraded = _tryLockf(held[0], op)
+                if not upgraded:
+                    stats["retries"] += 1
+                    upgraded = _lockf(held[0], op, timeout)
+            except IOError, e:
+                raise RuntimeError("Unable to take exclusive lock on %s: %s" % (d, e))
+            if not upgraded:
+                raise RuntimeError("Unable to take exclusive lock on %s: shared locks are held" % (d))
+            held[1] = LOCK_EX
+            _recordHolder(held[0], cmdName)
+
+        held[2] += 1
+        return (lockFile, None)
+
+    try:
+        getLockPath(d, create=True)
+        fd = os.open(lockFile, os.O_RDWR | os.O_CREAT, 0666)
+    except OSError, e:
+        fd = None
+        if lockType == LOCK_SH and os.path.exists(lockFile):
+            try:
+                fd = os.open(lockFile, os.O_RDONLY) # enough for a shared lock
+            except OSError:
+                pass
+
+        if fd is None:
+            if lockType == LOCK_SH:
+                if verbose:
+                    print >> utils.stdwarn, "Unable to lock %s; proceeding with trepidation" % d
+                return None
+
+            msg = "Unable to take exclusive lock on %s" % (d)
+            if e.errno in (errno.EACCES, errno.EROFS):
+                if verbose >= 0:
+                    print >> utils.stdinfo, "%s; your command may fail" % (msg)
+                    utils.stdinfo.flush()
+                return None
+
+            raise RuntimeError("%s: %s" % (msg, e))
+
+    fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+    try:
+        try:
+            if not _lockf(fd, op, 0):
+                holder = _readHolder(fd)
+                if holder and holder[1] == os.environ.get("EUPS_LOCK_PID"):
+                    if verbose > 0:
+                        print >> utils.stdinfo, "Lock is held by a parent, PID %s" % holder[1]
+                    os.close(fd)
+                    return None
+
+                reason = "locks are held by %s" % " ".join(_fcntlLockers(holder))
+                if verbose >= 0:
+                    print >> utils.stdinfo, "Waiting for %s lock on %s: %s" % (lockTypeName, d, reason)
+                    utils.stdinfo.flush()
+
+                stats["retries"] += 1
+                if not _lockf(fd, op, timeout):
+                    raise RuntimeError("Unable to take %s lock on %s after %gs: %s" %
+                                       (lockTypeName, d, timeout, reason))
+        except IOError, e:
+            raise RuntimeError("Unable to take %s lock on %s: %s" % (lockTypeName, d, e))
+    except:
+        os.close(fd)
+        raise
+
+    if lockType == LOCK_EX:
+        _recordHolder(fd, cmdName)
+
+    if verbose > 3:
+        print >> utils.stdinfo, "Taking %s lock on %s" % (lockTypeName, lockFile)
+
+    _fcntlLocks[(os.getpid(), lockFile)] = [fd, lockType, 1]
+
+    return (lockFile, None)
+
+def _giveFcntlLock(lockFile, verbose=0):
+    """Give up a lock taken by _takeFcntlLock()"""
+    held = _fcntlLocks.get((os.getpid(), lockFile))
+    if not held:
+        return
+
+    held[2] -= 1
+    if held[2] > 0:
+        return
+
+    del _fcntlLocks[(os.getpid(), lockFile)]
+    fd, lockType = held[0], held[1]
+
+    if verbose > 2:
+        print >> utils.stdinfo, "Releasing lock on %s" % (lockFile)
+
+    try:
+        if lockType == LOCK_EX:
+            os.ftruncate(fd, 0)         # we're no longer the holder
+        fcntl.lockf(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+def _lockf(fd, op, timeout):
+    """
+    Apply fcntl.lockf(fd, op), waiting at most timeout seconds for the lock (for ever if timeout
+    is None or negative).  Return True if the lock was acquired
+    """
+    if _tryLockf(fd, op):
+        return True
+
+    if timeout == 0:
+        return False
+
+    if timeout is None or timeout < 0:
+        _blockingLockf(fd, op)
+        return True
+    #
+    # Block in lockf with a timer set to interrupt it.  Only the main thread can set signal
+    # handlers, and we mustn't steal SIGALRM from someone else, so otherwise we have to poll
+    #
+    if signal.getsignal(signal.SIGALRM) == signal.SIG_DFL:
+        def expired(*args):
+            raise _LockTimeout()
+
+        try:
+            signal.signal(signal.SIGALRM, expired)
+        except ValueError:              # not the main thread
+            pass
+        else:
+            try:
+                try:
+                    signal.setitimer(signal.ITIMER_REAL, timeout)
+                    _blockingLockf(fd, op)
+                    return True
+                finally:
+                    signal.setitimer(signal.ITIMER_REAL, 0)
+                    signal.signal(signal.SIGALRM, signal.SIG_DFL)
+            except _LockTimeout:
+                return False
+
+    deadline = time.time() + timeout
+    dt = 0.01
+    while True:
+        now = time.time()
+        if now >= deadline:
+            return False
+        time.sleep(min(dt, deadline - now))
+        dt = min(2*dt, 0.5)
+
+        if _tryLockf(fd, op):
+            return True
+
+def _blockingLockf(fd, op):
+    """Apply fcntl.lockf(fd, op), waiting until the lock is ours even if a signal arrives"""
+    while True:
+        try:
+            fcntl.lockf(fd, op)
+            return
+        except IOError, e:
+            if e.errno != errno.EINTR:
+                raise
+
+def _tryLockf(fd, op):
+    """Try to apply fcntl.lockf(fd, op) without waiting;  return True if the lock was acquired"""
+    try:
+        fcntl.lockf(fd, op | fcntl.LOCK_NB)
+        return True
+    except IOError, e:
+        if e.errno in (errno.EACCES, errno.EAGAIN):
+            return False
+        if e.errno == errno.EDEADLK:
+            return False
+        raise
+
+def _recordHolder(fd, cmdName):
+    """Record the holder of the exclusive lock on fd in the lock file, in the style of listLockers()"""
+    import pwd
+    who = pwd.getpwuid(os.geteuid())[0]
+
+    os.ftruncate(fd, 0)
+    os.lseek(fd, 0, 0)
+    os.write(fd, "exclusive-%s.%d %s\n" % (who, os.getpid(), cmdName))
+
+_holderRe = re.compile(r"^exclusive-(\S+)\.(\d+)(?:\s+(.*))?")
+
+def _readHolder(fd):
+    """Return the (user, pid, command) recorded by _recordHolder(), or None"""
+    try:
+        os.lseek(fd, 0, 0)
+        mat = _holderRe.search(os.read(fd, 1024))
+    except OSError:
+        return None
+
+    if not mat:
+        return None
+
+    return mat.groups()
+
+def _fcntlLockers(holder):
+    """Describe the holders of an fcntl lock, given the exclusive holder (or None) from _readHolder()"""
+    if holder:
+        return ["[user=%s, pid=%s]" % holder[0:2]]
+    else:
+        return ["[shared]"]
+
 def giveLocks(locks, verbose=0):
-    """Give up all locks in the provided list of (directory, file)
+    """Give up all locks in the provided list of (directory, file, stats), as returned by takeLocks();
+    the list is emptied
 
-    If the directory ends up empty, it is removed
+    If the directory ends up empty, it is removed.  If file is None, d is the lock file of an fcntl lock
     """
-    for d, f in locks:
+    while locks:
+        d, f, stats = locks.pop()
+        if stats:
+            _recordStats(stats, time.time() - stats["acquired"])
+
+        if f is None:
+            _giveFcntlLock(d, verbose)
+            continue
+
         if not os.path.isdir(d):
             continue
 
@@ -186,10 +515,28 @@ def giveLocks(locks, verbose=0):
         if nlockFiles == 0:
             os.rmdir(d)
 
+def _lockedDirs(path):
+    """Return the directories in path, each followed by the directories of the locks on its products"""
+    dirs = []
+    for d in path:
+        dirs.append(d)
+
+        productLockDir = os.path.join(d, _productLocks)
+        try:
+            products = sorted(os.listdir(getLockPath(productLockDir)))
+        except OSError:
+            products = []
+        dirs += [os.path.join(productLockDir, p) for p in products]
+
+    return dirs
+
 def clearLocks(path, verbose=0, noaction=False):
-    """Remove all locks found in the directories listed in path"""
+    """Remove all locks found in the directories listed in path (including those on products)
+
+    Only lock directories need to be removed, as fcntl locks are released when their holders exit
+    """
     
-    for d in path:
+    for d in _lockedDirs(path):
         lockDir = os.path.join(getLockPath(d), _lockDir)
 
         if not os.path.isdir(lockDir):
@@ -207,15 +554,23 @@ def clearLocks(path, verbose=0, noaction=False):
                 print >> utils.stderr, "Unable to remove %s: %s" % (lockDir, e)                    
 
 def listLocks(path, verbose=0, noaction=False):
-    """List all locks found in the directories listed in path"""
+    """List all locks found in the directories listed in path (including those on products)"""
+
+    for d in _lockedDirs(path):
+        lockers = []
 
-    for d in path:
         lockDir = os.path.join(getLockPath(d), _lockDir)
+        if os.path.isdir(lockDir):
+            lockers += listLockers(lockDir)
 
-        if not os.path.isdir(lockDir):
+        lockFile = os.path.join(getLockPath(d), _lockFile)
+        if fcntl and os.path.exists(lockFile):
+            lockers += listFcntlLockers(lockFile)
+
+        if not lockers:
             continue
 
-        print "%-30s %s" % (d + ":", " ".join(listLockers(lockDir)))
+        print "%-30s %s" % (d + ":", " ".join(lockers))
 
 def listLockers(lockDir, globPattern="*", getPids=False):
     """List all the owners of locks in a lockDir"""
@@ -228,3 +583,197 @@ def listLockers(lockDir, globPattern="*", getPids=False):
             lockers.append("[user=%s, pid=%s]" % (who, pid))
 
     return lockers
+
+def listFcntlLockers(lockFile):
+    """List the owners of the fcntl lock on lockFile.  Only the holder of an exclusive lock is known;
+    if shared locks are held, they are listed as "[shared]"
+    """
+    held = _fcntlLocks.get((os.getpid(), lockFile))
+    if held:                            # we can't test our own locks (and closing the file would drop them)
+        import pwd
+        return ["[user=%s, pid=%d]" % (pwd.getpwuid(os.geteuid())[0], os.getpid())]
+
+    try:
+        fd = os.open(lockFile, os.O_RDWR)
+        canWrite = True
+    except OSError:
+        try:
+            fd = os.open(lockFile, os.O_RDONLY)
+            canWrite = False
+        except OSError:
+            return []
+
+    try:
+        try:
+            if not _tryLockf(fd, fcntl.LOCK_SH):
+                return _fcntlLockers(_readHolder(fd))
+            if canWrite and not _tryLockf(fd, fcntl.LOCK_EX):
+                return _fcntlLockers(None)
+        except IOError:
+            pass
+    finally:
+        os.close(fd)                    # releases our locks
+
+    return []
+
+def _recordStats(stats, hold):
+    """
+    Append a record of a lock's use to the stats file in its directory, given the stats from
+    takeLocks() and the number of seconds that the lock was held (None if we failed to get it).
+    The file is trimmed to the last hooks.config.site.lockStatsSize records.  This is best effort:
+    if the stats file can't be written (or locked) the record is dropped
+    """
+    size = hooks.config.site.lockStatsSize
+    if not size or size <= 0 or fcntl is None:
+        return
+
+    if stats["type"] == LOCK_EX:
+        lockTypeName = "exclusive"
+    else:
+        lockTypeName = "shared"
+
+    if hold is None:
+        hold = "-"
+    else:
+        hold = "%.6f" % hold
+
+    import pwd
+    who = pwd.getpwuid(os.geteuid())[0]
+
+    statsFile = os.path.join(getLockPath(stats["dir"]), _lockStats)
+    try:
+        # Appending isn't atomic on all filesystems (e.g. NFS emulates O_APPEND in the client), and
+        # records mustn't be added while the file's being trimmed, so hold an fcntl lock on the file
+        # while we modify it.  The file is trimmed in place, as anyone waiting for the lock would
+        # otherwise go on to write to a file that we'd just replaced
+        fd = os.open(statsFile, os.O_RDWR | os.O_CREAT, 0666)
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+
+            os.lseek(fd, 0, os.SEEK_END)
+            os.write(fd, "%.3f %s %s %d %.6f %s %d %s\n" % (time.time(), lockTypeName, who, os.getpid(),
+                                                           stats["wait"], hold, stats["retries"],
+                                                           stats["cmd"]))
+            nbyte = os.fstat(fd).st_size
+
+            if nbyte > 2*80*size:        # records are typically shorter than 80 bytes
+                os.lseek(fd, 0, os.SEEK_SET)
+                records = os.read(fd, nbyte).splitlines(True)
+                if len(records) > size:
+                    data = "".join(records[-size:])
+                    os.lseek(fd, 0, os.SEEK_SET)
+                    os.write(fd, data)
+                    os.ftruncate(fd, len(data))
+        finally:
+            os.close(fd)                # releases the lock
+    except (IOError, OSError):
+        pass                            # we're not allowed to write there (or lock it); never mind
+
+def readLockStats(dirName):
+    """
+    Return the records of the use of the locks on dirName, as a list of dicts with keys
+    time, type ("shared" or "exclusive"), user, pid, wait, hold, retries and cmd.  Times
+    are in seconds, and hold is None if the lock couldn't be taken
+    """
+    records = []
+    try:
+        fd = open(os.path.join(getLockPath(dirName), _lockStats))
+    except IOError:
+        return records
+
+    try:
+        if fcntl is not None:
+            try:
+                fcntl.lockf(fd.fileno(), fcntl.LOCK_SH) # don't read it while it's being trimmed
+            except IOError:
+                pass
+
+        for line in fd:
+            fields = line.split(None, 7)
+            if len(fields) != 8:
+                continue
+            try:
+                if fields[5] == "-":
+                    hold = None
+                else:
+                    hold = float(fields[5])
+
+                records.append(dict(time=float(fields[0]), type=fields[1], user=fields[2],
+                                    pid=int(fields[3]), wait=float(fields[4]), hold=hold,
+                                    retries=int(fields[6]), cmd=fields[7].strip()))
+            except ValueError:
+                continue                # a corrupted record
+    finally:
+        fd.close()
+
+    return records
+
+def _percentile(values, p):
+    """Return the p'th percentile of the sorted list values"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(p/100.0*len(values)))]
+
+def listLockStats(path, top=10, verbose=0):
+    """
+    Summarize the use of the locks in the directories listed in path: how long commands waited for,
+    and held, shared and exclusive locks (and locks on individual products), and the commands that held
+    them longest
+    """
+    for d in path:
+        records = readLockStats(d)
+        for productLockDir in _lockedDirs([d])[1:]:
+            for r in readLockStats(productLockDir):
+                r["type"] = "product"
+                records.append(r)
+        if not records:
+            continue
+        records.sort(key=lambda r: r["time"])
+
+        print "%s: %d locks taken between %s and %s" % (d, len(records),
+                                                        time.strftime("%Y-%m-%d %H:%M:%S",
+                                                                      time.localtime(records[0]["time"])),
+                                                        time.strftime("%Y-%m-%d %H:%M:%S",
+                                                                      time.localtime(records[-1]["time"])))
+
+        percentiles = (50, 90, 99, 100)
+        print "  %-9s %6s %6s %7s   wait (s)%s   hold (s)%s" % \
+              ("lock", "count", "failed", "retries",
+               "".join(["%7s" % ("p%d" % p) for p in percentiles[:-1]]) + "%7s" % "max",
+               "".join(["%7s" % ("p%d" % p) for p in percentiles[:-1]]) + "%7s" % "max")
+        for lockTypeName in ("shared", "exclusive", "product"):
+            recs = [r for r in records if r["type"] == lockTypeName]
+            if not recs:
+                continue
+
+            waits = sorted([r["wait"] for r in recs])
+            holds = sorted([r["hold"] for r in recs if r["hold"] is not None])
+
+            print "  %-9s %6d %6d %7d   %8s%s   %8s%s" % \
+                  (lockTypeName, len(recs), len(recs) - len(holds), sum([r["retries"] for r in recs]),
+                   "", "".join(["%7.3f" % _percentile(waits, p) for p in percentiles]),
+                   "", "".join(["%7.3f" % _percentile(holds, p) for p in percentiles]))
+        #
+        # Who held the locks longest?
+        #
+        holders = {}
+        for r in records:
+            if r["hold"] is None:
+                continue
+            key = (r["cmd"], r["type"])
+            if not holders.has_key(key):
+                holders[key] = [0, 0.0, 0.0, 0.0]  # count, total hold, max hold, total wait
+            h = holders[key]
+            h[0] += 1
+            h[1] += r["hold"]
+            h[2] = max(h[2], r["hold"])
+            h[3] += r["wait"]
+
+        if holders:
+            print "  %-24s %-9s %6s %10s %10s %10s" % ("command", "lock", "count",
+                                                      "hold (s)", "max hold", "mean wait")
+            keys = sorted(holders.keys(), key=lambda k: -holders[k][1])
+            for cmd, lockTypeName in keys[:top]:
+                count, hold, maxHold, wait = holders[(cmd, lockTypeName)]
+                print "  %-24s %-9s %6d %10.2f %10.2f %10.2f" % (cmd, lockTypeName, count,
+                                                                  hold, maxHold, wait/count)
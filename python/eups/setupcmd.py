@@ -16,10 +16,14 @@ The output of run() is a status code appropriate for passing to sys.exit().
 import os, sys, glob, re
 from cmd import EupsOptionParser
 from exceptions import EupsException
+from Product import Product
 import eups
 import lock
+import snapshot
 import hooks
 import utils
+from TableCache import getTableCache
+from TableRegistry import getTableRegistry
 
 def append_current(option, opt_str, value, parser):
     """Add "current" to values.tag;  would use append_const but that's not in python 2.4"""
@@ -34,7 +38,7 @@ class EupsSetup(object):
 
     """
 
-    usage = "%prog [-h|--help|-V|--version] [options] [product [version]]"
+    usage = "%prog [-h|--help|-V|--version] [options] [product [version] | product[:version] ...]"
 
     # set this to True if the description is preformatted.  If false, it 
     # will be automatically reformatted to fit the screen
@@ -43,6 +47,8 @@ class EupsSetup(object):
     description = \
 """(Un)Setup an EUPS-managed product.  This will "load" (or "unload") the 
 product and all its dependencies into the environment so that it can be used.
+Several products may be (un)setup together by listing them as product[:version]; this is
+faster than setting them up one by one, as their common dependencies are only looked up once.
 """
 
     def __init__(self, args=None, toolname=None):
@@ -115,6 +121,10 @@ product and all its dependencies into the environment so that it can be used.
                             help="deprecated (use 'eups list')")
         self.clo.add_option("-m", "--table", dest="tablefile", action="store", default=None,
                             help="Use this table file")
+        self.clo.add_option("--from-snapshot", dest="fromSnapshot", action="store", metavar="FILE",
+                            help="Use the environment saved by --save-snapshot if it's still current")
+        self.clo.add_option("--save-snapshot", dest="saveSnapshot", action="store", metavar="FILE",
+                            help="Save the resulting environment for use with --from-snapshot")
         self.clo.add_option("-S", "--max-depth", dest="max_depth", action="store", type="int", default=-1,
                             help="Only show this many levels of dependencies (use with -v)")
         self.clo.add_option("-n", "--noaction", dest="noaction", action="store_true", default=False,
@@ -146,10 +156,33 @@ product and all its dependencies into the environment so that it can be used.
 
     def execute(self):
         productName = versionName = None
-        if len(self.args) > 0:
-            productName = self.args[0]
-        if len(self.args) > 1:
-            versionName = self.args[1]
+        products = []                   # (productName, versionName) for each product, if there's more than one
+        #
+        # "setup product version" is still allowed, so we only have a list of products if there are more
+        # than two or if one's written as product:version (but versions may look like "LOCAL:dir")
+        #
+        specs = [a for a in self.args[:2] if ":" in a and not a.startswith(Product.LocalVersionPrefix)]
+        if len(self.args) > 2 or specs:
+            for spec in self.args:
+                if ":" in spec:
+                    name, version = spec.split(":", 1)
+                    products.append((name, version or None))
+                else:
+                    products.append((spec, None))
+
+            if len(products) == 1:
+                productName, versionName = products[0]
+                products = []
+            else:
+                for name, version in products:
+                    if version:
+                        versionName = version # used to choose the VRO
+                        break
+        else:
+            if len(self.args) > 0:
+                productName = self.args[0]
+            if len(self.args) > 1:
+                versionName = self.args[1]
 
         if self.opts.unsetup:
             cmdName = "unsetup"
@@ -171,7 +204,11 @@ product and all its dependencies into the environment so that it can be used.
             self.opts.exact_version = False
             self.opts.inexact_version = False
 
-        if self.opts.tablefile:         # we're setting up a product based only on a tablefile
+        if products:
+            if self.opts.tablefile or self.opts.productDir:
+                self.err("You may not specify --table or --root with more than one product")
+                return 3
+        elif self.opts.tablefile:       # we're setting up a product based only on a tablefile
             if self.opts.unsetup:
                 self.err("Ignoring --table as I'm unsetting up a product")
                 self.opts.tablefile = None
@@ -187,7 +224,7 @@ product and all its dependencies into the environment so that it can be used.
                     self.opts.productDir = os.path.dirname(self.opts.tablefile)
                     productName = os.path.splitext(os.path.basename(self.opts.tablefile))[0]
 
-        if not self.opts.productDir and not productName:
+        if not self.opts.productDir and not productName and not products:
             self.err("please specify at least a product name or use -r")
             print >> utils.stderr, self.clo.get_usage()
             return 3
@@ -207,7 +244,7 @@ product and all its dependencies into the environment so that it can be used.
                     e.status = 4
                     raise
 
-        if not productName:
+        if not productName and not products:
             self.err("Please specify a product")
             print >> utils.stderr, self.clo.get_usage()
             return 3
@@ -218,18 +255,35 @@ product and all its dependencies into the environment so that it can be used.
                 return 3
             self.opts.max_depth = 0
 
+        request = self._snapshotRequest() # n.b. before the default tags are added to the options
+        if self.opts.fromSnapshot:
+            cmds, reason = snapshot.load(self.opts.fromSnapshot, request)
+            if cmds is not None:
+                if self.opts.verbose > 3:
+                    print >> sys.stderr, "\n\t".join(["Issuing commands from %s:" % self.opts.fromSnapshot] + cmds)
+                print ";\n".join(cmds)
+                return 0
+
+            self.err("Not using snapshot: %s" % reason, volume=1)
+
+        # With snapshotReads we don't wait for writers, but read a consistent snapshot from the product caches
+        snapshotReads = hooks.config.site.snapshotReads
+
         path = eups.Eups.setEupsPath(self.opts.path, self.opts.dbz)
-        locks = lock.takeLocks("setup", path, lock.LOCK_SH,
-                               nolocks=self.opts.nolocks, verbose=self.opts.verbose - self.opts.quiet)
+        locks = lock.takeLocks("setup", path, lock.LOCK_SH, nolocks=self.opts.nolocks or snapshotReads,
+                               verbose=self.opts.verbose - self.opts.quiet)
         #
         # Do the work
         #
         status = 0
         try:
             try:
+                # Only use the product caches if they're known to be up to date; otherwise read the database
+                readCache = hooks.config.Eups.setupUsesCache or snapshotReads
+                validateCache = readCache and not snapshotReads
                 Eups = eups.Eups(flavor=self.opts.flavor, path=self.opts.path, 
                                  dbz=self.opts.dbz, # root=self.opts.productDir, 
-                                 readCache=False, force=self.opts.force,
+                                 readCache=readCache, validateCache=validateCache, force=self.opts.force,
                                  quiet=self.opts.quiet, verbose=self.opts.verbose, 
                                  noaction=self.opts.noaction, keep=self.opts.keep, 
                                  ignore_versions=self.opts.ignoreVer, setupType=self.opts.setupType,
@@ -275,9 +329,13 @@ product and all its dependencies into the environment so that it can be used.
                 else:
                     tablefile=self.opts.tablefile
 
-                cmds = eups.setup(productName, versionName, self.opts.tag, self.opts.productDir,
-                                  Eups, fwd=not self.opts.unsetup, tablefile=tablefile,
-                                  postTags=self.opts.postTag)
+                if products:
+                    cmds = eups.setupProducts(products, self.opts.tag, Eups, fwd=not self.opts.unsetup,
+                                              postTags=self.opts.postTag)
+                else:
+                    cmds = eups.setup(productName, versionName, self.opts.tag, self.opts.productDir,
+                                      Eups, fwd=not self.opts.unsetup, tablefile=tablefile,
+                                      postTags=self.opts.postTag)
 
             except EupsException, e:
                 e.status = 1
@@ -289,12 +347,42 @@ product and all its dependencies into the environment so that it can be used.
             lock.giveLocks(locks, self.opts.verbose)
 
         if Eups.verbose > 3:
+            print >> sys.stderr, "VRO searches: %d remembered, %d made" % (Eups.vroMemoHits, Eups.vroMemoMisses)
+            tableCache = getTableCache()
+            if tableCache:
+                print >> sys.stderr, "Parsed table files: %(hits)d found, %(misses)d parsed, %(stores)d saved" % \
+                      tableCache.stats()
+            print >> sys.stderr, "Tables shared between products: %(hits)d reused, %(misses)d read, %(evictions)d evicted" % \
+                  getTableRegistry().stats()
             print >> sys.stderr, "\n\t".join(["Issuing commands:"] + cmds)
 
+        if self.opts.saveSnapshot:
+            if Eups.noaction:
+                self.err("Not saving a snapshot as --noaction was specified")
+            elif "false" in cmds:
+                self.err("Not saving a snapshot as setup failed")
+            else:
+                reason = snapshot.save(self.opts.saveSnapshot, cmds, request, Eups)
+                if reason:
+                    self.err("Unable to save snapshot: %s" % reason)
+
         print ";\n".join(cmds)
 
         return status
 
+    def _snapshotRequest(self):
+        # what setup's been asked to do, which must match for a snapshot to be used (see snapshot.load())
+        request = dict(args=self.args)
+        for k in ("dbz", "exact_version", "flavor", "force", "ignoreVer", "inexact_version", "keep",
+                  "max_depth", "path", "postTag", "productDir", "setupType", "tablefile", "tag", "unsetup",
+                  "vro",):
+            value = getattr(self.opts, k)
+            if isinstance(value, list):
+                value = value[:]
+            request[k] = value
+
+        return request
+
     def err(self, msg, volume=0):
         """
         print an error message to standard error.  The message will only 
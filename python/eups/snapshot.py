@@ -0,0 +1,176 @@
+"""
+Snapshots of the environment changes made by setup, so that the same setup
+can be repeated without looking anything up (see setup --save-snapshot and
+--from-snapshot).
+
+A snapshot holds the shell commands that setup issued, the request that
+produced them and a fingerprint of everything that the result depends on:
+the starting values of the variables that setup reads or changes, the
+generation counts of the databases (see Database.getGeneration()), the
+table files of the products that were setup and the user's
+customizations.  Checking the fingerprint only needs a few stat() calls,
+so a current snapshot is much cheaper to use than repeating the setup; a
+snapshot that is out of date is simply not used.
+"""
+import os, re, time, cPickle
+
+import hooks
+import utils
+from utils import mtimeResolution
+from db import Database
+
+# Bump this whenever the contents of a snapshot change
+snapshotVersion = 1
+
+def save(file, cmds, request, eupsenv):
+    """
+    save a snapshot of a setup that has just been carried out (so that
+    os.environ holds its results), returning None, or the reason why the
+    setup couldn't be saved
+    @param file      the file to write
+    @param cmds      the commands issued by setup
+    @param request   what setup was asked to do, e.g. the command line
+                       options and arguments.  The snapshot will only be
+                       used for the same request.
+    @param eupsenv   the Eups instance used to do the setup
+    """
+    created = time.time()
+    #
+    # The variables that setup changed, and those that affect what it does
+    #
+    setupEnvPrefix = utils.setupEnvPrefix()
+    changed = []
+    for key in set(os.environ.keys() + eupsenv.oldEnviron.keys()):
+        if os.environ.get(key) != eupsenv.oldEnviron.get(key):
+            changed.append(key)
+    environ = _contextEnviron(eupsenv.oldEnviron, changed)
+    #
+    # The databases
+    #
+    generations = {}
+    for p in eupsenv.path:
+        dbroots = [eupsenv.getUpsDB(p)]
+        userCacheDir = eupsenv._userStackCache(p)
+        if userCacheDir:
+            dbroots.append(userCacheDir)
+
+        for dbroot in dbroots:
+            if os.path.isdir(dbroot):
+                generations[dbroot] = Database(dbroot).getGeneration()
+            else:
+                generations[dbroot] = False # it mustn't appear
+    #
+    # Files whose modification times we need to check: the table files of the products that we setup,
+    # and the customizations (including those that could appear in the customization directories)
+    #
+    files = []
+    for key in changed:
+        if not key.startswith(setupEnvPrefix) or not os.environ.get(key):
+            continue
+
+        product = eupsenv.findSetupProduct(os.environ[key].split()[0])
+        if product and product.tablefile and product.tablefile != "none":
+            files.append(product.tablefile)
+
+    for dir in getattr(hooks, "customisationDirs", None) or []:
+        files.append(os.path.join(dir, hooks.customisationFilename or hooks.config.Eups.startupFileName))
+    files += getattr(hooks, "customisationFiles", None) or []
+
+    mtimes = {}
+    for f in files:
+        mtimes[f] = _mtime(f)
+
+    snapshot = dict(version=snapshotVersion, request=request, created=created, environ=environ,
+                    generations=generations, mtimes=mtimes, cmds=cmds)
+
+    tmpfile = "%s.%d" % (file, os.getpid())
+    try:
+        fd = open(tmpfile, "w")
+        try:
+            cPickle.dump(snapshot, fd, protocol=2)
+        finally:
+            fd.close()
+        os.rename(tmpfile, file)
+    except (IOError, OSError, cPickle.PicklingError), e:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        return str(e)
+
+    return None
+
+def load(file, request):
+    """
+    return the commands saved in a snapshot if they are still what setup
+    would issue, otherwise None.  The reason that they can't be used is
+    also returned (or None), so the return value is a tuple (cmds, reason)
+    @param file      the file written by save()
+    @param request   what setup is being asked to do (see save())
+    """
+    try:
+        fd = open(file)
+        try:
+            snapshot = cPickle.load(fd)
+        finally:
+            fd.close()
+    except (IOError, OSError, EOFError, ValueError, TypeError, AttributeError, ImportError,
+            cPickle.UnpicklingError), e:
+        return None, "unable to read %s: %s" % (file, e)
+
+    reason = _check(snapshot, request)
+    if reason:
+        return None, reason
+
+    return snapshot["cmds"], None
+
+def _check(snapshot, request):
+    # return the reason that snapshot can't be used for request, or None
+    if not isinstance(snapshot, dict) or snapshot.get("version") != snapshotVersion:
+        return "it was written by a different version of EUPS"
+
+    if snapshot["request"] != request:
+        return "it was saved for a different setup command"
+
+    environ = snapshot["environ"]
+    if _contextEnviron(os.environ, environ.keys()) != environ:
+        return "the environment has changed"
+
+    for dbroot, generation in snapshot["generations"].items():
+        if generation is False:
+            if os.path.isdir(dbroot):
+                return "%s has been created" % dbroot
+        elif generation is None:        # no generation is recorded, so check the files
+            if not os.path.isdir(dbroot) or \
+                   Database(dbroot).isNewerThan(snapshot["created"] - mtimeResolution):
+                return "%s has changed" % dbroot
+        elif Database(dbroot).getGeneration() != generation:
+            return "%s has changed" % dbroot
+
+    for f, mtime in snapshot["mtimes"].items():
+        if _mtime(f) != mtime:
+            return "%s has changed" % f
+        if mtime is not None and mtime > snapshot["created"] - mtimeResolution:
+            return "%s was modified just before the snapshot was saved" % f
+
+    return None
+
+def _contextEnviron(environ, keys):
+    # return the values in environ of the variables that affect setup (and of the given keys);
+    # None is used for keys that aren't set
+    contextRe = re.compile(r"^(%s|EUPS_)" % utils.setupEnvPrefix())
+
+    keys = set(keys)
+    keys.update([k for k in environ.keys() if contextRe.search(k)])
+    keys.add("HOME")
+    keys.discard("EUPS_LOCK_PID")       # set while we hold locks (see lock.takeLocks())
+
+    out = {}
+    for k in keys:
+        out[k] = environ.get(k)
+
+    return out
+
+def _mtime(file):
+    try:
+        return os.stat(file).st_mtime
+    except OSError:
+        return None
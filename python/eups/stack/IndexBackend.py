@@ -0,0 +1,349 @@
+"""
+storage formats ("index backends") for the per-flavor ProductStack cache.
+
+A ProductStack persists the product data for each flavor into its own
+cache file.  How that data is laid out on disk is delegated to an index
+backend; the available backends are:
+   PickleIndex   the original format: the whole flavor lookup is pickled
+                   into a single blob which must be read in its entirety.
+   SqliteIndex   products, versions, table paths and tag assignments are
+                   stored as indexed rows in an SQLite database so that a
+                   single product can be loaded without reading the rest
+                   of the stack.
+
+If the sqlite3 module is not available, requests for the "sqlite" backend
+will fall back to the pickle format.
+"""
+import os, re, cPickle
+from ProductFamily import ProductFamily
+from eups.utils import AtomicFile
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+# the version name for the persistence formats used by this implementation.
+# It is intended to match the version of EUPS when this format was introduced
+persistVersionName = "1.3.0"
+
+dotre = re.compile(r'\.')
+
+class PickleIndex(object):
+    """
+    persist the product lookup for a flavor as a single pickled dictionary
+    """
+    name = "pickle"
+
+    # the extension used for the cache files
+    persistFileExt = "pickleDB%s" % dotre.sub('_', persistVersionName)
+
+    # the regular expression for matching cache file names
+    persistFileRe = re.compile(r'^(\w\S*)\.%s$' % persistFileExt)
+
+    def persistFilename(self, flavor):
+        return "%s.%s" % (flavor, self.persistFileExt)
+
+    def save(self, flavorData, file, flavor=None, generations=None):
+        """
+        write the product lookup for a flavor to a file.
+        @param flavorData   a dictionary mapping product names to
+                              ProductFamily instances
+        @param file         the name of the file to write
+        @param flavor       the flavor of the products (unused)
+        @param generations  a dictionary giving the generation counts of
+                              the databases (keyed by path) that the data 
+                              reflects (see loadGenerations())
+        """
+        # a lazily loaded lookup must be fully realized before pickling
+        flavorData = dict(flavorData.items())
+
+        # The generations are kept in a separate file so that the cache
+        # can still be read by older versions of EUPS.  Remove it first
+        # so that it can never describe a different version of the cache.
+        genfile = self._generationsFile(file)
+        if os.path.exists(genfile):
+            os.remove(genfile)
+
+        # the files are replaced atomically, as they may be read by commands
+        # that don't take locks (see hooks.config.site.snapshotReads)
+        _atomicDump(flavorData, file)
+        if generations:
+            _atomicDump(generations, genfile)
+
+    def _generationsFile(self, file):
+        return file + ".generations"
+
+    def loadGenerations(self, file):
+        """
+        return the generation counts of the databases that the data in 
+        a cache file reflects as a dictionary keyed by the database path.  
+        An empty dictionary is returned if they were not recorded.
+        """
+        try:
+            fd = open(self._generationsFile(file))
+            try:
+                return cPickle.load(fd)
+            finally:
+                fd.close()
+        except (IOError, EOFError, cPickle.UnpicklingError):
+            return {}
+
+    def remove(self, file):
+        """
+        delete a cache file (and anything stored alongside it)
+        """
+        for f in [file, self._generationsFile(file)]:
+            if os.path.exists(f):
+                os.remove(f)
+
+    def load(self, file, flavor=None):
+        """
+        read the product lookup for a flavor from a file.
+        """
+        fd = open(file)
+        try:
+            return cPickle.load(fd)
+        finally:
+            fd.close()
+
+def _atomicDump(data, file):
+    # pickle data into a file, replacing it atomically
+    fd = AtomicFile(file)
+    try:
+        cPickle.dump(data, fd)
+    except:
+        fd.abort()
+        raise
+    fd.close()
+
+class SqliteIndex(PickleIndex):
+    """
+    persist the product lookup for a flavor as rows in an SQLite database.
+    The returned lookup loads a ProductFamily only when it is first
+    requested, so that finding a single product is a point query.
+    """
+    name = "sqlite"
+
+    persistFileExt = "sqliteDB%s" % dotre.sub('_', persistVersionName)
+    persistFileRe = re.compile(r'^(\w\S*)\.%s$' % persistFileExt)
+
+    schema = [
+        "CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)",
+        "CREATE TABLE versions (product TEXT NOT NULL, version TEXT NOT NULL,"
+        " dir TEXT, tablefile TEXT, tableData BLOB,"
+        " PRIMARY KEY (product, version))",
+        "CREATE TABLE tags (product TEXT NOT NULL, tag TEXT NOT NULL,"
+        " version TEXT NOT NULL, PRIMARY KEY (product, tag))",
+        "CREATE INDEX tagsByVersion ON tags (product, version)",
+        ]
+
+    def save(self, flavorData, file, flavor=None, generations=None):
+        # Write into a new file and move it into place: the data may be
+        # lazily loaded from the very file we are replacing, and readers
+        # should never see a partially written database.
+        flavorData = flavorData.items()
+
+        tmpfile = "%s.tmp%d" % (file, os.getpid())
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+
+        conn = _connect(tmpfile)
+        try:
+            for stmt in self.schema:
+                conn.execute(stmt)
+            conn.execute("INSERT INTO meta VALUES (?, ?)", ("version", persistVersionName))
+            conn.execute("INSERT INTO meta VALUES (?, ?)", ("flavor", flavor))
+            if generations:
+                for dbpath, generation in generations.items():
+                    conn.execute("INSERT INTO meta VALUES (?, ?)", 
+                                 ("generation:%s" % dbpath, str(generation)))
+
+            for name, family in flavorData:
+                for version, (installdir, tablefile, table) in family.versions.items():
+                    tableData = None
+                    if table is not None:
+                        tableData = sqlite3.Binary(cPickle.dumps(table, 2))
+                    conn.execute("INSERT INTO versions VALUES (?, ?, ?, ?, ?)",
+                                 (name, version, installdir, tablefile, tableData))
+                for tag, version in family.tags.items():
+                    conn.execute("INSERT INTO tags VALUES (?, ?, ?)", (name, tag, version))
+            conn.commit()
+        finally:
+            conn.close()
+
+        os.rename(tmpfile, file)
+
+    def load(self, file, flavor=None):
+        return SqliteFlavorLookup(file)
+
+    def loadGenerations(self, file):
+        out = {}
+        try:
+            conn = _connect(file)
+            try:
+                for key, value in conn.execute("SELECT key, value FROM meta WHERE key LIKE 'generation:%'"):
+                    out[key[len("generation:"):]] = int(value)
+            finally:
+                conn.close()
+        except (sqlite3.Error, ValueError):
+            return {}
+        return out
+
+    def remove(self, file):
+        if os.path.exists(file):
+            os.remove(file)
+
+class SqliteFlavorLookup(dict):
+    """
+    a product-name-to-ProductFamily dictionary backed by an SQLite cache
+    file.  Families are read from the file the first time they are looked
+    up; operations that need the whole flavor (keys(), values(), etc.)
+    read everything that has not been loaded yet.
+    """
+    def __init__(self, file):
+        dict.__init__(self)
+        self.file = file
+        self._conn = None
+        self._complete = False    # true when every product has been loaded
+        self._removed = set()     # products deleted since loading
+
+    def _cursor(self):
+        if self._conn is None:
+            self._conn = _connect(self.file)
+        return self._conn
+
+    def _loadFamily(self, name):
+        if self._complete or name in self._removed:
+            return None
+
+        conn = self._cursor()
+        rows = conn.execute("SELECT version, dir, tablefile, tableData FROM versions WHERE product = ?",
+                            (name,)).fetchall()
+        if not rows:
+            return None
+
+        family = ProductFamily(name)
+        for version, installdir, tablefile, tableData in rows:
+            family.addVersion(version, installdir, tablefile, _loadTable(tableData))
+        for tag, version in conn.execute("SELECT tag, version FROM tags WHERE product = ?", (name,)):
+            family.tags[tag] = version
+
+        dict.__setitem__(self, name, family)
+        return family
+
+    def _loadAll(self):
+        if self._complete:
+            return
+
+        conn = self._cursor()
+        families = {}
+        for name, version, installdir, tablefile, tableData in \
+                conn.execute("SELECT product, version, dir, tablefile, tableData FROM versions"):
+            if dict.has_key(self, name) or name in self._removed:
+                continue
+            if not families.has_key(name):
+                families[name] = ProductFamily(name)
+            families[name].addVersion(version, installdir, tablefile, _loadTable(tableData))
+        for name, tag, version in conn.execute("SELECT product, tag, version FROM tags"):
+            if families.has_key(name):
+                families[name].tags[tag] = version
+
+        for name, family in families.items():
+            dict.__setitem__(self, name, family)
+
+        self._complete = True
+        self._conn.close()
+        self._conn = None
+
+    def __missing__(self, name):
+        family = self._loadFamily(name)
+        if family is None:
+            raise KeyError(name)
+        return family
+
+    def has_key(self, name):
+        return dict.has_key(self, name) or self._loadFamily(name) is not None
+
+    __contains__ = has_key
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def __setitem__(self, name, family):
+        self._removed.discard(name)
+        dict.__setitem__(self, name, family)
+
+    def __delitem__(self, name):
+        self.has_key(name)
+        dict.__delitem__(self, name)
+        self._removed.add(name)
+
+    def keys(self):
+        # the names can be listed without loading the families
+        if self._complete:
+            return dict.keys(self)
+
+        names = dict.keys(self)
+        for (name,) in self._cursor().execute("SELECT DISTINCT product FROM versions"):
+            if not dict.has_key(self, name) and name not in self._removed:
+                names.append(name)
+        return names
+
+    def values(self):
+        self._loadAll()
+        return dict.values(self)
+
+    def items(self):
+        self._loadAll()
+        return dict.items(self)
+
+    def __reduce__(self):
+        # pickle (e.g. as part of a cached table) as a plain dictionary; the
+        # database connection cannot be restored in another process.
+        return (dict, (self.items(),))
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+def _connect(file):
+    conn = sqlite3.connect(file)
+    conn.text_factory = str     # the rest of eups expects str, not unicode
+    return conn
+
+def _loadTable(tableData):
+    if tableData is None:
+        return None
+    return cPickle.loads(str(tableData))
+
+# the available backends, by name.  Additional backends may be registered here.
+indexBackends = {
+    PickleIndex.name : PickleIndex,
+    SqliteIndex.name : SqliteIndex,
+    }
+
+def getIndexBackend(name=None):
+    """
+    return an instance of the named index backend.  If name is None, the
+    pickle backend is returned; the pickle backend is also returned if
+    the sqlite backend is requested but the sqlite3 module is unavailable.
+    @param name   the name of the backend (e.g. "pickle" or "sqlite"), or
+                    an index backend instance (which is returned as is)
+    """
+    if name is None:
+        name = PickleIndex.name
+    if not isinstance(name, str):
+        return name
+    if name == SqliteIndex.name and sqlite3 is None:
+        name = PickleIndex.name
+
+    try:
+        return indexBackends[name]()
+    except KeyError:
+        raise RuntimeError("Unknown product cache index backend: %s" % name)
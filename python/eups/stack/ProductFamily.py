@@ -4,6 +4,7 @@ from eups.Product import Product
 import eups.tags
 from eups.exceptions import ProductNotFound, TableFileNotFound
 from eups.table import Table
+from eups.VersionCompare import sortVersions
 
 class ProductFamily(object):
     """
@@ -35,6 +36,27 @@ class ProductFamily(object):
         """
         return self.versions.keys()
 
+    def getSortedVersions(self, versionCmp):
+        """
+        return a list of the version names in this product family, earliest
+        first in the order defined by versionCmp.  The list is remembered
+        until a version is added or removed, so the caller must not modify it.
+        @param versionCmp  the function used to compare two versions
+                             (e.g. hooks.version_cmp)
+        """
+        cached = getattr(self, "_sortedVersions", None)
+        if cached is None or cached[0] is not versionCmp:
+            vers = self.versions.keys()
+            sortVersions(vers, versionCmp)
+            cached = self._sortedVersions = (versionCmp, vers)
+        return cached[1]
+
+    def __getstate__(self):
+        # don't save the sorted list of versions (see getSortedVersions())
+        state = self.__dict__.copy()
+        state.pop("_sortedVersions", None)
+        return state
+
     def getProduct(self, version, dbpath=None, flavor=None):
         """
         return the Product of the requested version or None if not found.
@@ -138,6 +160,8 @@ class ProductFamily(object):
             msg = "Missing version name while registering new version " + \
                 "for product %s: %s"
             raise RuntimeError(msg % (self.name, version))
+        if version not in self.versions:
+            self._sortedVersions = None
         self.versions[version] = (installdir, tablefile, table)
 
     def hasVersion(self, version):
@@ -162,6 +186,7 @@ class ProductFamily(object):
             for tag in itsTags:
                 self.unassignTag(tag)
             del self.versions[version]
+            self._sortedVersions = None
             return True
         else:
             return False
@@ -2,21 +2,23 @@ import pwd, re, os, cPickle, sys
 from eups import utils
 from eups import Product
 from ProductFamily import ProductFamily
+from IndexBackend import persistVersionName, getIndexBackend, indexBackends
 from eups.exceptions import EupsException,ProductNotFound, UnderSpecifiedProduct
 from eups.db import Database
+from eups.VersionCompare import sortVersions
 
 # Issues:
 #  o  restoring from cache (when and how) 
 
-# the version name for the persistence format used by this implementation.
-# It is intended to match the version of EUPS when this format was introduced
-persistVersionName = "1.3.0"
-
 # the prefix to a tag name that labels it as a user tag.  Anything left over is 
 # considered a global tag.
 userPrefix = "user:"     
 
 dotre = re.compile(r'\.')
+
+# the number of times to reread a database that was modified while we were
+# reading it (see ProductStack.refreshFromDatabase())
+maxCrawlRetries = 3
 who = pwd.getpwuid(os.geteuid())[0]
 
 class ProductStack(object):
@@ -39,6 +41,10 @@ class ProductStack(object):
 
     Note that this class does not keep track of what are considered allowed 
     tag names.  The user of this class should manage this.  
+
+    The on-disk format of the cache is delegated to an index backend (see 
+    IndexBackend).  If a cache file in the requested format is not available,
+    one in the original pickle format will be used instead.
     """
     # static variable: version of Product stack cache, set to the EUPS 
     # version when the format was introduced
@@ -53,7 +59,8 @@ class ProductStack(object):
     # static variable: name of file extension to use to persist data
     userTagFileExt = "pickleTag%s" % dotre.sub('_', persistVersionName)
 
-    def __init__(self, dbpath, persistDir=None, autosave=True):
+    def __init__(self, dbpath, persistDir=None, autosave=True, 
+                 indexBackend=None, crawlThreads=1):
         """
         create the stack with a given database
         @param dbpath             the path to the ups_db directory
@@ -62,6 +69,12 @@ class ProductStack(object):
                                      directory.
         @param autosave           if true (default), all updates will be 
                                      saved to disk.
+        @param indexBackend       the name of the format to persist the 
+                                     cache in ("pickle" or "sqlite").  If
+                                     None, the pickle format is used.
+        @param crawlThreads       the number of threads to use to read the
+                                     database files when the stack is 
+                                     loaded directly from the database
         """
         # the path to the ups_db directory
         self.dbpath = dbpath
@@ -113,6 +126,19 @@ class ProductStack(object):
         # True if python is new enough to pickle the cache data
         self.canCache = utils.canPickle()
 
+        # the number of threads used by refreshFromDatabase()
+        self.crawlThreads = crawlThreads
+
+        # the format used to persist the cache
+        self.index = getIndexBackend(indexBackend)
+
+        # the generation counts of the databases (keyed by path) as they
+        # were before the product data was read from them, or None if not
+        # known.  A cache is stamped with these rather than the current
+        # counts (see persist()), as a database may be modified while it's
+        # being read.
+        self._readGenerations = None
+
 
     def getDbPath(self):
         """
@@ -165,6 +191,27 @@ class ProductStack(object):
         except KeyError:
           return []
 
+    def getSortedVersions(self, productName, flavor, versionCmp):
+        """
+        return the versions declared for a product of a given flavor, earliest
+        first in the order defined by versionCmp.  The sorted list is kept
+        with the product until a version is added or removed, so the caller
+        must not modify it.
+        @param productName   the name of the product of interest
+        @param flavor        the flavor to search; if None, return for all
+                                flavors (in a new list that is not kept)
+        @param versionCmp    the function used to compare two versions
+        """
+        if flavor is None:
+            vers = self.getVersions(productName)
+            sortVersions(vers, versionCmp)
+            return vers
+
+        try:
+            return self.lookup[flavor][productName].getSortedVersions(versionCmp)
+        except KeyError:
+            return []
+
     def hasProduct(self, name, flavor=None, version=None):
         """
         return true if a desired product is registered.
@@ -209,8 +256,8 @@ class ProductStack(object):
             raise ProductNotFound(name, version, flavor)
 
     # @staticmethod   # requires python 2.4
-    def persistFilename(flavor):
-        return "%s.%s" % (flavor, ProductStack.persistFileExt)
+    def persistFilename(flavor, indexBackend=None):
+        return getIndexBackend(indexBackend).persistFilename(flavor)
     persistFilename = staticmethod(persistFilename)  # works since python 2.2
 
     def save(self, flavors=None, dir=None):
@@ -266,6 +313,32 @@ class ProductStack(object):
                 return False
         return True
 
+    def isCurrent(self, flavors=None, cacheDir=None):
+        """
+        return True if this stack, as read from a cache, still reflects the
+        database:  it has no unsaved changes, the cache files are up to 
+        date, and they haven't been rewritten since they were read.  This 
+        allows a long-lived process to safely reuse a ProductStack.
+        @param flavors    the flavors of interest (default: all loaded)
+        @param cacheDir   the directory the caches were read from 
+        """
+        if not flavors:
+            flavors = self.getFlavors()
+        if isinstance(flavors, str):
+            flavors = [flavors]
+        if not cacheDir:
+            cacheDir = self._persistDir()
+
+        if self.updated:
+            return False
+        try:
+            for flavor in flavors:
+                if not self.cacheIsUpToDate(flavor, cacheDir):
+                    return False
+            return self.cacheIsInSync(flavors)
+        except OSError:                 # a cache file has disappeared
+            return False
+
     def _persistDir(self, dir=None):
         if not dir:
             dir = self.persistDir
@@ -274,7 +347,23 @@ class ProductStack(object):
         return dir
 
     def _persistPath(self, flavor, dir=None):
-        return os.path.join(self._persistDir(dir), self.persistFilename(flavor))
+        return os.path.join(self._persistDir(dir), 
+                            self.index.persistFilename(flavor))
+
+    def _cachedPath(self, flavor, dir=None):
+        # return the cache file to read data for a flavor from along with
+        # the backend that can read it; fall back to a pickled cache if 
+        # there is none in our preferred format.  
+        file = self._persistPath(flavor, dir)
+        if os.path.exists(file) or self.index.name == "pickle":
+            return file, self.index
+
+        index = getIndexBackend("pickle")
+        fallback = os.path.join(self._persistDir(dir), 
+                                index.persistFilename(flavor))
+        if os.path.exists(fallback):
+            return fallback, index
+        return file, self.index
 
     def persist(self, flavor, file=None):
         """
@@ -285,20 +374,45 @@ class ProductStack(object):
                           a location will be be used.
         """
         if file is None:
-            dir = self.persistDir
-            if not dir:
-                dir = self.dbpath
-            file = os.path.join(dir, persistFilename(flavor))
+            file = self._persistPath(flavor)
 
         if not self.lookup.has_key(flavor):
             self.lookup[flavor] = {}
         flavorData = self.lookup[flavor]
 
-        fd = open(file, "w")
-        cPickle.dump(flavorData, fd)
-        fd.close()
+        generations = self._getGenerations(os.path.dirname(file))
+        if self._readGenerations is not None:
+            for dbroot in generations.keys():
+                if self._readGenerations.has_key(dbroot):
+                    generations[dbroot] = self._readGenerations[dbroot]
+                else:
+                    del generations[dbroot] # we don't know what state we read
+
+        self.index.save(flavorData, file, flavor, generations)
         self.modtimes[file] = os.stat(file).st_mtime
 
+    def _getGenerations(self, cacheDir=None):
+        # return the current generation counts of our database and, if 
+        # different, of the database of user tags in cacheDir, keyed by path.
+        # Databases that don't record their generation are omitted.
+        out = {}
+        dbroots = [self.dbpath]
+        if cacheDir and cacheDir != self.dbpath:
+            dbroots.append(cacheDir)
+        for dbroot in dbroots:
+            generation = Database(self.dbpath).getGeneration(dbroot)
+            if generation is not None:
+                out[dbroot] = generation
+        return out
+
+    def _getReadGenerations(self, userTagDir=None):
+        # return the current generation counts of all the databases that
+        # we read from (see self._readGenerations)
+        out = self._getGenerations(self.persistDir)
+        if userTagDir:
+            out.update(self._getGenerations(userTagDir))
+        return out
+
     def export(self):
         """
         return a hierarchical dictionary of all the Products in the stack, 
@@ -606,32 +720,65 @@ class ProductStack(object):
                 except KeyError:
                     pass
 
-    def cacheIsUpToDate(self, flavor, cacheDir=None):
+    def cacheIsUpToDate(self, flavor, cacheDir=None, fullCheck=False):
         """
         return True if there is a cache file on disk with product information
         for a given flavor which is newer than the information in the 
         product database.  False is returned if the file does not exist
         or otherwise appears out-of-date.
 
+        If the cache recorded the generation count of a database when 
+        it was written, it is enough to compare it with the database's 
+        current count; otherwise the modification times of every file
+        in the database must be checked.
+
         Note that this is different from cacheIsInSync()
+
+        @param fullCheck   if True, always check the modification times of
+                              the database files, ignoring the generation
+                              counts.
         """
+        return self._checkCache(flavor, cacheDir, fullCheck)[0]
+
+    def _checkCache(self, flavor, cacheDir=None, fullCheck=False):
+        # return a tuple of whether the cache for flavor is up to date, 
+        # and whether this was established from the generation counts alone
         if not cacheDir:
             cacheDir = self.dbpath
-        cache = self._persistPath(flavor, cacheDir)
+        cache, index = self._cachedPath(flavor, cacheDir)
         if not os.path.exists(cache):
-            return False
-
-        # get the modification time of the cache file
-        cache_mtime = os.stat(cache).st_mtime
-
-        # check for user tag updates
-        if cacheDir != self.dbpath and \
-           Database(cacheDir).isNewerThan(cache_mtime):
-            return False
-
-        # this is slightly inaccurate: if data for any flavor in the database
-        # is newer than this time, this isNewerThan() returns True
-        return not Database(self.dbpath).isNewerThan(cache_mtime)
+            return False, False
+
+        recorded = {}
+        if not fullCheck:
+            recorded = index.loadGenerations(cache)
+
+        # check for user tag updates, then the database itself
+        dbroots = [self.dbpath]
+        if cacheDir != self.dbpath:
+            dbroots.insert(0, cacheDir)
+
+        byGeneration = True
+        for dbroot in dbroots:
+            generation = None
+            if recorded.has_key(dbroot):
+                generation = Database(self.dbpath).getGeneration(dbroot)
+
+            if generation is not None:
+                if generation != recorded[dbroot]:
+                    return False, True
+                continue
+            # 
+            # No generation to go on; compare with the modification time of
+            # the cache file.  This is slightly inaccurate: if data for any 
+            # flavor in the database is newer than this time, this 
+            # isNewerThan() returns True
+            #
+            byGeneration = False
+            if Database(dbroot).isNewerThan(os.stat(cache).st_mtime):
+                return False, False
+
+        return True, byGeneration
 
     def clearCache(self, flavors=None, cachedir=None, verbose=0):
         """
@@ -651,11 +798,14 @@ class ProductStack(object):
             flavors = [flavors]
 
         for flavor in flavors:
-            fileName = self._persistPath(flavor, cachedir)
-            if os.path.exists(fileName):
-                if verbose > 0:
-                    print >> sys.stderr, "Deleting %s" % (fileName)
-                os.remove(fileName)
+            for index in indexBackends.keys():
+                index = getIndexBackend(index)
+                fileName = os.path.join(self._persistDir(cachedir), 
+                                        index.persistFilename(flavor))
+                if os.path.exists(fileName):
+                    if verbose > 0:
+                        print >> sys.stderr, "Deleting %s" % (fileName)
+                    index.remove(fileName)
 
     def reload(self, flavors=None, persistDir=None, verbose=0):
         """
@@ -683,42 +833,84 @@ class ProductStack(object):
             flavors = [flavors]
 
         for flavor in flavors:
-            fileName = self._persistPath(flavor,persistDir)
+            fileName, index = self._cachedPath(flavor, persistDir)
             self.modtimes[fileName] = os.stat(fileName).st_mtime
-            fd = open(fileName)
-            lookup = cPickle.load(fd)
-            fd.close()
+            lookup = index.load(fileName, flavor)
 
             self.lookup[flavor] = lookup
 
     # @staticmethod   # requires python 2.4
-    def findCachedFlavors(dir):
-
-        # read comments from bottom to top
-        return map(lambda a: a.group(1),  # extra flavor name
-                   filter(lambda b: b,    # grab only cache files
-                          # match file against cache file pattern
-                          map(lambda c: ProductStack.persistFileRe.match(c),
-                              # list contents of directory
-                              os.listdir(dir))))
+    def findCachedFlavors(dir, indexBackend=None):
+        """
+        return the flavors that have cache files in a directory
+        @param dir           the directory to search
+        @param indexBackend  only consider caches in this format; if None, 
+                                look for caches in any known format.
+        """
+        if indexBackend is None:
+            patterns = map(lambda i: getIndexBackend(i).persistFileRe, 
+                           indexBackends.keys())
+        else:
+            patterns = [getIndexBackend(indexBackend).persistFileRe]
+
+        out = []
+        for file in os.listdir(dir):
+            for pattern in patterns:
+                mat = pattern.match(file)
+                if mat and mat.group(1) not in out:
+                    out.append(mat.group(1))
+        return out
 
     findCachedFlavors = staticmethod(findCachedFlavors) # works since python2.2
 
-    def refreshFromDatabase(self, userTagDir=None):
+    def refreshFromDatabase(self, userTagDir=None, crawlThreads=None):
         """
         load product information directly from the database files on disk,
         overwriting any previous information.  If userTagDir is provided,
         user tag assignments will be explicitly loaded into the stack 
         (otherwise, the stack may not have user tags in it).
+
+        The products are read by a pool of threads (see crawlThreads) as 
+        reading the database is dominated by the latency of opening many
+        small files; the results are added to the stack in product name 
+        order so that the outcome doesn't depend on the number of threads.
+
+        As the database may be modified while it's being read (e.g. by a
+        command that doesn't take locks), the generation counts are checked
+        before and after reading it, and if they changed (or a file vanished
+        from under us) the database is read again, up to maxCrawlRetries 
+        times.
+        @param userTagDir    the directory where user tag data is persisted
+        @param crawlThreads  the number of threads to read the database 
+                               with.  If None, use self.crawlThreads.
         """
+        if crawlThreads is None:
+            crawlThreads = self.crawlThreads
+
         db = Database(self.dbpath, userTagDir)
 
-        # forget!
-        self.lookup = {}
+        retries = maxCrawlRetries
+        while True:
+            generations = self._getReadGenerations(userTagDir)
+
+            # forget!
+            self.lookup = {}
 
-        for prodname in db.findProductNames():
-            for product in db.findProducts(prodname):
-                self.addProduct(product)
+            try:
+                prodnames = db.findProductNames()
+                prodnames.sort()
+                for products in utils.parallelMap(db.findProducts, prodnames, crawlThreads):
+                    for product in products:
+                        self.addProduct(product)
+            except EnvironmentError:
+                if retries == 0:
+                    raise
+            else:
+                if retries == 0 or self._getReadGenerations(userTagDir) == generations:
+                    break
+            retries -= 1
+
+        self._readGenerations = generations
 
     def _loadUserTags(self, userTagDir=None):
         if not userTagDir:
@@ -734,7 +926,8 @@ class ProductStack(object):
             
 
     # @staticmethod   # requires python 2.4
-    def fromDatabase(dbpath, persistDir=None, userTagDir=None, autosave=True):
+    def fromDatabase(dbpath, persistDir=None, userTagDir=None, autosave=True,
+                     indexBackend=None, crawlThreads=1):
         """
         return a ProductStack that has all products loaded in from an EUPS
         database.  If a userTagDir is provided, user tag assignments will be
@@ -745,15 +938,18 @@ class ProductStack(object):
         @param userTagDir  the directory where user tag data is persisted.
         @param autosave    if true (default), all updates will be saved to 
                               disk.
+        @param indexBackend  the format to persist the cache in 
+        @param crawlThreads  the number of threads to read the database with
         """
-        out = ProductStack(dbpath, persistDir, autosave)
+        out = ProductStack(dbpath, persistDir, autosave, indexBackend, crawlThreads)
         out.refreshFromDatabase(userTagDir)
         return out
     fromDatabase = staticmethod(fromDatabase)    # works since python2.2
 
     # @staticmethod   # requires python 2.4
     def fromCache(dbpath, flavors, persistDir=None, userTagDir=None, 
-                  updateCache=True, autosave=True, verbose=0):
+                  updateCache=True, autosave=True, verbose=0, indexBackend=None,
+                  crawlThreads=1):
         """
         return a ProductStack that has all products loaded in from the 
         available caches.  If they are out of date (or non-existent), this 
@@ -763,8 +959,11 @@ class ProductStack(object):
         for an cache.  If it apears up-to-date, it will be read in.  This 
         will be assumed to have all user tags included in the cache.  If 
         no cache exists, then an up-to-date one will be looked for in dbpath.
-        If one does not exist, one will be created by loading all product
-        data from the dbpath database.  A ProductStack created from dbpath 
+        If neither is up-to-date, but the database journals record every 
+        change made since one of them was written, it is read and only the 
+        changed products are reloaded from the database.  Failing that,
+        a cache will be created by loading all product data from the dbpath
+        database.  A ProductStack created from dbpath 
         will not have user tags in it; thus, these will be explicitly added 
         to it.  Finally, regardless of where the stack was loaded from, if 
         persistDir is set and updateCache is True, the stack is pesisted 
@@ -780,6 +979,10 @@ class ProductStack(object):
                                appear out of date
         @param autosave     if true (default), all updates will be 
                                saved to disk.
+        @param indexBackend the format to persist the cache in ("pickle" or
+                               "sqlite").  If None, use the pickle format.
+        @param crawlThreads the number of threads to read the database with
+                               if the cache must be rebuilt
         """
         if not flavors:
             raise RuntimeError("ProductStack.fromCache(): at least one flavor needed as input" +
@@ -787,7 +990,8 @@ class ProductStack(object):
         if not isinstance(flavors, list):
             flavors = [flavors]
 
-        out = ProductStack(dbpath, persistDir, False)
+        out = ProductStack(dbpath, persistDir, False, indexBackend, crawlThreads)
+        out._readGenerations = out._getReadGenerations(userTagDir)
 
         cacheOkay = out._tryCache(dbpath, persistDir, flavors, verbose=verbose)
         if not cacheOkay:
@@ -795,6 +999,16 @@ class ProductStack(object):
             if cacheOkay:
                 out._loadUserTags(userTagDir)
 
+        if not cacheOkay:
+            cacheOkay = out._tryJournal(persistDir, flavors, userTagDir, verbose)
+            if not cacheOkay:
+                cacheOkay = out._tryJournal(dbpath, flavors, userTagDir, verbose)
+                if cacheOkay:
+                    out._loadUserTags(userTagDir)
+            if cacheOkay:
+                out._flavorsUpdated(flavors)
+                if updateCache:  out.save()
+
         if not cacheOkay:
             out.refreshFromDatabase(userTagDir)
             out._flavorsUpdated(flavors)
@@ -805,13 +1019,64 @@ class ProductStack(object):
 
     fromCache = staticmethod(fromCache)    # works since python2.2
 
+    # @staticmethod   # requires python 2.4
+    def fromValidCache(dbpath, flavors, persistDir=None, userTagDir=None, 
+                       verbose=0, indexBackend=None):
+        """
+        return a ProductStack loaded from caches that are known to be up to 
+        date with the database, or None if there are no such caches.  
+        Unlike fromCache(), this never regenerates or writes a cache; it is 
+        intended for callers that would rather read the database directly 
+        than pay for rebuilding the cache (e.g. setup).
+
+        The caches are looked for in the same order as fromCache():  first 
+        in persistDir (which is assumed to include the user tags), then in 
+        dbpath (in which case the user tags are loaded from userTagDir).
+
+        @param dbpath       the full path to the database directory ("ups_db")
+        @param flavors      the desired flavors
+        @param persistDir   the directory where the user's cache is persisted
+        @param userTagDir   the directory where user tag data is persisted
+        @param indexBackend the format of the cache ("pickle" or "sqlite")
+        """
+        if not flavors:
+            raise RuntimeError("ProductStack.fromValidCache(): at least one flavor needed as input" +
+                               str(flavors));
+        if not isinstance(flavors, list):
+            flavors = [flavors]
+
+        out = ProductStack(dbpath, persistDir, False, indexBackend)
+        out._readGenerations = out._getReadGenerations(userTagDir)
+
+        if out._tryCache(dbpath, persistDir, flavors):
+            return out
+        if out._tryCache(dbpath, dbpath, flavors):
+            out._loadUserTags(userTagDir)
+            return out
+        # bring the caches up to date in memory if we can do so cheaply
+        if out._tryJournal(persistDir, flavors, userTagDir, verbose):
+            return out
+        if out._tryJournal(dbpath, flavors, userTagDir, verbose):
+            out._loadUserTags(userTagDir)
+            return out
+
+        if verbose > 1:
+            print >> sys.stderr, \
+                "No up-to-date cache for %s; reading the database directly" % (dbpath)
+        return None
+
+    fromValidCache = staticmethod(fromValidCache)    # works since python2.2
+
     def _tryCache(self, dbpath, cacheDir, flavors, verbose=0):
         if not cacheDir or not os.path.exists(cacheDir):
             return False
 
         cacheOkay = True
+        byGeneration = True
         for flav in flavors:
-            if not self.cacheIsUpToDate(flav, cacheDir):
+            upToDate, byGen = self._checkCache(flav, cacheDir)
+            byGeneration = byGeneration and byGen
+            if not upToDate:
                 cacheOkay = False
                 if verbose > 1:
                     print >> sys.stderr, \
@@ -821,6 +1086,10 @@ class ProductStack(object):
         if cacheOkay:
             self.reload(flavors, cacheDir, verbose=verbose)
 
+            # the generation counts guarantee that the cache is current
+            if byGeneration:
+                return cacheOkay
+
             # do a final consistency check; do we have the same products
             dbnames = Database(dbpath).findProductNames()
             dbnames.sort()
@@ -839,6 +1108,60 @@ class ProductStack(object):
 
         return cacheOkay
 
+    def _tryJournal(self, cacheDir, flavors, userTagDir=None, verbose=0):
+        # bring an out-of-date cache up to date by reloading only the 
+        # products that the database journals say have changed since the
+        # cache was written.  Return False if this isn't possible.
+        if not cacheDir or not os.path.exists(cacheDir):
+            return False
+
+        dbroots = [self.dbpath]
+        if cacheDir != self.dbpath:
+            dbroots.append(cacheDir)
+
+        changed = {}                    # the products to reload for each flavor
+        for flavor in flavors:
+            cache, index = self._cachedPath(flavor, cacheDir)
+            if not os.path.exists(cache):
+                return False
+            recorded = index.loadGenerations(cache)
+
+            changed[flavor] = {}
+            for dbroot in dbroots:
+                if not recorded.has_key(dbroot):
+                    # a user tag area that has never recorded a generation
+                    if dbroot != self.dbpath and \
+                       not Database(dbroot).isNewerThan(os.stat(cache).st_mtime):
+                        continue
+                    return False
+
+                changes = Database(self.dbpath).getChanges(recorded[dbroot], dbroot)
+                if changes is None:
+                    return False
+                for change in changes:
+                    changed[flavor][change[2]] = True
+
+        if verbose > 1:
+            print >> sys.stderr, "Updating cache for %s in %s from the database journal" % \
+                (", ".join(flavors), cacheDir)
+
+        self.reload(flavors, cacheDir)
+
+        db = Database(self.dbpath, userTagDir)
+        try:
+            for flavor in flavors:
+                for name in changed[flavor].keys():
+                    if self.lookup[flavor].has_key(name):
+                        del self.lookup[flavor][name]
+                    for product in db.findProducts(name, flavors=flavor):
+                        self.addProduct(product)
+        except EnvironmentError:
+            # the product was being modified as we read it
+            self.lookup = {}
+            return False
+
+        return True
+
 def _uniquify(lis):
     for i in xrange(len(lis)):
         item = lis.pop(0)
@@ -8,6 +8,9 @@ The major classes are:
                        to speed up recreation of a stack instance later.
    ProductFamily   a collection of different versions of product (installed 
                        for the same flavor).  
+   IndexBackend    the formats ("pickle" or "sqlite") that a ProductStack 
+                       can use to persist its data.
 """
 from ProductFamily import ProductFamily
 from ProductStack import ProductStack, persistVersionName, CacheOutOfSync
+from IndexBackend import getIndexBackend
@@ -5,13 +5,14 @@
 # product from a package
 #
 import os
-import re, sys
+import re, sys, time
 
 import eups
 from exceptions import BadTableContent, TableError, TableFileNotFound, ProductNotFound
 import Product
 from tags       import TagNotRecognized
-from VersionParser import VersionParser
+from VersionParser import VersionParser, compileExpression
+from TableCache import getTableCache
 import utils
 import hooks
 
@@ -36,6 +37,7 @@ class Table(object):
         self.topProduct = topProduct
         self.old = False
         self._actions = []
+        self._parseWarnings = 0         # the number of diagnostics issued while parsing the file
 
         if utils.isRealFilename(tableFile):
             self._read(tableFile, addDefaultProduct, verbose, topProduct)
@@ -102,6 +104,7 @@ but no other interpretation is applied
                         raise BadTableContent(self.file, msg=msg)
                     else:
                         print >> utils.stdwarn, "Ignoring qualifiers \"%s\" at %s:%d" % (mat.group(1), self.file, lineNo)
+                        self._parseWarnings += 1
                 continue
             #
             # Parse Group...Common...End, replacing by a proper If statement
@@ -256,6 +259,45 @@ but no other interpretation is applied
 
         if not tableFile:               # nothing to do
             return
+        #
+        # Use the parsed form of the file saved by an earlier process, if it's still valid
+        #
+        variant = None                  # the parsed form depends on the name of the top product
+        if topProduct:
+            variant = topProduct.name
+
+        tableCache = getTableCache()
+        data = None
+        if tableCache:
+            data = tableCache.lookup(tableFile, variant)
+
+        if data is not None:
+            self._actions = self._actionsFromData(data, tableFile, topProduct)
+        else:
+            parsed = time.time()
+            if self._parse(tableFile, verbose, topProduct) and tableCache:
+                tableCache.store(tableFile, self._actionsToData(), variant, parsed)
+        #
+        # Setup the default product, usually "toolchain"
+        #
+        if addDefaultProduct is not False and hooks.config.Eups.defaultProduct["name"]:
+            args = [hooks.config.Eups.defaultProduct["name"]]
+            if hooks.config.Eups.defaultProduct["version"]:
+                args.append(hooks.config.Eups.defaultProduct["version"])
+            if hooks.config.Eups.defaultProduct["tag"]:
+                args.append("--tag")
+                args.append(hooks.config.Eups.defaultProduct["tag"])
+
+            self._actions += [('True',
+                               [Action("implicit", "setupRequired", args,
+                                       {"optional": True, "silent" : True})],
+                               [])]
+
+    def _parse(self, tableFile, verbose=0, topProduct=None):
+        """Parse a table file, setting _actions.  Return False if any diagnostics were generated
+        (so that the parsed form shouldn't be reused)"""
+
+        self._parseWarnings = 0
 
         try:
             fd = file(tableFile)
@@ -373,6 +415,7 @@ but no other interpretation is applied
                         }[cmd]
                 except KeyError:
                     print >> utils.stderr, "Unexpected line in %s:%d: %s" % (tableFile, lineNo, line)
+                    self._parseWarnings += 1
                     continue
             else:
                 cmd = line; args = []
@@ -433,14 +476,17 @@ but no other interpretation is applied
                 if args[0] != pdirVar:  # only allow the unsetting of this one variable
                     if pdirVar and verbose > 0:
                         print >> utils.stdwarn, "Attempt to unset $%s at %s:%d" % (args[0], self.file, lineNo)
+                    self._parseWarnings += 1
                     continue                
             elif cmd == Action.sourceRequired:
                 print >> utils.stderr, "Ignoring unsupported directive %s at %s:%d" % (line, self.file, lineNo)
+                self._parseWarnings += 1
                 continue
             elif cmd == Action.doPrint:
                 pass
             else:
                 print >> utils.stderr, "Unrecognized line: %s at %s:%d" % (line, self.file, lineNo)
+                self._parseWarnings += 1
                 continue
 
             block += [Action(tableFile, cmd, args, extra, topProduct=topProduct)]
@@ -451,38 +497,99 @@ but no other interpretation is applied
             self._actions.append(logicalBlocks)
         if block:
             self._actions += [(logical, block, [])]
-        #
-        # Setup the default product, usually "toolchain"
-        #
-        if addDefaultProduct is not False and hooks.config.Eups.defaultProduct["name"]:
-            args = [hooks.config.Eups.defaultProduct["name"]]
-            if hooks.config.Eups.defaultProduct["version"]:
-                args.append(hooks.config.Eups.defaultProduct["version"])
-            if hooks.config.Eups.defaultProduct["tag"]:
-                args.append("--tag")
-                args.append(hooks.config.Eups.defaultProduct["tag"])
 
-            self._actions += [('True',
-                               [Action("implicit", "setupRequired", args,
-                                       {"optional": True, "silent" : True})],
-                               [])]
+        return self._parseWarnings == 0
+
+    def _actionsToData(self):
+        """Return _actions in a form that can be saved by a TableCache (see _actionsFromData)"""
+        def toData(el):
+            if isinstance(el, Action):
+                return {"cmd" : el.cmd, "args" : el.args, "extra" : el.extra}
+            elif isinstance(el, list):
+                return [toData(e) for e in el]
+            elif isinstance(el, tuple):
+                return tuple([toData(e) for e in el])
+            else:
+                return el
+
+        return toData(self._actions)
+
+    def _actionsFromData(self, data, tableFile, topProduct=None):
+        """Return the _actions saved as data by _actionsToData()"""
+        def fromData(el):
+            if isinstance(el, dict):
+                a = Action(tableFile, el["cmd"], [], el["extra"], topProduct=topProduct)
+                a.args = el["args"]     # n.b. they've already been processed by Action.__init__
+                return a
+            elif isinstance(el, list):
+                return [fromData(e) for e in el]
+            elif isinstance(el, tuple):
+                return tuple([fromData(e) for e in el])
+            else:
+                return el
+
+        return fromData(data)
+
+    def __getstate__(self):
+        # don't save the lists of actions that we've selected (see actions())
+        state = self.__dict__.copy()
+        state.pop("_actionsCache", None)
+        state.pop("_envVars", None)
+        return state
+
+    def _getEnvVars(self):
+        # return the environment variables that the logical conditions refer to
+        envVars = getattr(self, "_envVars", None)
+        if envVars is None:
+            envVars = set()
+            for LBB in self._actions:
+                while LBB:
+                    envVars.update(compileExpression(LBB[0]).envVars)
+                    if len(LBB[2:]) == 1:
+                        break
+                    LBB = LBB[2:]
+            self._envVars = envVars = sorted(envVars)
+
+        return envVars
 
     def actions(self, flavor, setupType=[], verbose=0):
         """Return a list of actions for the specified flavor"""
 
-        actions = []
         if not self._actions:
-            return actions
+            return []
+        #
+        # The actions selected only depend on flavor, setupType, and any environment variables in the conditions
+        #
+        key = (flavor, tuple(setupType or []), tuple([os.environ.get(v) for v in self._getEnvVars()]))
+
+        actionsCache = getattr(self, "_actionsCache", None)
+        if actionsCache is None:
+            actionsCache = self._actionsCache = {}
+        try:
+            actions = actionsCache[key]
+        except KeyError:
+            actions = actionsCache[key] = self._selectActions(flavor, setupType)
+
+        if len(actions) == 0 and verbose > 1:
+            msg = "Table %s has no entry for flavor %s" % (self.file, flavor)
+            if setupType:
+                msg += ", type " + ", ".join(setupType)
+            print >> utils.stdinfo, msg
+        return actions[:]
+
+    def _selectActions(self, flavor, setupType):
+        """Return a list of the actions whose logical conditions are satisfied"""
+
+        actions = []
+        symbols = {"flavor" : flavor}
+        if setupType:
+            symbols["type"] = setupType
 
         for LBB in self._actions:       # LBB: Logical Block Block[s]
             while LBB:
                 logical, ifBlock, elseBlock = LBB[0], LBB[1], LBB[2:]
-                parser = VersionParser(logical)
-                parser.define("flavor", flavor)
-                if setupType:
-                    parser.define("type", setupType)
 
-                if parser.eval():
+                if compileExpression(logical).eval(symbols):
                     actions += ifBlock
                     break
                 else:
@@ -492,11 +599,6 @@ but no other interpretation is applied
                     else:
                         LBB = elseBlock # another Logical Block Block[s]
 
-        if len(actions) == 0 and verbose > 1:
-            msg = "Table %s has no entry for flavor %s" % (self.file, flavor)
-            if setupType:
-                msg += ", type " + ", ".join(setupType)
-            print >> utils.stdinfo, msg
         return actions
 
     def __str__(self):
@@ -655,12 +757,11 @@ but no other interpretation is applied
                     print "Oh dear. Please type w at the pdb prompt and notify rhl@astro.princeton.edu"
                     import pdb; pdb.set_trace() 
 
-                parser = VersionParser(logical)
-                parser.define("flavor", flavor)
+                symbols = {"flavor" : flavor}
                 if setupType:
-                    parser.define("type", setupType)
+                    symbols["type"] = setupType
 
-                if parser.eval():
+                if compileExpression(logical).eval(symbols):
                     block = ifBlock
                     LBB = None
                 else:
@@ -1,9 +1,15 @@
 """
 Utility functions used across EUPS classes.
 """
-import time, os, sys, glob, re, shutil, tempfile
+import time, os, sys, glob, re, shutil, tempfile, array
 from cStringIO import StringIO
 
+# Files modified within this many seconds before some derived state (a cache,
+# index, or snapshot) was built might be modified again without changing their
+# modification time (on filesystems with coarse timestamps), so such state is
+# not trusted.
+mtimeResolution = 1.0
+
 def _svnRevision(file=None, lastChanged=False):
     """Return file's Revision as a string; if file is None return
     a tuple (oldestRevision, youngestRevision, flags) as reported
@@ -471,6 +477,277 @@ def copyfile(file1, file2):
 
     shutil.copy2(file1, file2)
 
+class AtomicFile(object):
+    """
+    A file that is written under a temporary name, flushed to disk, and
+    renamed into place when it's closed, so that a reader sees either the
+    old or the new contents of the file but never a partially written one.
+    If the file already exists its permissions are preserved.
+
+    If writing fails, call abort() rather than close() to leave the
+    original file untouched.
+    """
+
+    def __init__(self, fileName):
+        self.name = os.path.realpath(fileName) # don't replace a symlink with a file
+        self._tmpName = "%s.tmp%d" % (self.name, os.getpid())
+        self._fd = open(self._tmpName, "w")
+
+        try:
+            os.chmod(self._tmpName, os.stat(self.name).st_mode & 07777)
+        except OSError:
+            pass
+
+    def write(self, text):
+        self._fd.write(text)
+
+    def writelines(self, lines):
+        self._fd.writelines(lines)
+
+    def close(self):
+        """Move the new contents into place"""
+        if self._fd.closed:
+            return
+
+        try:
+            self._fd.flush()
+            os.fsync(self._fd.fileno())
+            self._fd.close()
+            os.rename(self._tmpName, self.name)
+        except:
+            self.abort()
+            raise
+
+    def abort(self):
+        """Discard what we've written, leaving the file as it was"""
+        self._fd.close()
+        if os.path.exists(self._tmpName):
+            os.remove(self._tmpName)
+
+def parallelMap(func, items, nthreads=1):
+    """
+    Return [func(item) for item in items], calling func from a pool of
+    nthreads threads.  This is intended for I/O-bound work (e.g. reading
+    many small files on a network filesystem).  The results are returned
+    in the order of the input items regardless of the order in which they
+    were computed.  If any call raises an exception, the exception raised
+    for the earliest item is re-raised once all the threads have finished.
+
+    @param func      the function to apply to each item
+    @param items     the items to process
+    @param nthreads  the maximum number of threads to use; if <= 1, the
+                       items are processed serially in the calling thread
+    """
+    items = list(items)
+    if nthreads is None or nthreads <= 1 or len(items) <= 1:
+        return map(func, items)
+
+    import threading
+
+    results = [None] * len(items)
+    errors = [None] * len(items)
+    indices = range(len(items))
+    indices.reverse()                   # so that pop() returns them in order
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            lock.acquire()
+            try:
+                if not indices:
+                    return
+                i = indices.pop()
+            finally:
+                lock.release()
+
+            try:
+                results[i] = func(items[i])
+            except Exception:
+                errors[i] = sys.exc_info()
+
+    threads = []
+    for n in xrange(min(nthreads, len(items))):
+        t = threading.Thread(target=worker)
+        t.setDaemon(True)
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+
+    for err in errors:
+        if err is not None:
+            raise err[0], err[1], err[2]
+
+    return results
+
+def forkMap(func, items, nprocs=1):
+    """
+    Return [func(item) for item in items], calling func in up to nprocs
+    forked processes, each of which processes a contiguous slice of the
+    items.  This is intended for CPU-bound work that parallelMap() can't
+    speed up; the results must be picklable.  The results are returned in
+    the order of the input items.  If a call raises an exception, a
+    RuntimeError describing it is raised once all the processes have
+    finished.
+
+    @param func      the function to apply to each item
+    @param items     the items to process
+    @param nprocs    the maximum number of processes to use; if <= 1 (or
+                       if fork isn't available), the items are processed
+                       serially in the calling process
+    """
+    import cPickle
+
+    items = list(items)
+    if nprocs is None or nprocs <= 1 or len(items) <= 1 or not hasattr(os, "fork"):
+        return map(func, items)
+
+    nprocs = min(nprocs, len(items))
+    children = []
+    for i in xrange(nprocs):
+        chunk = items[i*len(items)//nprocs:(i + 1)*len(items)//nprocs]
+
+        rfd, wfd = os.pipe()
+        sys.stdout.flush(); sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:                    # the child
+            os.close(rfd)
+            status = 0
+            try:
+                try:
+                    result = ("ok", map(func, chunk))
+                except Exception, e:
+                    result = ("error", "%s: %s" % (e.__class__.__name__, e))
+                fd = os.fdopen(wfd, "w")
+                cPickle.dump(result, fd, protocol=2)
+                fd.close()
+            except:
+                status = 1
+            os._exit(status)
+
+        os.close(wfd)
+        children.append((pid, os.fdopen(rfd)))
+
+    results = []
+    errors = []
+    for pid, fd in children:
+        try:
+            status, value = cPickle.load(fd)
+        except (EOFError, ValueError, cPickle.UnpicklingError), e:
+            status, value = "error", "unable to read the results: %s" % e
+        fd.close()
+        os.waitpid(pid, 0)
+
+        if status == "ok":
+            results += value
+        else:
+            errors.append(value)
+
+    if errors:
+        raise RuntimeError("Failed to process items in parallel: %s" % "; ".join(errors))
+
+    return results
+
+class LRUCache(object):
+    """
+    A dictionary-like cache holding at most maxsize items; when it's full, the
+    least recently used item is discarded to make room for a new one.  The
+    number of successful and failed look-ups (via get()) are counted in hits
+    and misses.
+
+    The items are kept in a dictionary, and in a circular doubly-linked list
+    ordered by when they were last used (collections.OrderedDict would do, but
+    it needs python 2.7)
+    """
+
+    # indices into the [prev, next, key, value] lists that are the list's links
+    _PREV, _NEXT, _KEY, _VALUE = 0, 1, 2, 3
+
+    def __init__(self, maxsize=1000):
+        """
+        @param maxsize   the maximum number of items to keep; if None, the
+                           cache is unbounded
+        """
+        self.maxsize = maxsize
+        self._items = {}                # the links, indexed by key
+        self._root = [None, None, None, None] # the list's sentinel; _root[_NEXT] is the least recently used
+        self._root[self._PREV] = self._root[self._NEXT] = self._root
+        self.hits = 0
+        self.misses = 0
+
+    def _unlink(self, link):
+        link[self._PREV][self._NEXT] = link[self._NEXT]
+        link[self._NEXT][self._PREV] = link[self._PREV]
+
+    def _append(self, link):
+        # add a link at the most recently used end of the list
+        last = self._root[self._PREV]
+        link[self._PREV], link[self._NEXT] = last, self._root
+        last[self._NEXT] = self._root[self._PREV] = link
+
+    def get(self, key, default=None):
+        """Return the value for key (marking it as recently used), or default if it isn't cached"""
+        link = self._items.get(key)
+        if link is None:
+            self.misses += 1
+            return default
+
+        self._unlink(link)
+        self._append(link)
+        self.hits += 1
+        return link[self._VALUE]
+
+    def put(self, key, value):
+        """Cache a value for key, discarding the least recently used item if the cache is full"""
+        link = self._items.get(key)
+        if link is not None:
+            self._unlink(link)
+        elif self.maxsize is not None and len(self._items) >= self.maxsize:
+            oldest = self._root[self._NEXT]
+            if oldest is not self._root:
+                self._unlink(oldest)
+                del self._items[oldest[self._KEY]]
+
+        link = [None, None, key, value]
+        self._append(link)
+        self._items[key] = link
+
+    def remove(self, key):
+        """Forget the value for key, if any"""
+        link = self._items.pop(key, None)
+        if link is not None:
+            self._unlink(link)
+
+    def clear(self):
+        """Forget all the cached items (but not the counts of hits and misses)"""
+        self._items.clear()
+        self._root[self._PREV] = self._root[self._NEXT] = self._root
+
+    def keys(self):
+        """Return the keys, least recently used first"""
+        keys = []
+        link = self._root[self._NEXT]
+        while link is not self._root:
+            keys.append(link[self._KEY])
+            link = link[self._NEXT]
+        return keys
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def stats(self):
+        """Return a dictionary describing how useful the cache has been"""
+        lookups = self.hits + self.misses
+        if lookups:
+            hitRate = float(self.hits)/lookups
+        else:
+            hitRate = 0.0
+        return {"hits" : self.hits, "misses" : self.misses, "size" : len(self._items),
+                "maxsize" : self.maxsize, "hitRate" : hitRate}
+
 
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 
@@ -586,168 +863,171 @@ stdok =   coloredFile(sys.stderr, "OK")
 
 """
 
-def stronglyConnectedComponents(graph):
-    """ Find the strongly connected components in a graph using
-        Tarjan's algorithm.
+def _compactGraph(graph, addMissing=False):
+    """Convert a graph (a dictionary mapping nodes to their successors) to a compact form over
+    integer node ids.  Returns (nodes, offsets, targets), where nodes[i] is the node with id i
+    and the successors of node i are targets[offsets[i]:offsets[i + 1]]
 
-        graph should be a dictionary mapping node names to
-        lists of successor nodes.
-        """
+    If addMissing is True, successors that aren't keys in graph are added as nodes with no successors
+    (in which case self dependencies are also dropped); otherwise they raise KeyError
+    """
+    nodes = list(graph)
+    nkey = len(nodes)                   # the number of nodes that are keys in graph
+    ids = {}
+    for i, node in enumerate(nodes):
+        ids[node] = i
+
+    offsets = array.array('l', [0])
+    targets = array.array('l')
+    i = 0
+    while i < len(nodes):               # nodes may grow as we go
+        if i < nkey:
+            for successor in graph[nodes[i]]:
+                try:
+                    j = ids[successor]
+                except KeyError:
+                    if not addMissing:
+                        raise
+                    j = ids[successor] = len(nodes)
+                    nodes.append(successor)
+
+                if addMissing and j == i:
+                    continue            # ignore self dependencies
+                targets.append(j)
+        offsets.append(len(targets))
+        i += 1
+
+    return nodes, offsets, targets
+
+def _stronglyConnectedComponents(offsets, targets):
+    """Find the strongly connected components in a graph of n = len(offsets) - 1 nodes with integer
+    ids, as returned by _compactGraph, using an iterative version of Tarjan's algorithm
+
+    Returns a list of components, each a list of node ids.  A component appears after all the
+    components that it has edges to (i.e. the list is in reverse topological order)
+    """
+    n = len(offsets) - 1
+    low = array.array('l', [-1])*n      # -1: not yet visited; n: in a completed component
+    num = array.array('l', [0])*n       # the order in which the nodes were visited
+    stackPos = array.array('l', [0])*n  # where each node was pushed onto stack
+    nvisited = 0
 
     result = []
     stack = []
-    low = {}
-
-    def visit(node):
-        if node in low: return
-
-        num = len(low)
-        low[node] = num
-        stack_pos = len(stack)
-        stack.append(node)
-
-        for successor in graph[node]:
-            visit(successor)
-            low[node] = min(low[node], low[successor])
-
-        if num == low[node]:
-            component = tuple(stack[stack_pos:])
-            del stack[stack_pos:]
-            result.append(component)
-            for item in component:
-                low[item] = len(graph)
-
-    for node in graph:
-        visit(node)
+    for root in xrange(n):
+        if low[root] >= 0:
+            continue
+
+        low[root] = num[root] = nvisited; nvisited += 1
+        stackPos[root] = len(stack); stack.append(root)
+        work = [root]                   # the nodes being visited
+        next = [offsets[root]]          # the position in targets of each work node's next successor
+
+        while work:
+            node = work[-1]
+            e = next[-1]
+            if e < offsets[node + 1]:
+                next[-1] = e + 1
+                successor = targets[e]
+                if low[successor] < 0:  # descend into successor
+                    low[successor] = num[successor] = nvisited; nvisited += 1
+                    stackPos[successor] = len(stack); stack.append(successor)
+                    work.append(successor)
+                    next.append(offsets[successor])
+                elif low[successor] < low[node]:
+                    low[node] = low[successor]
+                continue
+
+            work.pop(); next.pop()
+            if num[node] == low[node]:
+                component = stack[stackPos[node]:]
+                del stack[stackPos[node]:]
+                result.append(component)
+                for item in component:
+                    low[item] = n
+
+            if work and low[node] < low[work[-1]]:
+                low[work[-1]] = low[node]
 
     return result
 
+def stronglyConnectedComponents(graph):
+    """ Find the strongly connected components in a graph using
+        Tarjan's algorithm.
 
-def _topological_sort(graph):
-    count = { }
-    for node in graph:
-        count[node] = 0
-    for node in graph:
-        for successor in graph[node]:
-            count[successor] += 1
-
-    ready = [ node for node in graph if count[node] == 0 ]
-
-    result = [ ]
-    while ready:
-        node = ready.pop(-1)
-        result.append(node)
+        graph should be a dictionary mapping node names to
+        lists of successor nodes.
 
-        for successor in graph[node]:
-            count[successor] -= 1
-            if count[successor] == 0:
-                ready.append(successor)
+        Returns a list of tuples of nodes, in reverse topological order
+        """
 
-    return result
+    nodes, offsets, targets = _compactGraph(graph)
 
+    return [tuple([nodes[i] for i in component])
+            for component in _stronglyConnectedComponents(offsets, targets)]
 
 def topologicalSort(graph, verbose=False, checkCycles=False):
     """
     If checkCycles is True, throw RuntimeError if any cycles are detected
 
-    From http://code.activestate.com/recipes/577413-topological-sort (but converted back to python 2.4)
-
-    Author Paddy McCarthy, under the MIT license
+    Based on http://code.activestate.com/recipes/577413-topological-sort, by Paddy McCarthy,
+    under the MIT license.  Strongly connected components (i.e. cycles) are sorted as a unit;
+    self dependencies are ignored.  Runs in time linear in the size of graph.
 
     Returns a generator;
            print [str(t) for t in utils.topologicalSort(graph)]
-    returns a list of keys, where the earlier elements sort _after_ the later ones.
+    returns a sorted list of keys for each level, where the elements of a level only depend
+    on elements of earlier levels.
     """
 
-    for k, v in graph.items():
-        graph[k] = set(v)
-
-    for k, v in graph.items():
-        v.discard(k) # Ignore self dependencies
-
-    extra_items_in_deps = reduce(set.union, graph.values()) - set(graph.keys())
-    for item in extra_items_in_deps:
-        graph[item] = set()
-
-    #
-    # If there are strongly-connected components, make these components the keys
-    # in the graph, not single elements
-    #
-    def name(p):
-        """Return a p's name (if a Product), otherwise str(p)"""
-        try:
-            return p.name
-        except AttributeError:
-            return str(p)
-
     def nameVersion(p):
         try:
             return "[%s %s]" % (p.name, p.version)
         except AttributeError:
             return str(p)
 
+    nodes, offsets, targets = _compactGraph(graph, addMissing=True)
+    components = _stronglyConnectedComponents(offsets, targets)
 
-    components = stronglyConnectedComponents(graph)
-
-    cycles = []
+    msg = []
     for ccomp in components:
         if len(ccomp) > 1:
-            cycles.append(ccomp)
-
-    msg = []
-    for ccomp in cycles:
-        msg.append(", ".join([nameVersion(c) for c in ccomp]))
+            msg.append(", ".join([nameVersion(nodes[c]) for c in ccomp]))
 
     if msg:
         msg = "(%s)" % ("), (".join(msg))
 
         if verbose:
-            if len(msg) == 0:
-                s = ""
-            else:
-                s = "s"
-            print >> stdwarn, "Detected cycle%s: %s" % (s, msg)
+            print >> stdwarn, "Detected cycles: %s" % (msg)
             
         if checkCycles:
-            raise RuntimeError("".join(msg))
+            raise RuntimeError(msg)
     #
-    # Rebuild the graph using tuples, so as to handle connected components
+    # The components are in reverse topological order, so a component's level (one more than the
+    # highest level of anything it depends on) is known by the time that we reach it
     #
-    node_component = {}         # index for which component each node belongs in
-    for component in components:
+    nodeComponent = array.array('l', [0])*len(nodes)
+    for c, component in enumerate(components):
+        for node in component:
+            nodeComponent[node] = c
+
+    levels = []                         # the nodes at each level
+    componentLevel = array.array('l')
+    for c, component in enumerate(components):
+        level = 0
         for node in component:
-            node_component[node] = component
-
-    component_graph = {}        # our new graph, indexed by component
-    for component in components:
-        component_graph[component] = set()
-
-    for node in graph:
-        node_c = node_component[node]
-        for successor in graph[node]:
-            successor_c = node_component[successor]
-            if node_c != successor_c: # here's where we break the cycle
-                component_graph[node_c].add(successor_c)
-
-    graph = component_graph
-
-    while True:
-        ordered = set(item for item, dep in graph.items() if not dep)
-        if not ordered:
-            break
-        flattened_ordered = [p for comp in list(ordered)
-                               for p    in comp]
-        yield sorted(flattened_ordered)
-        ngraph = {}
-        for item, dep in graph.items():
-            if item not in ordered:
-                ngraph[item] = (dep - ordered)
-
-        graph = ngraph; del ngraph
-
-    if graph:
-        raise RuntimeError("A cyclic dependency exists amongst %s" %
-                           " ".join(sorted([name([x for x in p]) for p in graph.keys()])))
+            for e in xrange(offsets[node], offsets[node + 1]):
+                successor_c = nodeComponent[targets[e]]
+                if successor_c != c and componentLevel[successor_c] >= level: # here's where we break the cycle
+                    level = componentLevel[successor_c] + 1
+
+        componentLevel.append(level)
+        if level == len(levels):
+            levels.append([])
+        levels[level] += component
+
+    for level in levels:
+        yield sorted([nodes[i] for i in level])
 
 if __name__ == "__main__":
     data = {
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+"""
+Benchmark for reading a whole EUPS database into a ProductStack with
+different numbers of threads (see ProductStack.refreshFromDatabase()).
+
+A synthetic database is written to a temporary directory.  As the benefit
+of using several threads comes from overlapping the latency of opening
+files on network filesystems, a delay may be added to each file opened
+in the database (--latency) to mimic such a filesystem.
+
+Usage: python benchCrawl.py [-n nproducts] [-v nversions] [-l latency] [threads ...]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import optparse
+import __builtin__
+
+from eups.stack import ProductStack
+
+def makeStack(root, nproducts, nversions, flavor="Linux"):
+    """write a synthetic database with nproducts products, each with nversions versions"""
+    dbpath = os.path.join(root, "ups_db")
+    for p in xrange(nproducts):
+        name = "prod%05d" % p
+        pdir = os.path.join(dbpath, name)
+        os.makedirs(pdir)
+        for v in xrange(nversions):
+            version = "1.%d" % v
+            fd = open(os.path.join(pdir, version + ".version"), "w")
+            print >> fd, """FILE = version
+PRODUCT = %(name)s
+VERSION = %(version)s
+#***************************************
+
+Group:
+   FLAVOR = %(flavor)s
+   QUALIFIERS = ""
+   PROD_DIR = %(flavor)s/%(name)s/%(version)s
+   UPS_DIR = ups
+   TABLE_FILE = %(name)s.table
+End:""" % locals()
+            fd.close()
+
+        fd = open(os.path.join(pdir, "current.chain"), "w")
+        print >> fd, """FILE = version
+PRODUCT = %(name)s
+CHAIN = current
+#***************************************
+
+#Group:
+   FLAVOR = %(flavor)s
+   VERSION = %(version)s
+   QUALIFIERS = ""
+#End:""" % locals()
+        fd.close()
+
+    return dbpath
+
+def addLatency(dbpath, latency):
+    """make every file opened under dbpath take an extra latency seconds to open"""
+    realOpen = __builtin__.open
+    def slowOpen(name, *args):
+        if latency > 0 and name.startswith(dbpath):
+            time.sleep(latency)
+        return realOpen(name, *args)
+    __builtin__.open = slowOpen
+
+def crawl(dbpath, threads):
+    t0 = time.time()
+    stack = ProductStack.fromDatabase(dbpath, autosave=False, crawlThreads=threads)
+    return time.time() - t0, stack
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__.strip().split("\n")[-1])
+    parser.add_option("-n", "--products", type="int", default=500,
+                      help="the number of products in the synthetic stack")
+    parser.add_option("-v", "--versions", type="int", default=4,
+                      help="the number of versions of each product")
+    parser.add_option("-l", "--latency", type="float", default=0.0005,
+                      help="the extra time taken (in seconds) to open each database file")
+    (opts, args) = parser.parse_args()
+
+    threads = map(int, args) or [1, 2, 4, 8, 16]
+
+    root = tempfile.mkdtemp(prefix="eupsBenchCrawl")
+    try:
+        dbpath = makeStack(root, opts.products, opts.versions)
+        addLatency(dbpath, opts.latency)
+
+        print "%d products x %d versions, %g s latency per file" % \
+            (opts.products, opts.versions, opts.latency)
+        serial = None
+        for n in threads:
+            elapsed, stack = crawl(dbpath, n)
+            if serial is None:
+                serial = elapsed
+            nprod = len(stack.getProductNames("Linux"))
+            print "%3d threads: %7.3f s  (x%.2f)  %d products" % \
+                (n, elapsed, serial/elapsed, nprod)
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == "__main__":
+    main()
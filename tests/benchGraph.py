@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""
+Benchmark for utils.stronglyConnectedComponents() and utils.topologicalSort()
+on synthetic dependency graphs of different sizes.
+
+Each node depends on up to --edges randomly chosen earlier nodes; a few
+back edges (--cycles) are added so that the graph has non-trivial strongly
+connected components.  A chain as long as the graph is also timed, to
+check that deep graphs don't run into the recursion limit.
+
+Usage: python benchGraph.py [-e edges] [-c cycles] [nnodes ...]
+"""
+
+import sys
+import time
+import random
+import optparse
+
+from eups import utils
+
+def makeGraph(nnodes, nedges, ncycles, seed=1):
+    """return a random graph of nnodes nodes, each with up to nedges successors"""
+    rand = random.Random(seed)
+    graph = {}
+    for i in xrange(nnodes):
+        graph[i] = [rand.randrange(i + 1) for j in xrange(rand.randrange(nedges + 1))]
+    for j in xrange(ncycles):
+        i = rand.randrange(nnodes)
+        graph[i].append(rand.randrange(i, nnodes))
+
+    return graph
+
+def makeChain(nnodes):
+    """return a graph where each node depends on the next one"""
+    graph = {}
+    for i in xrange(nnodes):
+        graph[i] = (i + 1 < nnodes and [i + 1]) or []
+
+    return graph
+
+def timeit(func, *args):
+    t0 = time.time()
+    result = func(*args)
+    return time.time() - t0, result
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__.strip().split("\n")[-1])
+    parser.add_option("-e", "--edges", type="int", default=8,
+                      help="the maximum number of successors of each node")
+    parser.add_option("-c", "--cycles", type="int", default=10,
+                      help="the number of back edges added to the graph")
+    (opts, args) = parser.parse_args()
+
+    sizes = map(int, args) or [1000, 10000, 100000]
+
+    print "%8s %8s %10s %10s %10s" % ("nodes", "edges", "SCC (s)", "sort (s)", "chain (s)")
+    for n in sizes:
+        graph = makeGraph(n, opts.edges, opts.cycles)
+        nedge = sum([len(v) for v in graph.values()])
+
+        tscc, components = timeit(utils.stronglyConnectedComponents, graph)
+        tsort, levels = timeit(lambda g: list(utils.topologicalSort(g)), graph)
+        tchain, chain = timeit(lambda g: list(utils.topologicalSort(g)), makeChain(n))
+
+        assert sum([len(l) for l in levels]) == n and len(chain) == n
+
+        print "%8d %8d %10.3f %10.3f %10.3f" % (n, nedge, tscc, tsort, tchain)
+
+if __name__ == "__main__":
+    main()
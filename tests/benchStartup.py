@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""
+Benchmark for the start-up cost of eups subcommands.
+
+Each subcommand is run in a fresh python process (as it would be from the
+shell) against a synthetic stack written to a temporary directory, and the
+wall-clock time taken is reported.  Commands such as "flavor" and "path"
+shouldn't need to read the product stacks at all (see Eups.versions), so
+their times should be close to that of importing eups.
+
+Usage: python benchStartup.py [-n nproducts] [-v nversions] [-r repeats] [command ...]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import optparse
+import subprocess
+
+from benchCrawl import makeStack
+
+# run a command as bin/eups would, discarding its output
+driver = """
+import sys, os
+sys.stdout = sys.stderr = open(os.devnull, "w")
+import eups.cmd
+sys.exit(eups.cmd.EupsCmd(args=sys.argv[1:], toolname="eups").run())
+"""
+
+defaultCommands = ["flavor", "path", "tags", "list prod00000", "list", "uses prod00000"]
+
+def timeCommand(args, env, repeats):
+    """return the fastest and the mean time taken to run "eups args" """
+    times = []
+    for i in range(repeats):
+        t0 = time.time()
+        subprocess.call([sys.executable, "-c", driver] + args, env=env)
+        times.append(time.time() - t0)
+    return min(times), sum(times)/len(times)
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__.strip().split("\n")[-1])
+    parser.add_option("-n", "--products", type="int", default=500,
+                      help="the number of products in the synthetic stack")
+    parser.add_option("-v", "--versions", type="int", default=4,
+                      help="the number of versions of each product")
+    parser.add_option("-r", "--repeats", type="int", default=5,
+                      help="the number of times to run each command")
+    (opts, args) = parser.parse_args()
+
+    commands = args or defaultCommands
+
+    root = tempfile.mkdtemp(prefix="eupsBenchStartup")
+    try:
+        makeStack(root, opts.products, opts.versions)
+
+        env = os.environ.copy()
+        env["EUPS_PATH"] = root
+        env["EUPS_FLAVOR"] = "Linux"
+        env["EUPS_USERDATA"] = os.path.join(root, "_userdata_")
+        env.setdefault("EUPS_SHELL", "sh")
+        env["PYTHONPATH"] = os.pathsep.join([os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                          "..", "python")] +
+                                            filter(None, [env.get("PYTHONPATH")]))
+
+        timeCommand(["list"], env, 1)   # build the cache, so that all the commands can use it
+
+        print "%d products x %d versions, best/mean of %d runs" % \
+            (opts.products, opts.versions, opts.repeats)
+        for cmd in commands:
+            best, mean = timeCommand(cmd.split(), env, opts.repeats)
+            print "eups %-20s %7.3f s  %7.3f s" % (cmd, best, mean)
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == "__main__":
+    main()
@@ -11,12 +11,15 @@ for t in [
     "testCmd",
     "testDeprecated",
     "testDb",
+    "testDependencyGraph",
     "testEups",
+    "testLock",
     "testMisc",
     "testProduct",
     "testStack",
     "testTable",
     "testTags",
+    "testVersionCompare",
     ]:
     tests += __import__(t).suite()
 
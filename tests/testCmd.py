@@ -7,12 +7,13 @@ import os
 import sys
 import unittest
 import time
-import re, shutil
+import re, shutil, tempfile
 import cStringIO as StringIO
 import testCommon
 from testCommon import testEupsStack
 
 import eups.cmd
+import eups.snapshot
 import eups.lock as lock
 import eups.hooks as hooks
 from eups import Tag, TagNotRecognized
@@ -404,6 +405,240 @@ class SetupCmdTestCase(unittest.TestCase):
         cmd = eups.setupcmd.EupsSetup(args=cmd.split(), toolname=prog)
         self.assertEqual(cmd.run(), 0)
         
+    def _unsetupAll(self):
+        for k in os.environ.keys():
+            if k.startswith("SETUP_"):
+                del os.environ[k]
+
+    def testMultipleProducts(self):
+        self._unsetupAll()
+        hooks.config.Eups.defaultTags = dict(pre=[], post=[]) # disable any defined in the startup.py file
+
+        cmd = eups.setupcmd.EupsSetup(args="-f Linux python tcltk:8.5a4".split(), toolname=prog)
+        self.assertEqual(cmd.run(), 0)
+        cmds = self.out.getvalue().split(";\n")
+        self.assertEquals(len([c for c in cmds if re.search(r"^export SETUP_PYTHON=", c)]), 1)
+        self.assertEquals(len([c for c in cmds if re.search(r"^export SETUP_TCLTK=", c)]), 1)
+        #
+        # A failure skips the remaining products, but keeps the ones already setup
+        #
+        self._unsetupAll()
+        self._resetOut()
+        cmd = eups.setupcmd.EupsSetup(args="-f Linux python goober doxygen".split(), toolname=prog)
+        cmd.run()
+        cmds = self.out.getvalue().split(";\n")
+        self.assertEquals(cmds[-1], "false")
+        self.assert_([c for c in cmds if re.search(r"^export SETUP_PYTHON=", c)])
+        self.assert_(not [c for c in cmds if re.search(r"^export SETUP_DOXYGEN=", c)])
+
+        self.assertEqual(eups.setupcmd.EupsSetup(args="-r . python tcltk doxygen".split(), toolname=prog).run(), 3)
+
+    def testSnapshot(self):
+        self._unsetupAll()
+        hooks.config.Eups.defaultTags = dict(pre=[], post=[]) # disable any defined in the startup.py file
+        environ = os.environ.copy()
+        #
+        # A snapshot isn't trusted if the database (which doesn't record its generation) or the table
+        # files were modified just before it was saved, as they are in a fresh checkout
+        #
+        past = time.time() - 3600
+        for dir, dirs, files in os.walk(self.dbpath):
+            for f in [dir] + [os.path.join(dir, f) for f in files]:
+                os.utime(f, (past, past))
+        for dir, dirs, files in os.walk(os.path.join(testEupsStack, "Linux")):
+            for f in files:
+                if f.endswith(".table"):
+                    os.utime(os.path.join(dir, f), (past, past))
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            file = os.path.join(tmpdir, "snapshot")
+            args = "-f Linux python"
+
+            cmd = eups.setupcmd.EupsSetup(args=("--save-snapshot %s %s" % (file, args)).split(), toolname=prog)
+            self.assertEqual(cmd.run(), 0)
+            cmds = self.out.getvalue()
+            self.assert_(re.search(r"export SETUP_PYTHON=", cmds))
+            #
+            # Starting from the same environment, we get the same commands from the snapshot
+            #
+            os.environ = environ.copy()
+            self._resetOut()
+            cmd = eups.setupcmd.EupsSetup(args=("--from-snapshot %s %s" % (file, args)).split(), toolname=prog)
+            self.assertEqual(eups.snapshot.load(file, cmd._snapshotRequest())[1], None)
+            self.assertEqual(cmd.run(), 0)
+            self.assertEquals(self.out.getvalue(), cmds)
+            #
+            # A different request, or a different environment, means that we setup the usual way
+            #
+            cmd = eups.setupcmd.EupsSetup(args=("--from-snapshot %s -f Linux tcltk" % file).split(),
+                                          toolname=prog)
+            self.assert_(eups.snapshot.load(file, cmd._snapshotRequest())[0] is None)
+
+            os.environ = environ.copy()
+            os.environ["SETUP_GOOBER"] = "goober 1.0"
+            cmd = eups.setupcmd.EupsSetup(args=("--from-snapshot %s %s" % (file, args)).split(), toolname=prog)
+            self.assert_(eups.snapshot.load(file, cmd._snapshotRequest())[0] is None)
+            self._resetOut()
+            self.assertEqual(cmd.run(), 0)
+            self.assert_(re.search(r"export SETUP_PYTHON=", self.out.getvalue()))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def testSnapshotReads(self):
+        self._unsetupAll()
+        hooks.config.Eups.defaultTags = dict(pre=[], post=[]) # disable any defined in the startup.py file
+        os.environ.pop("EUPS_LOCK_PID", None)
+        lockTimeout, snapshotReads = hooks.config.site.lockTimeout, hooks.config.site.snapshotReads
+        lockMethod = hooks.config.site.lockMethod
+        hooks.config.site.lockMethod = "fcntl"  # so the lock is dropped when its holder is killed
+        #
+        # Hold an exclusive lock on the stack, as a declare would
+        #
+        rfd, wfd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(rfd)
+                lock.takeLocks("declare", [testEupsStack], lock.LOCK_EX, verbose=-1)
+                os.write(wfd, "ok")
+                while True:
+                    time.sleep(10)
+            finally:
+                os._exit(1)
+        os.close(wfd)
+        try:
+            self.assertEquals(os.read(rfd, 2), "ok")
+            os.close(rfd)
+
+            hooks.config.site.lockTimeout = 0.2
+            cmd = eups.setupcmd.EupsSetup(args="-q -f Linux python".split(), toolname=prog)
+            self.assertRaises(RuntimeError, cmd.run)
+            #
+            # Reading a snapshot doesn't need the lock
+            #
+            self._resetOut()
+            hooks.config.site.snapshotReads = True
+            cmd = eups.setupcmd.EupsSetup(args="-f Linux python".split(), toolname=prog)
+            self.assertEqual(cmd.run(), 0)
+            self.assert_(re.search(r"export SETUP_PYTHON=", self.out.getvalue()))
+        finally:
+            hooks.config.site.lockTimeout, hooks.config.site.snapshotReads = lockTimeout, snapshotReads
+            hooks.config.site.lockMethod = lockMethod
+            os.kill(pid, 9)
+            os.waitpid(pid, 0)
+
+import socket
+import eups.daemon
+
+class DaemonTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.environ0 = os.environ.copy()
+        os.environ["EUPS_PATH"] = testEupsStack
+        for k in os.environ.keys():
+            if k.startswith("SETUP_") or k.endswith("_DIR") and k != "EUPS_DIR":
+                del os.environ[k]
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.socket = os.path.join(self.tmpdir, "socket")
+        eups.daemon.start(self.socket, idleTimeout=60)
+
+    def tearDown(self):
+        eups.daemon.stop(self.socket)
+        shutil.rmtree(self.tmpdir)
+        os.environ = self.environ0
+
+    def request(self, argv):
+        return eups.daemon.request(dict(command="setup", argv=argv, environ=dict(os.environ),
+                                        cwd=os.getcwd()), self.socket)
+
+    def testSetup(self):
+        self.assert_(eups.daemon.isRunning(self.socket))
+
+        for i in range(2):              # the second time, the daemon's state is warm
+            reply = self.request(["-f", "Linux", "python"])
+            self.assertEquals(reply["status"], 0)
+            self.assert_(re.search(r"SETUP_PYTHON='python 2\.5\.2", reply["stdout"]))
+            self.assert_(re.search(r"SETUP_TCLTK=", reply["stdout"]))
+
+        reply = self.request(["-f", "Linux", "goober"])
+        self.assertEquals(reply["stdout"].strip(), "false")
+
+    def testStalledClient(self):
+        path = os.path.join(self.tmpdir, "socket2")
+        eups.daemon.start(path, idleTimeout=60, connectionTimeout=0.5)
+
+        # a client that connects but never sends its request mustn't block the others
+        stalled = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            stalled.connect(path)
+            self.assert_(eups.daemon.isRunning(path))
+        finally:
+            stalled.close()
+            eups.daemon.stop(path)
+
+    def testFallback(self):
+        reply = self.request(["-Z", testEupsStack, "python"])
+        self.assert_(reply.has_key("fallback"))
+
+        os.environ["EUPS_PATH"] = self.tmpdir
+        reply = self.request(["python"])
+        self.assert_(reply.has_key("fallback"))
+
+    def testStop(self):
+        self.assert_(eups.daemon.stop(self.socket))
+        for i in range(50):
+            if not os.path.exists(self.socket):
+                break
+            time.sleep(0.1)
+        self.assert_(not eups.daemon.isRunning(self.socket))
+        self.assert_(self.request(["python"]) is None)
+
+class RunCmdTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.environ0 = os.environ.copy()
+        os.environ["EUPS_PATH"] = testEupsStack
+        os.environ["EUPS_FLAVOR"] = "Linux"
+        for k in os.environ.keys():
+            if k.startswith("SETUP_") or k.endswith("_DIR") and k != "EUPS_DIR":
+                del os.environ[k]
+        hooks.config.Eups.defaultTags = dict(pre=[], post=[]) # disable any defined in the startup.py file
+
+        self.err = StringIO.StringIO()
+        eups.cmd._errstrm = self.err
+        #
+        # Don't really replace this process; just remember what we were asked to run
+        #
+        self.execvpe = os.execvpe
+        self.executed = []
+        def execvpe(file, args, env):
+            self.executed.append((file, args, dict(env)))
+        os.execvpe = execvpe
+
+    def tearDown(self):
+        os.execvpe = self.execvpe
+        os.environ = self.environ0
+
+    def runCmd(self, args):
+        cmd = eups.cmd.EupsCmd(args=args.split(), toolname=prog)
+        return cmd.run()
+
+    def testRun(self):
+        self.runCmd("run python tcltk:8.5a4 -- printenv -0 PYTHON_DIR")
+        self.assertEquals(len(self.executed), 1)
+        file, args, env = self.executed[0]
+        self.assertEquals(file, "printenv")
+        self.assertEquals(args, ["printenv", "-0", "PYTHON_DIR"])
+        self.assert_(re.search(r"^python 2\.5\.2", env["SETUP_PYTHON"]))
+        self.assert_(re.search(r"^tcltk 8\.5a4", env["SETUP_TCLTK"]))
+
+    def testRunFailures(self):
+        self.assertNotEqual(self.runCmd("run python"), 0)     # no command
+        self.assertNotEqual(self.runCmd("run -- true"), 0)    # no products
+        self.assertNotEqual(self.runCmd("run goober -- true"), 0)
+        self.assertEquals(self.executed, [])
 
 class Stdout(object):
 
@@ -426,7 +661,9 @@ def suite(makeSuite=True):
     """Return a test suite"""
 
     return testCommon.makeSuite([CmdTestCase,
-                                 SetupCmdTestCase
+                                 SetupCmdTestCase,
+                                 RunCmdTestCase,
+                                 DaemonTestCase
                                  ], makeSuite)
 
 def run(shouldExit=False):
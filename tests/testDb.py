@@ -7,6 +7,7 @@ import os
 import sys
 import shutil
 import re
+import tempfile
 import unittest
 import time
 import testCommon
@@ -134,6 +135,25 @@ class VersionFileTestCase(unittest.TestCase):
         self.assert_("Darwin" in flavors)
         self.assert_("Linux:rhel" in flavors)
 
+    def testAtomicWrite(self):
+        dir = tempfile.mkdtemp()
+        try:
+            file = os.path.join(dir, "fw.version")
+            shutil.copyfile(os.path.join(testEupsStack, "fw.version"), file)
+            os.chmod(file, 0640)
+            ino = os.stat(file).st_ino
+
+            self.vf.addFlavor("Linux:rhel", "/opt/sw/Linux/fw/1.2",
+                              "/opt/sw/Linux/fw/1.2/ups/fw.table", "ups")
+            self.vf.write(file=file)
+            # the file was replaced, not rewritten, and nothing else was left behind
+            self.assertNotEquals(os.stat(file).st_ino, ino)
+            self.assertEquals(os.stat(file).st_mode & 0777, 0640)
+            self.assertEquals(os.listdir(dir), ["fw.version"])
+            self.assert_("Linux:rhel" in VersionFile(file).getFlavors())
+        finally:
+            shutil.rmtree(dir)
+
 class MacroSubstitutionTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -719,6 +739,114 @@ class DatabaseTestCase(unittest.TestCase):
 
         os.rename(self.pycur+".bak", self.pycur)
 
+    def testGeneration(self):
+        genfile = os.path.join(self.dbpath, ".generation")
+        if os.path.exists(genfile):
+            os.remove(genfile)
+        if not os.path.exists(self.pycur+".bak"):
+            shutil.copyfile(self.pycur, self.pycur+".bak")
+
+        self.assert_(self.db.getGeneration() is None)
+        self.db.initGeneration()
+        gen = self.db.getGeneration()
+        self.assert_(gen is not None)
+        self.db.initGeneration()
+        self.assertEquals(self.db.getGeneration(), gen)
+
+        self.db.assignTag("current", "python", "2.6")
+        self.assertEquals(self.db.getGeneration(), gen + 1)
+        self.db.unassignTag("current", "python", "Linux")
+        self.assertEquals(self.db.getGeneration(), gen + 2)
+        self.assert_(not self.db.unassignTag("current", "python", "Linux"))
+        self.assertEquals(self.db.getGeneration(), gen + 2)
+
+        # user tags are recorded (and counted) in the user database
+        self.assert_(self.db.getGeneration(self.userdb) is None)
+        self.db.assignTag("user:mine", "python", "2.6")
+        self.assertEquals(self.db.getGeneration(self.userdb), 1)
+        self.assertEquals(self.db.getGeneration(), gen + 2)
+
+        os.rename(self.pycur+".bak", self.pycur)
+
+    def testJournal(self):
+        for f in [".generation", ".journal"]:
+            f = os.path.join(self.dbpath, f)
+            if os.path.exists(f):
+                os.remove(f)
+        if not os.path.exists(self.pycur+".bak"):
+            shutil.copyfile(self.pycur, self.pycur+".bak")
+
+        # no journal to consult
+        self.assert_(self.db.getChanges(0) is None)
+
+        self.db.initGeneration()
+        gen = self.db.getGeneration()
+        self.assertEquals(self.db.getChanges(gen), [])
+
+        self.db.assignTag("current", "python", "2.6")
+        self.db.unassignTag("current", "python", "Linux")
+        changes = self.db.getChanges(gen)
+        self.assertEquals(len(changes), 2)
+        self.assertEquals(changes[0], (gen+1, "tag", "python", "2.6", ["Linux"], "current"))
+        self.assertEquals(changes[1][:4], (gen+2, "untag", "python", None))
+        self.assertEquals(changes[1][5], "current")
+        self.assertEquals(self.db.getChanges(gen+1), changes[1:])
+
+        # changes made before the journal was started can't be accounted for
+        self.assert_(self.db.getChanges(gen-1) is None)
+
+        os.rename(self.pycur+".bak", self.pycur)
+
+    def testJournalTrim(self):
+        dbModule = sys.modules["eups.db.Database"]
+        maxJournalEntries = dbModule.maxJournalEntries
+        dbModule.maxJournalEntries = 5
+        try:
+            self.db.initGeneration()
+            gen = self.db.getGeneration()
+            for i in range(50):
+                self.db._bumpGeneration(change=("tag", "python", "2.6", ["Linux"], "current"))
+
+            fd = open(os.path.join(self.dbpath, ".journal"))
+            try:
+                nline = len(fd.readlines())
+            finally:
+                fd.close()
+            self.assert_(nline < 50)
+            self.assertEquals(len(self.db.getChanges(gen + 45)), 5)
+        finally:
+            dbModule.maxJournalEntries = maxJournalEntries
+
+    def testConcurrentGenerations(self):
+        # writers that only lock the products that they change may bump the generation together
+        dbpath = tempfile.mkdtemp()
+        try:
+            db = Database(dbpath)
+            db.initGeneration()
+            gen = db.getGeneration()
+
+            rfd, wfd = os.pipe()        # the children start when wfd is closed
+            pids = []
+            for i in range(4):
+                pid = os.fork()
+                if pid == 0:
+                    try:
+                        os.close(wfd)
+                        os.read(rfd, 1)
+                        for j in range(50):
+                            Database(dbpath)._bumpGeneration()
+                    finally:
+                        os._exit(0)
+                pids.append(pid)
+            os.close(rfd)
+            os.close(wfd)
+            for pid in pids:
+                os.waitpid(pid, 0)
+
+            self.assertEquals(db.getGeneration(), gen + 200)
+        finally:
+            shutil.rmtree(dbpath)
+
     def testDeclare(self):
         pdir = self.db._productDir("base")
         if os.path.isdir(pdir):  
@@ -792,6 +920,80 @@ class DatabaseTestCase(unittest.TestCase):
                            
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 
+from eups.db import TagIndex
+from eups.db.TagIndex import getTagIndex
+
+class TagIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = os.path.join(testEupsStack, "tagindex_ups_db")
+        if os.path.exists(self.root):
+            shutil.rmtree(self.root)
+        os.makedirs(self.root)
+        self.pdir = os.path.join(self.root, "python")
+        shutil.copytree(os.path.join(testEupsStack, "ups_db", "python"), self.pdir)
+        self.age()
+
+    def tearDown(self):
+        TagIndex.persistent(False)
+        if os.path.exists(self.root):
+            shutil.rmtree(self.root)
+
+    def age(self):
+        # pretend that the chain files were last changed a while ago
+        t = time.time() - 60
+        os.utime(self.pdir, (t, t))
+
+    def testBuild(self):
+        index = TagIndex(self.pdir, "python")
+        self.assert_(not index.isCurrent())
+        index.build()
+        self.assert_(index.isCurrent())
+        self.assertEquals(index.findTags("2.5.2", "Linux"), ["current"])
+        self.assertEquals(index.findTags("2.6", "Linux"), [])
+        self.assertEquals(index.getAssignments(), [("current", "2.5.2", "Linux")])
+
+        # a recently modified directory can't be trusted
+        os.utime(self.pdir, None)
+        index.build()
+        self.assert_(not index.isCurrent())
+
+    def testInvalidation(self):
+        index = getTagIndex(self.pdir, "python")
+        self.assert_(getTagIndex(self.pdir, "python") is index)
+
+        chain = open(os.path.join(self.pdir, "current.chain")).read()
+        fd = open(os.path.join(self.pdir, "beta.chain"), "w")
+        fd.write(chain.replace("CHAIN = current", "CHAIN = beta"))
+        fd.close()
+        self.assert_(not index.isCurrent())
+        index = getTagIndex(self.pdir, "python")
+        self.assertEquals(sorted(index.findTags("2.5.2", "Linux")), ["beta", "current"])
+
+        # a chain file rewritten by Database marks the index as out of date
+        self.age()
+        index = getTagIndex(self.pdir, "python")
+        self.assert_(index.isCurrent())
+        db = Database(self.root)
+        db.assignTag("current", "python", "2.6")
+        self.assertEquals(db.findTags("python", "2.6", "Linux"), ["current"])
+        self.assertEquals(db.findTags("python", "2.5.2", "Linux"), ["beta"])
+
+    def testPersist(self):
+        TagIndex.persistent(True)
+        file = os.path.join(self.root, ".tagIndex", "python")
+        index = getTagIndex(self.pdir, "python")
+        self.assert_(os.path.exists(file))
+
+        restored = TagIndex(self.pdir, "python")
+        self.assert_(restored.load(file))
+        self.assert_(restored.isCurrent())
+        self.assertEquals(restored.getAssignments(), index.getAssignments())
+        self.assertEquals(restored.findTags("2.5.2", "Linux"), ["current"])
+
+        os.utime(self.pdir, None)
+        self.assert_(not restored.isCurrent())
+
 def suite(makeSuite=True):
     """Return a test suite"""
 
@@ -799,6 +1001,7 @@ def suite(makeSuite=True):
         ChainFileTestCase,
         DatabaseTestCase,
         MacroSubstitutionTestCase,
+        TagIndexTestCase,
         VersionFileTestCase,
         ], makeSuite)
 
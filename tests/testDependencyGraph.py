@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+Tests for eups.DependencyGraph
+"""
+import os
+import unittest
+import testCommon
+from testCommon import testEupsStack
+
+from eups.Product import Product
+from eups.DependencyGraph import DependencyGraph
+from eups.Eups import Eups
+import eups.hooks
+
+def prod(name, version="1.0"):
+    return Product(name, version, "Linux")
+
+class DependencyGraphTestCase(unittest.TestCase):
+    """test queries on a DependencyGraph"""
+
+    def setUp(self):
+        # top -> a -> c,  top -> b -> c -> d, b -(optional)-> e
+        self.top, self.a, self.b, self.c, self.d, self.e = [prod(n) for n in "top a b c d e".split()]
+        productDictionary = {
+            self.top : [[self.a, False, 1], [self.b, False, 1]],
+            self.a   : [[self.c, False, 2]],
+            self.b   : [[self.c, False, 2], [self.e, True, 2]],
+            self.c   : [[self.d, False, 3]],
+            }
+        self.graph = DependencyGraph(self.top, productDictionary)
+        self.graph.dependentProducts = [[self.a, False, 1], [self.c, False, 2], [self.d, False, 3],
+                                        [self.b, False, 1], [self.c, False, 2], [self.e, True, 2]]
+
+    def testQueries(self):
+        self.assertEquals(len(self.graph.products()), 6)
+        self.assertEquals(self.graph.getDependencies(), [(self.a, False), (self.b, False)])
+        self.assertEquals(self.graph.closure(), set([self.a, self.b, self.c, self.d, self.e]))
+        self.assertEquals(self.graph.closure(self.b), set([self.c, self.d, self.e]))
+        self.assertEquals(self.graph.closure(self.b, includeOptional=False), set([self.c, self.d]))
+        self.assertEquals(self.graph.closure(self.d), set())
+        self.assertEquals(self.graph.cycles(), [])
+
+    def testTopological(self):
+        levels = self.graph.topologicalOrder()
+        position = {}
+        for i, level in enumerate(levels):
+            for p in level:
+                position[p] = i
+        for p, q in [(self.d, self.c), (self.c, self.a), (self.c, self.b), (self.a, self.top)]:
+            self.assert_(position[p] < position[q], "%s should precede %s" % (p.name, q.name))
+
+        deps = self.graph.getDependentProducts(topological=True)
+        self.assertEquals([p[0].name for p in deps], ["a", "b", "c", "d", "e"]) # by depth, then name
+        self.assertEquals(len(self.graph.getDependentProducts()), 6) # not made unique
+
+    def testCycles(self):
+        graph = DependencyGraph(self.a, {self.a : [[self.b, False, 1]],
+                                         self.b : [[self.c, False, 2]],
+                                         self.c : [[self.a, False, 3]]})
+        self.assertEquals([set(c) for c in graph.cycles()], [set([self.a, self.b, self.c])])
+        self.assertRaises(RuntimeError, graph.topologicalOrder, True)
+
+class EupsDependencyGraphTestCase(unittest.TestCase):
+    """test the graphs resolved by Eups"""
+
+    def setUp(self):
+        self.environ0 = os.environ.copy()
+        os.environ["EUPS_PATH"] = testEupsStack
+        os.environ["EUPS_FLAVOR"] = "Linux"
+        os.environ["EUPS_USERDATA"] = os.path.join(testEupsStack, "_userdata_")
+        self.eups = Eups()
+
+    def tearDown(self):
+        os.environ = self.environ0
+
+    def testResolve(self):
+        python = self.eups.findProduct("python", "2.5.2")
+        graph = self.eups.getDependencyGraph(python, topological=True)
+        implicit = eups.hooks.config.Eups.defaultProduct["name"]
+        self.assertEquals([(p.name, p.version) for p in graph.closure() if p.name != implicit],
+                          [("tcltk", "8.5a4")])
+        self.assertEquals([(p[0].name, p[0].version, p[1]) for p in graph.getDependentProducts(True)
+                           if p[0].name != implicit], [("tcltk", "8.5a4", False)])
+        self.assertEquals([p[0:2] for p in graph.getDependentProducts(True)],
+                          [p[0:2] for p in self.eups.getDependentProducts(python, topological=True)])
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+
+def suite(makeSuite=True):
+    """Return a test suite"""
+
+    return testCommon.makeSuite([
+        DependencyGraphTestCase,
+        EupsDependencyGraphTestCase,
+        ], makeSuite)
+
+def run(shouldExit=False):
+    """Run the tests"""
+    testCommon.run(suite(), shouldExit)
+
+if __name__ == "__main__":
+    run(True)
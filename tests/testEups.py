@@ -5,6 +5,7 @@ Tests for eups.Eups
 
 import os
 import sys
+import re
 import shutil
 import unittest
 import time
@@ -15,6 +16,7 @@ from testCommon import testEupsStack
 from eups import TagNotRecognized, Product, ProductNotFound, EupsException
 from eups.Eups import Eups
 from eups.stack import ProductStack
+from eups.db import Database, UsesIndex
 from eups.utils import Quiet
 import eups.hooks
 
@@ -34,10 +36,7 @@ class EupsTestCase(unittest.TestCase):
 
     def tearDown(self):
         flavors = self.eups.versions[testEupsStack].getFlavors()
-        for flav in flavors:
-            file = os.path.join(self.dbpath, ProductStack.persistFilename(flav))
-            if os.path.exists(file):
-                os.remove(file)
+        self.eups.versions[testEupsStack].clearCache(flavors, self.dbpath)
 
         usercachedir = os.path.join(testEupsStack,"_userdata_","_caches_")
         if os.path.exists(usercachedir):
@@ -479,6 +478,56 @@ class EupsTestCase(unittest.TestCase):
         self.assert_(not os.environ.has_key("TCLTK_DIR"))
         self.assert_(not os.environ.has_key("SETUP_TCLTK"))
 
+    def testVroMemo(self):
+        # each product is only found once for a given VRO
+        hits, misses = self.eups.vroMemoHits, self.eups.vroMemoMisses
+        prod = self.eups.findProductFromVRO("python")[0]
+        self.assertEquals(prod.version, "2.5.2")
+        self.assertEquals(self.eups.vroMemoMisses, misses + 1)
+        prod = self.eups.findProductFromVRO("python")[0]
+        self.assertEquals(prod.version, "2.5.2")
+        self.assertEquals(self.eups.vroMemoHits, hits + 1)
+
+        # changing the VRO mustn't reuse the old answers...
+        self.eups.pushStack("vro", "version")
+        self.assert_(self.eups.findProductFromVRO("python")[0] is None)
+        self.assertEquals(self.eups.findProductFromVRO("python", "2.6")[0].version, "2.6")
+        self.assertEquals(self.eups.vroMemoMisses, misses + 3)
+
+        # ...but restoring it can
+        self.eups.popStack("vro")
+        self.assertEquals(self.eups.findProductFromVRO("python")[0].version, "2.5.2")
+        self.assertEquals(self.eups.vroMemoHits, hits + 2)
+
+        # remembered answers print the same warnings as searching again
+        vro = ["beta", "warn:0", "current"]
+        stderr0 = sys.stderr
+        try:
+            for i in range(2):
+                sys.stderr = StringIO()
+                self.assertEquals(self.eups.findProductFromVRO("python", vro=vro)[0].version, "2.5.2")
+                self.assert_(re.search(r"VRO \[beta\] failed to match for python", sys.stderr.getvalue()))
+        finally:
+            sys.stderr = stderr0
+        self.assertEquals(self.eups.vroMemoHits, hits + 3)
+
+        # changing the tags forgets the answers
+        vro = ["beta", "current"]
+        self.assertEquals(self.eups.findProductFromVRO("python", vro=vro)[0].version, "2.5.2")
+        self.eups.assignTag("beta", "python", "2.6")
+        self.assertEquals(self.eups.findProductFromVRO("python", vro=vro)[0].version, "2.6")
+
+    def testVroVersionExpr(self):
+        # the latest version satisfying the expression is chosen, whether or not the cache is used
+        vro = ["versionExpr"]
+        for noCache in (False, True):
+            for expr, version in [(">= 2.5", "2.6"), ("< 2.6", "2.5.2"), ("> 2.6", None)]:
+                prod = self.eups.findProductFromVRO("python", expr, vro=vro, noCache=noCache)[0]
+                if version:
+                    self.assertEquals(prod.version, version)
+                else:
+                    self.assert_(prod is None)
+
     def testRemove(self):
         os.environ = self.environ0
 
@@ -558,6 +607,120 @@ class EupsCacheTestCase(unittest.TestCase):
         prod = e2.findProduct("newprod")
         self.assert_(prod is not None, "Failed to declare product")
 
+    def testValidateCache(self):
+        # no cache yet: read the database directly rather than building one
+        e1 = Eups(validateCache=True)
+        self.assert_(not e1.versions.has_key(testEupsStack))
+        self.assertEquals(e1.findProduct("python", "2.5.2").dir,
+                          os.path.join(testEupsStack, "Linux", "python", "2.5.2"))
+
+        Eups().versions                 # reading the stacks builds the cache
+        e1 = Eups(validateCache=True)
+        self.assert_(e1.versions.has_key(testEupsStack))
+        self.assertEquals(e1.findProduct("python", "2.5.2").dir,
+                          os.path.join(testEupsStack, "Linux", "python", "2.5.2"))
+
+        # someone else changes the database; the change is replayed from
+        # the database's journal so that the cache can still be used
+        time.sleep(1)
+        Database(self.dbpath).assignTag("beta", "python", "2.5.2")
+        e3 = Eups(validateCache=True)
+        self.assert_(e3.versions.has_key(testEupsStack))
+        self.assert_("beta" in e3.findProduct("python", "2.5.2").tags)
+
+        # without the journal, the cache mustn't be used
+        time.sleep(1)
+        Database(self.dbpath).unassignTag("beta", "python")
+        os.remove(os.path.join(self.dbpath, ".journal"))
+        e4 = Eups(validateCache=True)
+        self.assert_(not e4.versions.has_key(testEupsStack))
+        self.assert_("beta" not in e4.findProduct("python", "2.5.2").tags)
+
+    def testLazyInit(self):
+        # the product stacks aren't read until they're needed
+        e = Eups()
+        self.assert_(e._versions is None)
+        self.assert_(not e._tagsLoaded)
+        self.assert_(not os.path.exists(os.path.join(testEupsStack, "_userdata_", "_caches_")))
+        self.assertEquals(e.flavor, "Linux")
+        self.assert_(e._versions is None)
+
+        # but are when a product is looked up, along with the tags in them
+        self.assertEquals(e.findProduct("python", "2.5.2").dir,
+                          os.path.join(testEupsStack, "Linux", "python", "2.5.2"))
+        self.assert_(e._versions.has_key(testEupsStack))
+        self.assert_(e._tagsLoaded)
+        self.assert_(e.preferredTags)
+
+        # asking about the tags reads the stacks too
+        e = Eups()
+        self.assert_(e.tags.isRecognized("stable"))
+        self.assert_(e._versions.has_key(testEupsStack))
+
+    def countingEups(self):
+        # an Eups that records the products whose entries in the uses index it recomputes
+        e = Eups()
+        e.recomputed = []
+        productUses = e._productUses
+        e._productUses = lambda product: e.recomputed.append(product.name) or productUses(product)
+        return e
+
+    def testUsesIndex(self):
+        Database(self.dbpath).initGeneration()
+        countingEups = self.countingEups
+
+        e1 = countingEups()
+        users = [u[0:2] for u in e1.uses("tcltk")]
+        self.assertEquals(users, [("python", "2.5.2")])
+        self.assertEquals(len(e1.recomputed), len(e1.findProducts()))
+        self.assert_(os.path.exists(os.path.join(e1._userStackCache(testEupsStack), ".usesIndex")))
+
+        # the saved index is used by the next process
+        e2 = countingEups()
+        self.assertEquals([u[0:2] for u in e2.uses("tcltk")], users)
+        self.assertEquals(e2.recomputed, [])
+
+        # only the changed product (and any products that use it) are recomputed
+        pdir10 = os.path.join(testEupsStack, "Linux", "newprod", "1.0")
+        e2.declare("newprod", "1.0", pdir10, testEupsStack, tablefile=StringIO("setupRequired(python)\n"))
+
+        e3 = countingEups()
+        self.assertEquals(sorted([u[0:2] for u in e3.uses("tcltk")]), [("newprod", "1.0"), ("python", "2.5.2")])
+        self.assertEquals(e3.recomputed, ["newprod"])
+
+        e3.undeclare("newprod", "1.0")
+        e4 = countingEups()
+        self.assertEquals([u[0:2] for u in e4.uses("tcltk")], users)
+        self.assertEquals(e4.recomputed, [])
+
+    def testUsesIndexUnresolved(self):
+        # products that asked for a product but didn't find it are its users too
+        index = UsesIndex()
+        index.set(("newprod", "1.0", "Linux"), [], requests=["goober"])
+        self.assertEquals(index.findUsers(["goober"]), set([("newprod", "1.0", "Linux")]))
+
+        Database(self.dbpath).initGeneration()
+
+        # newprod optionally uses a product that isn't declared yet, and newprod2 uses newprod
+        pdir10 = os.path.join(testEupsStack, "Linux", "newprod", "1.0")
+        pdir11 = os.path.join(testEupsStack, "Linux", "newprod", "1.1")
+        e1 = self.countingEups()
+        e1.declare("newprod", "1.0", pdir10, testEupsStack, tablefile=StringIO("setupOptional(goober)\n"))
+        e1.declare("newprod2", "1.0", pdir10, testEupsStack, tablefile=StringIO("setupRequired(newprod)\n"))
+        try:
+            self.assertEquals([u[0:2] for u in e1.uses("tcltk")], [("python", "2.5.2")])
+
+            # declaring it makes newprod (and so newprod2) depend on what it uses
+            e1.declare("goober", "1.0", pdir11, testEupsStack, tablefile=StringIO("setupRequired(tcltk)\n"))
+            e2 = self.countingEups()
+            self.assertEquals(sorted([u[0:2] for u in e2.uses("tcltk")]),
+                              [("goober", "1.0"), ("newprod", "1.0"), ("newprod2", "1.0"), ("python", "2.5.2")])
+            self.assertEquals(sorted(e2.recomputed), ["goober", "newprod", "newprod2"])
+        finally:
+            for name in ("newprod2", "newprod", "goober"):
+                if e1.findProduct(name):
+                    e1.undeclare(name, "1.0")
+
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 
 def suite(makeSuite=True):
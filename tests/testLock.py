@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+"""
+Tests for eups.lock
+"""
+
+import errno
+import os
+import re
+import sys
+import shutil
+import signal
+import StringIO
+import tempfile
+import time
+import unittest
+import testCommon
+
+import eups.hooks as hooks
+import eups.lock as lock
+
+class FcntlLockTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.lockFile = os.path.join(self.dir, lock._lockFile)
+        self.lockMethod = hooks.config.site.lockMethod
+        hooks.config.site.lockMethod = "fcntl"
+        self.lockPid = os.environ.get("EUPS_LOCK_PID")
+        self.children = []
+
+    def tearDown(self):
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+
+        hooks.config.site.lockMethod = self.lockMethod
+        if self.lockPid is None:
+            if os.environ.has_key("EUPS_LOCK_PID"):
+                del os.environ["EUPS_LOCK_PID"]
+        else:
+            os.environ["EUPS_LOCK_PID"] = self.lockPid
+        shutil.rmtree(self.dir)
+
+    def holdLock(self, lockType, setLockPid=False):
+        """Take a lock in a child process, which holds it until it's killed"""
+        rfd, wfd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(rfd)
+                if setLockPid:
+                    os.environ.pop("EUPS_LOCK_PID", None)
+                lock.takeLocks("child", [self.dir], lockType, verbose=-1)
+                os.write(wfd, "ok")
+                while True:
+                    time.sleep(10)
+            finally:
+                os._exit(1)
+
+        self.children.append(pid)
+        os.close(wfd)
+        self.assertEquals(os.read(rfd, 2), "ok")
+        os.close(rfd)
+
+        return pid
+
+    def isHeld(self):
+        """Do we hold the lock on self.dir?"""
+        return lock._fcntlLocks.has_key((os.getpid(), self.lockFile))
+
+    def testSharedLocks(self):
+        self.holdLock(lock.LOCK_SH)
+
+        locks = lock.takeLocks("test", [self.dir], lock.LOCK_SH, timeout=0, verbose=-1)
+        self.assertEquals(len(locks), 1)
+        self.assert_(os.path.exists(self.lockFile))
+        self.assert_(not os.path.exists(os.path.join(self.dir, lock._lockDir)))
+        lock.giveLocks(locks)
+        self.assertEquals(locks, [])
+
+        t0 = time.time()
+        self.assertRaises(RuntimeError, lock.takeLocks, "test", [self.dir], lock.LOCK_EX,
+                          timeout=0.2, verbose=-1)
+        self.assert_(time.time() - t0 < 5)
+
+    def testExclusiveLock(self):
+        pid = self.holdLock(lock.LOCK_EX)
+
+        self.assertRaises(RuntimeError, lock.takeLocks, "test", [self.dir], lock.LOCK_SH,
+                          timeout=0.1, verbose=-1)
+        lockers = lock.listFcntlLockers(self.lockFile)
+        self.assertEquals(len(lockers), 1)
+        self.assert_(lockers[0].endswith("pid=%d]" % pid))
+        #
+        # The lock is released when its holder dies, and we get it without polling for it
+        #
+        def kill(*args):
+            os.kill(pid, signal.SIGKILL)
+        signal.signal(signal.SIGALRM, kill)
+        signal.setitimer(signal.ITIMER_REAL, 0.2)
+        try:
+            locks = lock.takeLocks("test", [self.dir], lock.LOCK_EX, timeout=-1, verbose=-1)
+        finally:
+            signal.signal(signal.SIGALRM, signal.SIG_DFL)
+        self.assertEquals(len(locks), 1)
+        lock.giveLocks(locks)
+        self.assertEquals(lock.listFcntlLockers(self.lockFile), [])
+
+    def testParentLock(self):
+        pid = self.holdLock(lock.LOCK_EX, setLockPid=True)
+
+        os.environ["EUPS_LOCK_PID"] = str(pid)
+        self.assertEquals(lock.takeLocks("test", [self.dir], lock.LOCK_EX, timeout=0, verbose=-1), [])
+
+    def testNestedLocks(self):
+        outer = lock.takeLocks("test", [self.dir], lock.LOCK_SH, verbose=-1)
+        inner = lock.takeLocks("test", [self.dir], lock.LOCK_EX, verbose=-1)
+        lock.giveLocks(inner)
+        #
+        # We still hold the lock, so another process can't get it
+        #
+        self.assert_(self.isHeld())
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.environ.pop("EUPS_LOCK_PID", None) # we're not really a child of the lock's holder
+                lock.takeLocks("child", [self.dir], lock.LOCK_SH, timeout=0, verbose=-1)
+            except RuntimeError:
+                os._exit(0)
+            os._exit(1)
+        self.assertEquals(os.waitpid(pid, 0)[1], 0)
+
+        lock.giveLocks(outer)
+        self.assert_(not self.isHeld())
+
+    def testFcntlUnavailable(self):
+        # if fcntl locks can't be taken we mustn't quietly use a lock directory instead
+        def lockf(*args):
+            raise IOError(errno.ENOLCK, "No locks available")
+        lockf0, lock._lockf = lock._lockf, lockf
+        try:
+            self.assertRaises(RuntimeError, lock.takeLocks, "test", [self.dir], lock.LOCK_SH, verbose=-1)
+        finally:
+            lock._lockf = lockf0
+        self.assert_(not os.path.exists(os.path.join(self.dir, lock._lockDir)))
+
+    def testMkdirLocks(self):
+        hooks.config.site.lockMethod = "mkdir"
+
+        locks = lock.takeLocks("test", [self.dir], lock.LOCK_SH, verbose=-1)
+        self.assertEquals(len(locks), 1)
+        self.assert_(os.path.isdir(os.path.join(self.dir, lock._lockDir)))
+        lock.giveLocks(locks)
+        self.assert_(not os.path.exists(os.path.join(self.dir, lock._lockDir)))
+
+class LockStatsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.lockStatsSize = hooks.config.site.lockStatsSize
+        hooks.config.site.lockStatsSize = 1000
+        self.lockMethod = hooks.config.site.lockMethod
+        hooks.config.site.lockMethod = "fcntl"
+
+    def tearDown(self):
+        hooks.config.site.lockStatsSize = self.lockStatsSize
+        hooks.config.site.lockMethod = self.lockMethod
+        shutil.rmtree(self.dir)
+
+    def testRecords(self):
+        locks = lock.takeLocks("declare", [self.dir], lock.LOCK_EX, verbose=-1)
+        lock.giveLocks(locks)
+        locks = lock.takeLocks("list", [self.dir], lock.LOCK_SH, verbose=-1)
+        lock.giveLocks(locks)
+
+        records = lock.readLockStats(self.dir)
+        self.assertEquals(len(records), 2)
+        self.assertEquals([(r["cmd"], r["type"], r["pid"], r["retries"]) for r in records],
+                          [("declare", "exclusive", os.getpid(), 0), ("list", "shared", os.getpid(), 0)])
+        self.assert_(records[0]["hold"] >= 0 and records[0]["wait"] >= 0)
+
+        out = StringIO.StringIO()
+        sys.stdout, stdout = out, sys.stdout
+        try:
+            lock.listLockStats([self.dir])
+        finally:
+            sys.stdout = stdout
+        self.assert_(re.search(r"^  declare\s+exclusive\s+1 ", out.getvalue(), re.MULTILINE))
+
+    def testFailure(self):
+        locks = lock.takeLocks("declare", [self.dir], lock.LOCK_EX, verbose=-1)
+
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.environ.pop("EUPS_LOCK_PID", None)
+                lock.takeLocks("admin info", [self.dir], lock.LOCK_SH, timeout=0.1, verbose=-1)
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        lock.giveLocks(locks)
+
+        failed = lock.readLockStats(self.dir)[0]
+        self.assertEquals((failed["cmd"], failed["hold"], failed["retries"]), ("admin info", None, 1))
+
+    def takeLocksInChildren(self, nchild, nlock):
+        """Take and give back nlock shared locks in each of nchild processes at the same time"""
+        pids = []
+        for i in range(nchild):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    os.environ.pop("EUPS_LOCK_PID", None)
+                    for j in range(nlock):
+                        lock.giveLocks(lock.takeLocks("cmd%d" % i, [self.dir], lock.LOCK_SH, verbose=-1))
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+        for pid in pids:
+            os.waitpid(pid, 0)
+
+    def testConcurrentRecords(self):
+        # no records are lost when processes record their use of a lock at the same time...
+        self.takeLocksInChildren(4, 100)
+        self.assertEquals(len(lock.readLockStats(self.dir)), 400)
+        #
+        # ...or corrupted when the file is being trimmed
+        #
+        hooks.config.site.lockStatsSize = 20
+        self.takeLocksInChildren(4, 100)
+        records = open(os.path.join(self.dir, lock._lockStats)).readlines()
+        self.assertEquals(len(lock.readLockStats(self.dir)), len(records))
+        self.assert_(20 <= len(records) < 100)
+
+    def testTrim(self):
+        hooks.config.site.lockStatsSize = 3
+        for i in range(50):
+            locks = lock.takeLocks("cmd%d" % i, [self.dir], lock.LOCK_SH, verbose=-1)
+            lock.giveLocks(locks)
+
+        records = lock.readLockStats(self.dir)
+        self.assert_(len(records) < 10)
+        self.assertEquals(records[-1]["cmd"], "cmd49")
+
+        hooks.config.site.lockStatsSize = 0
+        locks = lock.takeLocks("cmd", [self.dir], lock.LOCK_SH, verbose=-1)
+        lock.giveLocks(locks)
+        self.assertEquals(lock.readLockStats(self.dir)[-1]["cmd"], "cmd49")
+
+class ProductLockTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.lockGranularity = hooks.config.site.lockGranularity
+        hooks.config.site.lockGranularity = "product"
+        self.lockMethod = hooks.config.site.lockMethod
+        hooks.config.site.lockMethod = "fcntl"
+        self.lockPid = os.environ.pop("EUPS_LOCK_PID", None)
+        self.children = []
+
+    def tearDown(self):
+        for pid in self.children:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+
+        hooks.config.site.lockGranularity = self.lockGranularity
+        hooks.config.site.lockMethod = self.lockMethod
+        os.environ.pop("EUPS_LOCK_PID", None)
+        if self.lockPid is not None:
+            os.environ["EUPS_LOCK_PID"] = self.lockPid
+        shutil.rmtree(self.dir)
+
+    def holdLock(self, lockType, products):
+        """Take a lock in a child process, which holds it until it's killed"""
+        rfd, wfd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(rfd)
+                lock.takeLocks("declare", [self.dir], lockType, verbose=-1, products=products)
+                os.write(wfd, "ok")
+                while True:
+                    time.sleep(10)
+            finally:
+                os._exit(1)
+
+        self.children.append(pid)
+        os.close(wfd)
+        self.assertEquals(os.read(rfd, 2), "ok")
+        os.close(rfd)
+
+    def tryLock(self, lockType, products=None):
+        """Return True iff we can take the lock"""
+        try:
+            locks = lock.takeLocks("test", [self.dir], lockType, timeout=0, verbose=-1, products=products)
+        except RuntimeError:
+            return False
+        lock.giveLocks(locks)
+        return True
+
+    def testProductLocks(self):
+        self.holdLock(lock.LOCK_EX, ["foo"])
+
+        self.assert_(self.tryLock(lock.LOCK_SH))                 # readers aren't blocked
+        self.assert_(self.tryLock(lock.LOCK_EX, ["bar"]))        # nor are writers of other products
+        self.assert_(not self.tryLock(lock.LOCK_EX, ["foo"]))
+        self.assert_(not self.tryLock(lock.LOCK_EX))             # but admin commands are
+
+        out = StringIO.StringIO()
+        sys.stdout, stdout = out, sys.stdout
+        try:
+            lock.listLocks([self.dir])
+        finally:
+            sys.stdout = stdout
+        self.assert_(re.search(r"^%s:" % os.path.join(self.dir, lock._productLocks, "foo"), out.getvalue(),
+                               re.MULTILINE))
+
+    def testAdminLock(self):
+        self.holdLock(lock.LOCK_EX, None)
+
+        self.assert_(not self.tryLock(lock.LOCK_SH))
+        self.assert_(not self.tryLock(lock.LOCK_EX, ["bar"]))
+
+    def testStackGranularity(self):
+        hooks.config.site.lockGranularity = "stack"
+        self.holdLock(lock.LOCK_EX, ["foo"])
+
+        self.assert_(not self.tryLock(lock.LOCK_SH))
+        self.assert_(not os.path.exists(os.path.join(self.dir, lock._productLocks)))
+
+def suite(makeSuite=True):
+    """Return a test suite"""
+
+    return testCommon.makeSuite([
+        FcntlLockTestCase,
+        LockStatsTestCase,
+        ProductLockTestCase,
+        ], makeSuite)
+
+def run(shouldExit=False):
+    """Run the tests"""
+    testCommon.run(suite(), shouldExit)
+
+if __name__ == "__main__":
+    run(True)
@@ -7,10 +7,14 @@ import os
 import sys
 import unittest
 import time
+import shutil
+import tempfile
 
 import testCommon
 from testCommon import testEupsStack
 from eups.Product import Product, TableFileNotFound
+from eups.TableRegistry import TableRegistry
+import eups.TableRegistry
 
 class ProductTestCase(unittest.TestCase):
     """test the Product container class"""
@@ -84,6 +88,72 @@ class ProductTestCase(unittest.TestCase):
         if os.path.exists("test_product.pickle"):
             os.remove("test_product.pickle")
 
+class TableRegistryTestCase(unittest.TestCase):
+    """test the sharing of tables between Products"""
+
+    def setUp(self):
+        self.registry0 = eups.TableRegistry._tableRegistry
+        self.registry = eups.TableRegistry._tableRegistry = TableRegistry(2)
+
+        self.tmpdir = tempfile.mkdtemp(prefix="eupsTableRegistry")
+        self.tablefile = os.path.join(self.tmpdir, "ups", "mwi.table")
+        os.mkdir(os.path.dirname(self.tablefile))
+        shutil.copyfile(os.path.join(testEupsStack, "mwi.table"), self.tablefile)
+        self.setAge(10)
+
+    def tearDown(self):
+        eups.TableRegistry._tableRegistry = self.registry0
+        shutil.rmtree(self.tmpdir)
+
+    def setAge(self, age):
+        t = time.time() - age
+        os.utime(self.tablefile, (t, t))
+
+    def product(self, version="1.0", name="mwi"):
+        return Product(name, version, "Linux", self.tmpdir, self.tablefile)
+
+    def testShare(self):
+        table = self.product().getTable()
+        self.assert_(self.product().getTable() is table)
+        self.assertEquals(self.registry.stats()["hits"], 1)
+
+        # another version expands the table differently
+        self.assert_(self.product("2.0").getTable() is not table)
+
+        # the table file's changed
+        fd = open(self.tablefile, "a")
+        print >> fd, "envSet(MWI_EXTRA, yes)"
+        fd.close()
+        self.setAge(5)
+        self.assert_(self.product().getTable() is not table)
+
+    def testEviction(self):
+        table = self.product("1.0").getTable()
+        self.product("2.0").getTable()
+        self.product("3.0").getTable()
+        self.assertEquals(len(self.registry), 2)
+        self.assertEquals(self.registry.stats()["evictions"], 1)
+        self.assert_(self.product("1.0").getTable() is not table)
+
+        self.registry.resize(1)
+        self.assertEquals(len(self.registry), 1)
+        self.registry.resize(0)
+        self.product("1.0").getTable()
+        self.assertEquals(len(self.registry), 0)
+
+    def testInvalidate(self):
+        table = self.product().getTable()
+        self.registry.invalidate("other")
+        self.assert_(self.product().getTable() is table)
+        self.registry.invalidate("mwi")
+        self.assertEquals(self.registry.stats()["invalidations"], 1)
+        self.assert_(self.product().getTable() is not table)
+
+    def testRecentTable(self):
+        self.setAge(0)                  # it may be modified again without its mtime changing
+        table = self.product().getTable()
+        self.assert_(self.product().getTable() is not table)
+
 class ProductTransformationTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -235,7 +305,7 @@ class ProductTransformationTestCase(unittest.TestCase):
 def suite(makeSuite=True):
     """Return a test suite"""
 
-    return testCommon.makeSuite((ProductTestCase, ProductTransformationTestCase), makeSuite)
+    return testCommon.makeSuite((ProductTestCase, TableRegistryTestCase, ProductTransformationTestCase), makeSuite)
 
 def run(shouldExit=False):
     """Run the tests"""
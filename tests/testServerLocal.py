@@ -7,6 +7,7 @@ import pdb                              # we may want to say pdb.set_trace()
 import os
 import sys
 import shutil
+import tempfile
 import unittest
 import time
 from testCommon import testEupsStack
@@ -166,6 +167,28 @@ class LocalRepositoryTestCase(unittest.TestCase):
         man = self.repos.getManifest("doxygen", "1.5.8", "generic")
         self.assert_(man is not None)
 
+    def testPrefetch(self):
+        distrib = self.repos.getDistribFor("lsstbuild:doxygen.tar.gz", {}, "Linux")
+        path = "manifests/doxygen-1.5.8.manifest"
+        buildDir = tempfile.mkdtemp()
+        try:
+            self.assert_(distrib.takePrefetchedFile(path, buildDir) is None)
+            distrib.prefetchPackage(path, "doxygen", "1.5.8", buildDir)
+
+            file = os.path.join(buildDir, "doxygen.manifest")
+            self.assertEquals(distrib.takePrefetchedFile(path, buildDir, file), file)
+            self.assertEquals(os.listdir(buildDir), ["doxygen.manifest"])
+            self.assertEquals(open(file).read(), open(os.path.join(self.pkgroot, path)).read())
+            os.remove(file)
+
+            # a file that wasn't prefetched by this process is ignored
+            stale = os.path.join(buildDir, "doxygen-1.5.8.manifest.prefetched")
+            open(stale, "w").close()
+            self.assert_(distrib.takePrefetchedFile(path, buildDir) is None)
+            self.assertEquals(os.listdir(buildDir), [])
+        finally:
+            shutil.rmtree(buildDir)
+
     def testListPackages(self):
         pkgs = self.repos.listPackages()
         self.assert_(pkgs is not None)
@@ -124,6 +124,7 @@ class ProductFamilyTestCase(unittest.TestCase):
 
 from eups.stack import ProductStack
 from eups import ProductNotFound, UnderSpecifiedProduct
+from eups.VersionCompare import VersionCompare
 
 class ProductStackTestCase(unittest.TestCase):
 
@@ -193,6 +194,36 @@ class ProductStackTestCase(unittest.TestCase):
         for ver in expected:
             self.assert_(ver in vers)
 
+    def testGetSortedVersions(self):
+        versionCmp = VersionCompare()
+        self.assertEquals(self.stack.getSortedVersions("afw", "Linux", versionCmp), [])
+
+        for ver in "1.10 1.2 1.9".split():
+            self.stack.addProduct(Product("fw", ver, "Linux",
+                                          "/opt/sw/Linux/fw/"+ver, "none"))
+        vers = self.stack.getSortedVersions("fw", "Linux", versionCmp)
+        self.assertEquals(vers, "1.2 1.9 1.10".split())
+        self.assert_(self.stack.getSortedVersions("fw", "Linux", versionCmp) is vers)
+
+        # adding or removing a version must not return the stale list
+        self.stack.addProduct(Product("fw", "1.3", "Linux",
+                                      "/opt/sw/Linux/fw/1.3", "none"))
+        self.assertEquals(self.stack.getSortedVersions("fw", "Linux", versionCmp),
+                          "1.2 1.3 1.9 1.10".split())
+        self.stack.removeProduct("fw", "Linux", "1.9")
+        self.assertEquals(self.stack.getSortedVersions("fw", "Linux", versionCmp),
+                          "1.2 1.3 1.10".split())
+
+        self.assertEquals(self.stack.getSortedVersions("fw", None, versionCmp),
+                          "1.2 1.3 1.10".split())
+
+        # the sorted list isn't persisted with the cache
+        self.stack.save("Linux")
+        self.stack.reload("Linux")
+        self.assertEquals(self.stack.getSortedVersions("fw", "Linux", versionCmp),
+                          "1.2 1.3 1.10".split())
+        self.stack.clearCache()
+
     def testAutoSave(self):
         self.assert_(self.stack.saveNeeded())
 
@@ -207,7 +238,8 @@ class ProductStackTestCase(unittest.TestCase):
                                  "/opt/sw/Darwin/fw/1.2", "none"))
         self.assert_(not stack.saveNeeded())
         self.assert_(os.path.exists(cache))
-        if os.path.exists(cache):  os.remove(cache)
+        stack.clearCache("Darwin")
+        self.assert_(not os.path.exists(cache))
 
     def testHasProduct(self):
         self.assert_(self.stack.hasProduct("fw"))
@@ -425,6 +457,8 @@ class ProductStackTestCase(unittest.TestCase):
 
 
 from eups.stack import CacheOutOfSync
+from eups.db import Database
+import shutil
 
 class CacheTestCase(unittest.TestCase):
 
@@ -468,6 +502,187 @@ class CacheTestCase(unittest.TestCase):
         ps2.addProduct(Product("fw", "1.2", "Linux", 
                                "/opt/sw/Darwin/fw/1.2", "none"))
         self.assertRaises(CacheOutOfSync, ps2.save)
+
+    def testParallelRefresh(self):
+        serial = ProductStack.fromDatabase(self.dbpath, autosave=False)
+        parallel = ProductStack.fromDatabase(self.dbpath, autosave=False, crawlThreads=8)
+        self.assertEquals(parallel.crawlThreads, 8)
+
+        self.assertEquals(sorted(parallel.getFlavors()), sorted(serial.getFlavors()))
+        for flavor in serial.getFlavors():
+            names = serial.getProductNames(flavor)
+            self.assertEquals(sorted(parallel.getProductNames(flavor)), sorted(names))
+            for name in names:
+                self.assertEquals(parallel.lookup[flavor][name].versions,
+                                  serial.lookup[flavor][name].versions)
+                self.assertEquals(parallel.lookup[flavor][name].tags,
+                                  serial.lookup[flavor][name].tags)
+
+class SqliteCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dbpath = os.path.join(testEupsStack, "ups_db")
+        self.cache = os.path.join(self.dbpath, 
+                                  ProductStack.persistFilename("Linux", "sqlite"))
+        self.pickleCache = os.path.join(self.dbpath, 
+                                        ProductStack.persistFilename("Linux"))
+        self.tearDown()
+
+    def tearDown(self):
+        ProductStack(self.dbpath, autosave=False).clearCache("Linux Linux64".split())
+
+    def testPersistFilename(self):
+        self.assertEquals(ProductStack.persistFilename("Linux", "sqlite"),
+                          "Linux.sqliteDB1_3_0")
+
+    def testRoundTrip(self):
+        ps = ProductStack.fromCache(self.dbpath, "Linux", autosave=False, 
+                                    indexBackend="sqlite")
+        self.assert_(os.path.exists(self.cache))
+        self.assert_(not os.path.exists(self.pickleCache))
+        self.assert_("Linux" in ProductStack.findCachedFlavors(self.dbpath))
+        self.assert_("Linux" in ProductStack.findCachedFlavors(self.dbpath, "sqlite"))
+        self.assert_("Linux" not in ProductStack.findCachedFlavors(self.dbpath, "pickle"))
+
+        ps = ProductStack.fromCache(self.dbpath, "Linux", autosave=False, 
+                                    indexBackend="sqlite")
+        # nothing is read until it is asked for
+        self.assertEquals(len(dict.keys(ps.lookup["Linux"])), 0)
+
+        p = ps.getProduct("python", "2.5.2", "Linux")
+        self.assertEquals(p.dir, os.path.join(testEupsStack, "Linux", "python", "2.5.2"))
+        self.assert_("current" in p.tags)
+        self.assertEquals(dict.keys(ps.lookup["Linux"]), ["python"])
+
+        versions = ps.getVersions("python", "Linux")
+        versions.sort()
+        self.assertEquals(versions, ["2.5.2", "2.6"])
+        self.assertEquals(ps.getTaggedProduct("python", "Linux", "current").version, "2.5.2")
+        self.assert_(ps.getTaggedProduct("python", "Linux", "gurn") is None)
+        self.assertRaises(ProductNotFound, ps.getProduct, "goober", "1.0", "Linux")
+
+        names = ps.getProductNames("Linux")
+        names.sort()
+        self.assertEquals(names, "cfitsio doxygen eigen mpich2 python tcltk".split())
+
+    def testUpdate(self):
+        ps = ProductStack.fromCache(self.dbpath, "Linux", autosave=False, 
+                                    indexBackend="sqlite")
+        ps = ProductStack.fromCache(self.dbpath, "Linux", autosave=False, 
+                                    indexBackend="sqlite")
+        ps.addProduct(Product("afw", "1.2", "Linux", "/opt/sw/Linux/afw/1.2", "none"))
+        self.assert_(ps.removeProduct("eigen", "Linux", "2.0.0"))
+        ps.save("Linux")
+
+        ps.reload("Linux")
+        self.assert_(ps.hasProduct("afw", "Linux", "1.2"))
+        self.assert_(not ps.hasProduct("eigen", "Linux"))
+        self.assert_(ps.hasProduct("python", "Linux", "2.6"))
+
+    def testGeneration(self):
+        db = Database(self.dbpath)
+        db.initGeneration()
+        ProductStack.fromCache(self.dbpath, "Linux", autosave=False, indexBackend="sqlite")
+
+        ps = ProductStack(self.dbpath, autosave=False, indexBackend="sqlite")
+        self.assert_(ps.cacheIsUpToDate("Linux"))
+        self.assertEquals(ps._checkCache("Linux"), (True, True))
+
+        # a change that doesn't go through Database isn't noticed unless we look at every file
+        time.sleep(1)
+        beta = os.path.join(self.dbpath, "python", "beta.chain")
+        try:
+            shutil.copyfile(os.path.join(self.dbpath, "python", "current.chain"), beta)
+            self.assert_(ps.cacheIsUpToDate("Linux"))
+            self.assert_(not ps.cacheIsUpToDate("Linux", fullCheck=True))
+
+            db.assignTag("beta", "python", "2.6")
+            self.assert_(not ps.cacheIsUpToDate("Linux"))
+        finally:
+            if os.path.exists(beta):
+                os.remove(beta)
+
+    def testJournal(self):
+        db = Database(self.dbpath)
+        db.initGeneration()
+        ProductStack.fromCache(self.dbpath, "Linux", autosave=False, indexBackend="sqlite")
+
+        ps = ProductStack(self.dbpath, autosave=False, indexBackend="sqlite")
+        time.sleep(1)
+        db.assignTag("beta", "python", "2.6")
+        try:
+            self.assert_(not ps.cacheIsUpToDate("Linux"))
+            self.assert_(ps._tryJournal(self.dbpath, ["Linux"]))
+            self.assert_("beta" in ps.getProduct("python", "2.6", "Linux").tags)
+            self.assert_(ps.hasProduct("tcltk", "Linux", "8.5a4"))
+
+            # the cache is brought up to date without a full refresh
+            ps = ProductStack.fromCache(self.dbpath, "Linux", autosave=False, indexBackend="sqlite")
+            self.assert_("beta" in ps.getProduct("python", "2.6", "Linux").tags)
+            self.assert_(ps.cacheIsUpToDate("Linux"))
+        finally:
+            db.unassignTag("beta", "python")
+
+        # a journal that doesn't reach back far enough can't be used
+        os.remove(os.path.join(self.dbpath, ".journal"))
+        self.assert_(not ps.cacheIsUpToDate("Linux"))
+        self.assert_(not ps._tryJournal(self.dbpath, ["Linux"]))
+
+    def testIsCurrent(self):
+        db = Database(self.dbpath)
+        db.initGeneration()
+        ProductStack.fromCache(self.dbpath, "Linux", autosave=False, indexBackend="sqlite")
+        ps = ProductStack.fromValidCache(self.dbpath, ["Linux"], indexBackend="sqlite")
+        self.assert_(ps.isCurrent(["Linux"]))
+
+        time.sleep(1)
+        db.assignTag("beta", "python", "2.6")
+        try:
+            self.assert_(not ps.isCurrent(["Linux"]))
+        finally:
+            db.unassignTag("beta", "python")
+
+    def testConcurrentWrite(self):
+        db = Database(self.dbpath)
+        db.initGeneration()
+        #
+        # Modify the database while the stack is reading it
+        #
+        ps = ProductStack(self.dbpath, autosave=False, indexBackend="sqlite")
+        addProduct, tagged = ps.addProduct, []
+        def addProductAndTag(product):
+            if not tagged:
+                db.assignTag("beta", "python", "2.6")
+                tagged.append(True)
+            addProduct(product)
+        ps.addProduct = addProductAndTag
+        try:
+            ps.refreshFromDatabase()
+            # the database was reread, so we saw the change
+            self.assert_("beta" in ps.getProduct("python", "2.6", "Linux").tags)
+            self.assertEquals(ps._readGenerations[self.dbpath], db.getGeneration())
+            #
+            # A cache holding data read before a change is stamped with the generation that it was read at,
+            # so it isn't trusted
+            #
+            ps = ProductStack.fromCache(self.dbpath, "Linux", autosave=False, indexBackend="sqlite")
+            self.assert_(ps.cacheIsUpToDate("Linux"))
+            ps._readGenerations[self.dbpath] -= 1
+            ps.save("Linux")
+            self.assert_(not ps.cacheIsUpToDate("Linux"))
+            self.assert_(ps._tryJournal(self.dbpath, ["Linux"]))
+        finally:
+            db.unassignTag("beta", "python")
+
+    def testPickleFallback(self):
+        ps = ProductStack.fromCache(self.dbpath, "Linux", autosave=False)
+        self.assert_(os.path.exists(self.pickleCache))
+        self.assert_(ps.cacheIsUpToDate("Linux"))
+
+        ps = ProductStack(self.dbpath, autosave=False, indexBackend="sqlite")
+        self.assert_(ps.cacheIsUpToDate("Linux"))
+        ps.reload("Linux")
+        self.assert_(ps.hasProduct("python", "Linux", "2.5.2"))
         
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 
@@ -477,7 +692,8 @@ def suite(makeSuite=True):
     return testCommon.makeSuite([
         CacheTestCase,
         ProductFamilyTestCase,
-        ProductStackTestCase
+        ProductStackTestCase,
+        SqliteCacheTestCase,
         ], makeSuite)
 
 def run(shouldExit=False):
@@ -8,12 +8,16 @@ import os
 import sys
 import unittest
 import time
+import shutil
+import tempfile
 import testCommon
 from testCommon import testEupsStack
 
 from eups.Product import Product, TableFileNotFound
-from eups.table import Table, BadTableContent
+from eups.table import Table, Action, BadTableContent
 from eups.Eups import Eups
+from eups.VersionParser import VersionParser, compileExpression
+from eups.TableCache import TableCache, getTableCache
 
 class TableTestCase1(unittest.TestCase):
     """test the Table class"""
@@ -170,8 +174,138 @@ class IfElseTestCase(unittest.TestCase):
             self.assertEqual(os.environ["FOO"].lower(), t)
                 
 
+class ActionsCacheTestCase(unittest.TestCase):
+    """
+    Check that the actions selected for a flavor/type are remembered, but
+    not once an environment variable used in a condition changes
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="eupsActions")
+        self.tablefile = os.path.join(self.tmpdir, "cond.table")
+        fd = open(self.tablefile, "w")
+        print >> fd, """\
+if (${EUPS_TEST_COND:-false}) {
+   envSet(COND, yes)
+} else {
+   envSet(COND, no)
+}
+if (type == exact) {
+   envSet(EXACT, yes)
+}
+"""
+        fd.close()
+        self.table = Table(self.tablefile)
+        self.oldCond = os.environ.get("EUPS_TEST_COND")
+
+    def tearDown(self):
+        if self.oldCond is None:
+            os.environ.pop("EUPS_TEST_COND", None)
+        else:
+            os.environ["EUPS_TEST_COND"] = self.oldCond
+        shutil.rmtree(self.tmpdir)
+
+    def actionStrings(self, *args):
+        return [str(a) for a in self.table.actions("Linux", *args) if a.cmd == Action.envSet]
+
+    def testCache(self):
+        os.environ.pop("EUPS_TEST_COND", None)
+        actions = self.actionStrings()
+        self.assertEquals(len(actions), 1)
+        self.assert_("no" in actions[0])
+
+        self.table.actions("Linux").append("junk") # we're given a copy of the cached list
+        self.assertEquals(self.actionStrings(), actions)
+        self.assertEquals(len(self.table._actionsCache), 1)
+
+        self.assertEquals(len(self.actionStrings(["exact"])), 2)
+
+        os.environ["EUPS_TEST_COND"] = "true"
+        actions = self.actionStrings()
+        self.assertEquals(len(actions), 1)
+        self.assert_("yes" in actions[0])
+        self.assertEquals(len(self.table._actionsCache), 3)
+
+    def testCompiledExpression(self):
+        expr = compileExpression("${EUPS_TEST_COND:-false} || type == exact")
+        self.assert_(compileExpression(str(expr)) is expr)
+        self.assertEquals(expr.envVars, ["EUPS_TEST_COND"])
+
+        os.environ.pop("EUPS_TEST_COND", None)
+        self.assert_(not expr.eval({"type" : "other"}))
+        self.assert_(expr.eval({"type" : "exact"}))
+        self.assertEquals(expr.eval(), VersionParser(str(expr)).eval())
+
+    def testPickle(self):
+        import cPickle
+        self.table.actions("Linux")
+        table = cPickle.loads(cPickle.dumps(self.table))
+        self.assert_(not hasattr(table, "_actionsCache"))
+        self.assertEquals([str(a) for a in table.actions("Linux")],
+                          [str(a) for a in self.table.actions("Linux")])
+
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 
+class TableCacheTestCase(unittest.TestCase):
+    """test the saving of parsed table files"""
+
+    def setUp(self):
+        self.dir0 = TableCache.directory()
+        self.tmpdir = tempfile.mkdtemp(prefix="eupsTableCache")
+        TableCache.directory(os.path.join(self.tmpdir, "_tables_"))
+
+        self.tablefile = os.path.join(self.tmpdir, "mwi.table")
+        shutil.copyfile(os.path.join(testEupsStack, "mwi.table"), self.tablefile)
+        self.setAge(10)
+
+    def tearDown(self):
+        TableCache.directory(self.dir0 or "")
+        shutil.rmtree(self.tmpdir)
+
+    def setAge(self, age):
+        t = time.time() - age
+        os.utime(self.tablefile, (t, t))
+
+    def actionStrings(self, table):
+        return [str(a) for a in table.actions("Linux")]
+
+    def testReuse(self):
+        cache = getTableCache()
+        table = Table(self.tablefile)
+        self.assertEquals(cache.stats()["stores"], 1)
+        self.assertEquals(cache.entries(), 1)
+
+        table2 = Table(self.tablefile)
+        self.assertEquals(cache.hits, 1)
+        self.assertEquals(self.actionStrings(table2), self.actionStrings(table))
+        self.assertEquals(len(table2.actions("Darwin")), 14)
+
+        # a different top product is a different entry
+        Table(self.tablefile, Product("mwi", "1.0"))
+        self.assertEquals(cache.hits, 1)
+        self.assertEquals(cache.entries(), 2)
+
+        cache.clear()
+        self.assertEquals(cache.entries(), 0)
+
+    def testInvalidation(self):
+        cache = getTableCache()
+        Table(self.tablefile)
+
+        fd = open(self.tablefile, "a")
+        print >> fd, "envSet(MWI_EXTRA, yes)"
+        fd.close()
+        self.setAge(5)
+
+        table = Table(self.tablefile)
+        self.assertEquals(cache.hits, 0)
+        self.assert_([a for a in table.actions("DarwinX86") if a.args and a.args[0] == "MWI_EXTRA"])
+
+        # a file that's just been modified isn't saved, as its modification time might not change again
+        self.setAge(0)
+        stores = cache.stores
+        Table(self.tablefile)
+        self.assertEquals(cache.stores, stores)
+
 def suite(makeSuite=True):
     """Return a test suite"""
 
@@ -180,6 +314,8 @@ def suite(makeSuite=True):
         TableTestCase1,
         TableTestCase2,
         IfElseTestCase,
+        ActionsCacheTestCase,
+        TableCacheTestCase,
         ], makeSuite)
 
 def run(shouldExit=False):
@@ -9,6 +9,7 @@ import sys
 import unittest
 import time
 import cStringIO
+import random
 from testCommon import testEupsStack
 
 from eups import utils
@@ -34,6 +35,114 @@ class UtilsTestCase(unittest.TestCase):
         msg += "gen.beta.zeta: No such property name defined\n"
         self.assertEquals(err.getvalue(), msg)
 
+    def testStronglyConnectedComponents(self):
+        graph = {"a" : ["b"], "b" : ["c", "d"], "c" : ["a"], "d" : ["e"], "e" : ["d"], "f" : []}
+        components = utils.stronglyConnectedComponents(graph)
+        self.assertEquals(sorted([sorted(c) for c in components]), [["a", "b", "c"], ["d", "e"], ["f"]])
+        # components are listed after the components that they depend on
+        order = [c[0] for c in components]
+        self.assert_(order.index("d") < order.index("a"))
+
+    def testDeepGraph(self):
+        """Check that long chains of dependencies don't exhaust the stack"""
+        n = 5*sys.getrecursionlimit()
+        graph = {}
+        for i in xrange(n):
+            graph[i] = (i + 1 < n and [i + 1]) or []
+        self.assertEquals(len(utils.stronglyConnectedComponents(graph)), n)
+
+        graph[n - 1] = [0]              # one big cycle
+        self.assertEquals(len(utils.stronglyConnectedComponents(graph)), 1)
+        self.assertEquals([len(level) for level in utils.topologicalSort(graph)], [n])
+
+    def testTopologicalSort(self):
+        graph = {"a" : ["b", "c", "a"], "b" : ["d"], "c" : ["d", "e"], "d" : []}
+        self.assertEquals(list(utils.topologicalSort(graph)), [["d", "e"], ["b", "c"], ["a"]])
+
+        graph["d"] = ["a"]
+        self.assertRaises(RuntimeError, lambda: list(utils.topologicalSort(graph, checkCycles=True)))
+        self.assertEquals(list(utils.topologicalSort(graph)), [["e"], ["a", "b", "c", "d"]])
+
+    def testTopologicalSortRandom(self):
+        """Check that every node comes after its dependencies in random graphs"""
+        rand = random.Random(666)
+        for n in [1, 10, 100, 1000]:
+            graph = {}
+            for i in xrange(n):
+                graph[i] = [rand.randrange(i + 1) for j in xrange(rand.randrange(5))]
+
+            level = {}
+            for l, nodes in enumerate(utils.topologicalSort(graph, checkCycles=True)):
+                for node in nodes:
+                    level[node] = l
+            self.assertEquals(len(level), n)
+            for node, successors in graph.items():
+                for successor in successors:
+                    if successor != node:
+                        self.assert_(level[successor] < level[node])
+
+    def testParallelMap(self):
+        items = range(50)
+        def slowSquare(i):
+            time.sleep(0.001*(i % 5))
+            return i*i
+        expected = map(slowSquare, items)
+        for n in [1, 4, 100]:
+            self.assertEquals(utils.parallelMap(slowSquare, items, n), expected)
+        self.assertEquals(utils.parallelMap(slowSquare, [], 4), [])
+
+        def fail(i):
+            if i % 10 == 7:
+                raise ValueError(i)
+            return i
+        try:
+            utils.parallelMap(fail, items, 4)
+            self.fail("failed to raise ValueError")
+        except ValueError, e:
+            self.assertEquals(e.args, (7,))
+
+    def testForkMap(self):
+        items = range(23)
+        parent = os.getpid()
+        def square(i):
+            return (i*i, os.getpid() != parent)
+        for n in [1, 4, 100]:
+            results = utils.forkMap(square, items, n)
+            self.assertEquals([r[0] for r in results], [i*i for i in items])
+            self.assertEquals(len(filter(lambda r: r[1], results)), (n > 1 and len(items)) or 0)
+        self.assertEquals(utils.forkMap(square, [], 4), [])
+
+        def fail(i):
+            if i % 10 == 7:
+                raise ValueError(i)
+            return i
+        self.assertRaises(RuntimeError, utils.forkMap, fail, items, 4)
+
+    def testLRUCache(self):
+        cache = utils.LRUCache(3)
+        for k in "abc":
+            cache.put(k, k.upper())
+        self.assertEquals(cache.get("a"), "A") # a is now the most recently used...
+        cache.put("d", "D")                    # ...so b is discarded
+        self.assertEquals(cache.keys(), ["c", "a", "d"])
+        self.assert_("b" not in cache)
+        self.assertEquals(cache.get("b", 0), 0)
+        self.assertEquals((cache.hits, cache.misses), (1, 1))
+
+        cache.put("c", "C2")                   # replacing a value doesn't discard anything
+        self.assertEquals(cache.keys(), ["a", "d", "c"])
+        self.assertEquals(cache.get("c"), "C2")
+        cache.remove("a")
+        cache.remove("a")
+        self.assertEquals(len(cache), 2)
+        cache.clear()
+        self.assertEquals((len(cache), cache.keys()), (0, []))
+
+        cache = utils.LRUCache(None)
+        for i in range(2000):
+            cache.put(i, i)
+        self.assertEquals(len(cache), 2000)
+
 
 __all__ = "UtilsTestCase".split()        
 
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+"""
+Tests for eups.VersionCompare
+"""
+import random
+import unittest
+import testCommon
+
+from eups.VersionCompare import VersionCompare, VersionKey, VersionExpr, sortVersions
+
+# versions of the forms used in the wild (and some odd ones)
+sampleVersions = [
+    "1", "1.0", "1.0.0", "1_0_2", "1.2", "1.2.1", "1.2.2", "1.3", "1.10", "1.9", "2", "10",
+    "v1_0", "v1_0_3", "v1_0_3p1", "v1_0_3m1", "v2_0", "v3_0", "v1.2.3", "v1.2.3+a",
+    "1-a", "1-b", "1+a", "1+b", "1-rc2", "1-rc2+a", "1-rc2+b", "1.2-rc1", "1.2-rc2",
+    "1.2-rc4", "1.2+h1", "1.2-rc1+h1", "1.2.3+svn666", "1.2.3-svn666", "1.2.3+svn100",
+    "1.2.3+svn1000", "1.2.3+rvn1000", "1.2.3+tvn666", "rel-0-8-2", "rel-0-8-10",
+    "w.2012.10", "w.2012.9", "w.2013.1", "b1", "b10", "rc1", "rc2", "alpha", "beta",
+    "2.5.2", "2.6", "3.1.1", "1.0.a", "1.0.b", "1.0.10", "1.0.a1", "1.0.a10", "",
+    "1..2", "1._2", "abc1", "abc", "1.2p3", "1.2m3", "3.0m1+b", "04", "4",
+]
+
+class VersionCompareTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.vcmp = VersionCompare()
+
+    def testKeyAgreesWithStdCompare(self):
+        """The keys must compare exactly as stdCompare does for every pair"""
+        for v1 in sampleVersions:
+            k1 = self.vcmp.sortKey(v1)
+            for v2 in sampleVersions:
+                k2 = self.vcmp.sortKey(v2)
+                self.assertEquals(cmp(k1, k2), self.vcmp.stdCompare(v1, v2),
+                                  "%r vs. %r: %d != %d" % (v1, v2, cmp(k1, k2), self.vcmp.stdCompare(v1, v2)))
+                self.assertEquals(k1 < k2, self.vcmp.stdCompare(v1, v2) < 0)
+
+    def testSortAgreesWithStdCompare(self):
+        """Sorting with keys must give the same order as sorting with compare()"""
+        rand = random.Random(12345)
+        for i in range(50):
+            versions = rand.sample(sampleVersions, rand.randint(2, len(sampleVersions)))
+            expected = versions[:]
+            expected.sort(self.vcmp)
+            sortVersions(versions, self.vcmp)
+            self.assertEquals(versions, expected)
+
+        # with a key function
+        products = [(v, "Linux") for v in sampleVersions]
+        rand.shuffle(products)
+        expected = products[:]
+        expected.sort(lambda a, b: self.vcmp(a[0], b[0]))
+        sortVersions(products, self.vcmp, key=lambda p: p[0])
+        self.assertEquals(products, expected)
+
+    def testKeyCache(self):
+        vcmp = VersionCompare()
+        vcmp.keyCacheSize = 3
+        k = vcmp.sortKey("1.2")
+        self.assert_(vcmp.sortKey("1.2") is k)
+        for v in ["1.3", "1.4", "1.5"]:
+            vcmp.sortKey(v)
+        self.assert_(vcmp.sortKey("1.2") is not k) # it was the least recently used
+        self.assertEquals(len(vcmp._keys), 3)
+        self.assertEquals(vcmp._keys.hits, 1)
+
+    def testKeyAgreesWithUnsortableCompare(self):
+        """With mustReturnInt=False, the keys must also refuse to compare when stdCompare does"""
+        for v1 in sampleVersions:
+            k1 = self.vcmp.sortKey(v1)
+            for v2 in sampleVersions:
+                k2 = self.vcmp.sortKey(v2)
+                try:
+                    expected = self.vcmp.stdCompare(v1, v2, mustReturnInt=False)
+                except ValueError:
+                    self.assertRaises(ValueError, k1.compare, k2, False)
+                else:
+                    self.assertEquals(k1.compare(k2, mustReturnInt=False), expected,
+                                      "%r vs. %r" % (v1, v2))
+
+    def testVersionExpr(self):
+        versions = ["1.0", "1.2", "1.3", "1.10", "2.0", "2.1", "3.0"]
+        def select(expr):
+            return VersionExpr(expr, self.vcmp).select(versions)
+
+        self.assertEquals(select(">= 1.3 && < 2.1"), ["1.3", "1.10", "2.0"])
+        self.assertEquals(select("< 1.2 || > 2.0"), ["1.0", "2.1", "3.0"])
+        self.assertEquals(select("== 1.10"), ["1.10"])
+        self.assertEquals(select("1.2 || 3.0"), ["1.2", "3.0"])
+        self.assertEquals(select("> 3.0"), [])
+        self.assertEquals(VersionExpr(">= 1.2 && < 2", self.vcmp).best(versions), "1.10")
+        self.assertEquals(VersionExpr("> 5", self.vcmp).best(versions), None)
+
+        products = [(v, "Linux") for v in versions]
+        self.assertEquals(VersionExpr("<= 1.2", self.vcmp).select(products, key=lambda p: p[0]),
+                          [("1.0", "Linux"), ("1.2", "Linux")])
+
+    def testVersionExprAgreesWithMatch(self):
+        """Bisecting a sorted list must select exactly the versions that match one at a time"""
+        versions = sampleVersions[:]
+        sortVersions(versions, self.vcmp)
+        # a comparison function that isn't a VersionCompare, so each version's matched in turn
+        stdCompare = lambda v1, v2, mustReturnInt=True: self.vcmp.stdCompare(v1, v2, mustReturnInt=mustReturnInt)
+
+        rand = random.Random(666)
+        relops = ["<", "<=", "==", ">", ">="]
+        for i in range(200):
+            expr = []
+            for j in range(rand.randint(1, 4)):
+                if j > 0:
+                    expr.append(rand.choice(["&&", "||"]))
+                expr += [rand.choice(relops), rand.choice(sampleVersions[:-10])]
+            expr = " ".join(expr)
+
+            expected = []
+            for v in versions:
+                try:
+                    if VersionExpr(expr, stdCompare).match(v):
+                        expected.append(v)
+                except ValueError:
+                    pass
+
+            versionExpr = VersionExpr(expr, self.vcmp)
+            self.assertEquals(versionExpr.select(versions), expected, expr)
+            if expected:
+                self.assertEquals(versionExpr.best(versions), expected[-1], expr)
+            else:
+                self.assertEquals(versionExpr.best(versions), None, expr)
+
+    def testCustomCompare(self):
+        """A subclass (or a plain function) that changes the ordering must be respected"""
+        class ReverseCompare(VersionCompare):
+            def compare(self, v1, v2, mustReturnInt=True):
+                return -VersionCompare.compare(self, v1, v2, mustReturnInt)
+
+        versions = ["1.2", "1.10", "1.3"]
+        sortVersions(versions, ReverseCompare())
+        self.assertEquals(versions, ["1.10", "1.3", "1.2"])
+        self.assert_(not isinstance(ReverseCompare().sortKey("1.2"), VersionKey))
+
+        versions = ["1.2", "1.10", "1.3"]
+        sortVersions(versions, lambda a, b: cmp(a, b))
+        self.assertEquals(versions, ["1.10", "1.2", "1.3"])
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+
+def suite(makeSuite=True):
+    """Return a test suite"""
+
+    return testCommon.makeSuite([
+        VersionCompareTestCase,
+        ], makeSuite)
+
+def run(shouldExit=False):
+    """Run the tests"""
+    testCommon.run(suite(), shouldExit)
+
+if __name__ == "__main__":
+    run(True)